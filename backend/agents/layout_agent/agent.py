@@ -5,22 +5,197 @@ from typing import AsyncGenerator, Optional
 
 from google.adk.agents import LlmAgent
 from google.adk.agents.invocation_context import InvocationContext
+from google.adk.agents.readonly_context import ReadonlyContext
 from google.adk.events.event import Event
-from google.adk.models.google_llm import Gemini
 from google.genai.types import Content, Part
 
 from .deliver_html_tool import html_delivery_tool
+from .html_stream import IncrementalHtmlExtractor
+from .response_cache import layout_response_cache
+from .template_renderer import (
+    parse_outline,
+    render_newsletter_html,
+    validate_outline,
+    wants_custom_design,
+)
 from .prompt import INSTRUCTION
 from agents.shared.file_utils import (
-    load_user_outline,
     save_user_newsletter,
     get_user_id_from_session,
     get_user_images_dir
 )
+from agents.shared.history_compaction import (
+    compact_history_before_model,
+    record_token_usage_after_model,
+)
+from agents.shared.llm_limiter import LimitedGemini
+from agents.shared.model_router import (
+    PRO_MODEL,
+    record_model_route_after_model,
+    route_model_before_model,
+)
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
+# 構成案からのテンプレート生成（LLMを使わない高速パス）を有効にするか
+TEMPLATE_FAST_PATH_ENABLED = os.environ.get("LAYOUT_TEMPLATE_FAST_PATH", "true").lower() == "true"
+
+
+def get_basic_info_from_state(state) -> Optional[dict]:
+    """セッション状態から基本情報を取得"""
+    try:
+        basic_info = {
+            "school_name": state.get("school_name", "○○小学校"),
+            "class_name": state.get("class_name", "3年2組"),
+            "teacher_name": state.get("teacher_name", "田中先生"),
+            "current_date": state.get("current_date", "2025-06-30")
+        }
+
+        # 基本情報が揃っているかチェック
+        if not basic_info["school_name"] or not basic_info["class_name"] or not basic_info["teacher_name"]:
+            logger.warning(f"基本情報不足: {basic_info}")
+            return None
+
+        return basic_info
+
+    except Exception as e:
+        logger.error(f"基本情報取得エラー: {e}")
+        return None
+
+
+def extract_content_from_message(message: Optional[Content]) -> str:
+    """ユーザーのメッセージから学級通信の内容を抽出"""
+    try:
+        content = ""
+        if message and message.parts:
+            for part in message.parts:
+                if part.text:
+                    content += part.text + "\n"
+
+        if not content.strip():
+            content = "今日は素晴らしい一日でした。子どもたちは元気に活動し、たくさんのことを学びました。"
+
+        return content.strip()
+
+    except Exception as e:
+        logger.error(f"会話内容抽出エラー: {e}")
+        return "学級通信の内容がここに入ります。"
+
+
+def get_outline_for_invocation(session, invocation_id: str, agent_name: str = "layout_agent") -> Optional[dict]:
+    """
+    今回の生成依頼で使う構成案を会話履歴から取得
+
+    前回のレイアウト生成より後に会話エージェントが保存した最新の構成案（output_keyのoutline）のみを対象にする。
+    最新の構成案が解析できない場合や、前回以前に生成済みの構成案しかない場合はNone（前回の学級通信を使い回さない）。
+    """
+    for event in reversed(getattr(session, "events", None) or []):
+        if event.author == agent_name and event.invocation_id != invocation_id:
+            return None
+        state_delta = event.actions.state_delta if event.actions else None
+        if state_delta and "outline" in state_delta:
+            return parse_outline(state_delta["outline"])
+    return None
+
+
+def build_cache_content(session, invocation_id: str, agent_name: str = "layout_agent") -> str:
+    """
+    レスポンスキャッシュのキーにする依頼内容
+
+    今回の構成案があればその内容、なければ会話全体のテキスト（最新の発言だけでは依頼を区別できないため）。
+    """
+    outline = get_outline_for_invocation(session, invocation_id, agent_name)
+    if outline is not None:
+        return json.dumps(outline, ensure_ascii=False, sort_keys=True)
+    texts = []
+    for event in getattr(session, "events", None) or []:
+        if event.partial or not event.content or not event.content.parts:
+            continue
+        texts.extend(f"{event.author}: {part.text}" for part in event.content.parts if part.text)
+    return "\n".join(texts)
+
+
+def get_user_images_info_from_state(state) -> str:
+    """セッション状態のアップロード画像情報をHTML生成用の文字列に変換"""
+    try:
+        uploaded_images = state.get("uploaded_images", [])
+
+        if not uploaded_images:
+            logger.info("アップロード画像が見つかりません")
+            return ""
+
+        images_text = []
+        for i, image in enumerate(uploaded_images, 1):
+            if isinstance(image, dict):
+                name = image.get("name", f"image_{i}")
+                url = image.get("url", "")
+                description = image.get("description", "")
+
+                if url:
+                    image_text = f"- 画像{i}: {name}"
+                    if description:
+                        image_text += f" ({description})"
+                    image_text += f" - URL: {url}"
+                    images_text.append(image_text)
+
+        if images_text:
+            logger.info(f"ユーザー画像情報を取得: {len(images_text)}件")
+            return "\n".join(images_text)
+        else:
+            logger.info("有効な画像情報が見つかりません")
+            return ""
+
+    except Exception as e:
+        logger.error(f"ユーザー画像情報取得エラー: {e}")
+        return ""
+
+
+def build_layout_prompt(basic_info: dict, conversation_content: str, user_images_info: str) -> str:
+    """学級通信のHTMLを生成するためのプロンプトを作成"""
+    images_info_text = ""
+    if user_images_info:
+        images_info_text = f"""
+アップロード画像:
+{user_images_info}
+"""
+
+    return f"""
+以下の情報から学級通信のHTMLを生成してください。
+
+基本情報:
+- 学校名: {basic_info['school_name']}
+- クラス名: {basic_info['class_name']}
+- 担任の先生: {basic_info['teacher_name']}
+- 発行日: {basic_info['current_date']}
+
+学級通信の内容:
+{conversation_content}
+{images_info_text}
+要件:
+- 美しくレスポンシブなデザインにしてください
+- 完全なHTMLドキュメントとして出力してください
+- 日本の学級通信らしい温かみのあるデザインにしてください
+- アップロード画像がある場合は、適切に配置して表示してください
+- HTMLのみを出力してください（説明は不要）
+            """
+
+
+def build_layout_instruction(context: ReadonlyContext) -> str:
+    """
+    ADK InstructionProvider: 呼び出しごとにコンテキストからレイアウト用プロンプトを組み立てる
+
+    共有エージェントのself.instructionを書き換えないため、並行実行しても他のユーザーの内容と混ざらない。
+    """
+    basic_info = get_basic_info_from_state(context.state)
+    if not basic_info:
+        return INSTRUCTION
+    return build_layout_prompt(
+        basic_info,
+        extract_content_from_message(context.user_content),
+        get_user_images_info_from_state(context.state),
+    )
+
 
 class LayoutAgent(LlmAgent):
     """
@@ -33,8 +208,9 @@ class LayoutAgent(LlmAgent):
         project_id = os.environ.get("GCP_PROJECT_ID")
         location = os.environ.get("GCP_REGION")
 
+        # 既定はproモデル。呼び出しごとのモデルはroute_model_before_modelが決める
         model_config = {
-            "model_name": "gemini-2.5-pro",
+            "model": PRO_MODEL,
         }
 
         # google-genaiがVertex AIを使うための設定
@@ -56,11 +232,13 @@ class LayoutAgent(LlmAgent):
         
         super().__init__(
             name="layout_agent",
-            model=Gemini(**model_config),
-            instruction=INSTRUCTION,
+            model=LimitedGemini(**model_config),
+            instruction=build_layout_instruction,
             description="学級通信の情報が揃い、ユーザーが「作成してください」「お願いします」「完成させて」等の要求をした際に、美しいHTMLレイアウトを生成してフロントエンドに配信する専門エージェントです。",
             tools=[html_delivery_tool.create_adk_function_tool()],
             output_key=output_key,
+            before_model_callback=[compact_history_before_model, route_model_before_model],
+            after_model_callback=[record_token_usage_after_model, record_model_route_after_model],
         )
 
     async def _run_async_impl(
@@ -72,11 +250,10 @@ class LayoutAgent(LlmAgent):
         AgentTool経由での呼び出しに対応します。
         """
         try:
-            # セッションIDを取得してHTML配信ツールに設定
+            # 配信先のセッションIDは呼び出しごとに取得する（共有ツールには設定しない）
             session_id = self._extract_session_id(ctx)
             if session_id:
-                html_delivery_tool.set_session_id(session_id)
-                logger.info(f"LayoutAgent: セッションID設定完了 - {session_id}")
+                logger.info(f"LayoutAgent: セッションID取得完了 - {session_id}")
             else:
                 logger.warning("LayoutAgent: セッションIDの取得に失敗しました")
 
@@ -113,48 +290,51 @@ class LayoutAgent(LlmAgent):
                 content=Content(parts=[Part(text="美しいデザインで仕上げています...")])
             )
 
-            # 学級通信のHTMLを生成するためのプロンプト作成
-            images_info_text = ""
-            if user_images_info:
-                images_info_text = f"""
-アップロード画像:
-{user_images_info}
-"""
-            
-            enhanced_prompt = f"""
-以下の情報から学級通信のHTMLを生成してください。
-
-基本情報:
-- 学校名: {basic_info['school_name']}
-- クラス名: {basic_info['class_name']}
-- 担任の先生: {basic_info['teacher_name']}
-- 発行日: {basic_info['current_date']}
-
-学級通信の内容:
-{conversation_content}
-{images_info_text}
-要件:
-- 美しくレスポンシブなデザインにしてください
-- 完全なHTMLドキュメントとして出力してください
-- 日本の学級通信らしい温かみのあるデザインにしてください
-- アップロード画像がある場合は、適切に配置して表示してください
-- HTMLのみを出力してください（説明は不要）
-            """
-
-            # 一時的にプロンプトを更新してLLMを実行
-            original_instruction = self.instruction
-            self.instruction = enhanced_prompt
-
-            # LLM実行（イベントを保存してHTMLを抽出）
-            llm_events = []
-            async for event in super()._run_async_impl(ctx):
-                llm_events.append(event)
-
-            # LLMイベントからHTMLを抽出してセッション状態に保存
-            await self._save_html_from_llm_events(ctx, llm_events)
-
-            # プロンプトを元に戻す
-            self.instruction = original_instruction
+            # 構成案が揃っていて、カスタムデザインの要望がなければテンプレートで即時生成する
+            template_html = None
+            if TEMPLATE_FAST_PATH_ENABLED and not wants_custom_design(conversation_content):
+                template_html = self._generate_html_from_template(ctx, basic_info)
+
+            # テンプレートを使わない場合は、同じユーザーの同じ依頼の生成済みHTMLを再利用できるか確認する
+            cache_hit = None
+            cache_user_id = getattr(getattr(ctx, "session", None), "user_id", None)
+            cache_content = build_cache_content(ctx.session, ctx.invocation_id, self.name) if cache_user_id else ""
+            if not template_html and cache_user_id:
+                cache_hit = layout_response_cache.get(cache_user_id, basic_info, cache_content, user_images_info)
+
+            delta_seq = 0
+            if template_html:
+                logger.info("LayoutAgent: テンプレート高速パスでHTMLを生成しました（LLM呼び出しなし）")
+            elif cache_hit:
+                logger.info(f"♻️ LayoutAgent: キャッシュ済みHTMLを再利用します（{cache_hit.tier}, 類似度={cache_hit.similarity}）")
+                self._save_html_to_session(ctx, cache_hit.html)
+            else:
+                # プロンプトはbuild_layout_instructionが呼び出しごとにコンテキストから組み立てる
+                # LLM実行（ストリーミング時は生成途中のHTMLを差分として配信し、確定イベントを保存）
+                llm_events = []
+                extractor = IncrementalHtmlExtractor()
+                async for event in super()._run_async_impl(ctx):
+                    if not event.partial:
+                        llm_events.append(event)
+                        continue
+
+                    delta = extractor.feed(self._extract_text_from_event(event))
+                    if delta:
+                        delta_seq += 1
+                        await html_delivery_tool.deliver_html_delta(session_id, delta, delta_seq)
+                        yield Event(
+                            author=self.name,
+                            partial=True,
+                            custom_metadata={"html_delta": delta, "seq": delta_seq},
+                        )
+
+                # LLMイベントからHTMLを抽出してセッション状態に保存
+                await self._save_html_from_llm_events(ctx, llm_events)
+
+                if cache_user_id and ctx.session.state.get("html"):
+                    layout_response_cache.put(
+                        cache_user_id, basic_info, cache_content, user_images_info, ctx.session.state["html"]
+                    )
 
             # HTMLが正常に生成された場合、配信ツールを自動実行
             if hasattr(ctx, "session") and hasattr(ctx.session, "state") and ctx.session.state.get("html"):
@@ -163,11 +343,23 @@ class LayoutAgent(LlmAgent):
 
                 # HTML配信ツールを自動実行
                 try:
-                    metadata_json = json.dumps({"auto_generated": True, "agent": "layout_agent"})
-                    delivery_result = await html_delivery_tool.deliver_html_to_frontend(
+                    delivery_result = await html_delivery_tool.deliver_html(
+                        session_id=session_id,
                         html_content=html_content,
                         artifact_type="newsletter",
-                        metadata_json=metadata_json
+                        metadata={
+                            "auto_generated": True,
+                            "agent": "layout_agent",
+                            "generator": "template" if template_html else "llm",
+                            "cache": cache_hit.tier if cache_hit else "miss",
+                        },
+                    )
+
+                    # ストリームの最終フレームとして完成したHTML全体を送る
+                    yield Event(
+                        author=self.name,
+                        partial=True,
+                        custom_metadata={"html_complete": html_content, "seq": delta_seq + 1},
                     )
 
                     yield Event(
@@ -214,206 +406,76 @@ class LayoutAgent(LlmAgent):
             # HTMLの抽出
             html_content = self._extract_html_from_response(llm_response_text)
 
-            # セッション状態に保存（ADK標準）
-            if hasattr(ctx, "session") and hasattr(ctx.session, "state"):
-                ctx.session.state["html"] = html_content
-                logger.info("HTMLをセッション状態に保存しました")
-                
-                # ユーザー固有ファイルにも保存
-                user_id = get_user_id_from_session(ctx.session)
-                if user_id:
-                    success = save_user_newsletter(user_id, html_content)
-                    if success:
-                        logger.info(f"✅ ユーザー固有HTMLファイルにも保存成功: user_id={user_id}")
-                    else:
-                        logger.warning(f"⚠️ ユーザー固有HTMLファイル保存に失敗: user_id={user_id}")
-                else:
-                    logger.warning("⚠️ ユーザーIDが取得できないため、ユーザー固有HTMLファイル保存をスキップ")
-
-            logger.info("HTMLをセッション状態とファイルに保存完了")
+            self._save_html_to_session(ctx, html_content)
 
         except Exception as e:
             logger.error(f"LLMイベントからのHTML保存エラー: {e}")
 
+    def _save_html_to_session(self, ctx: InvocationContext, html_content: str):
+        """HTMLをセッション状態とユーザー固有ファイルに保存"""
+        # セッション状態に保存（ADK標準）
+        if hasattr(ctx, "session") and hasattr(ctx.session, "state"):
+            ctx.session.state["html"] = html_content
+            logger.info("HTMLをセッション状態に保存しました")
+
+            # ユーザー固有ファイルにも保存
+            user_id = get_user_id_from_session(ctx.session)
+            if user_id:
+                success = save_user_newsletter(user_id, html_content)
+                if success:
+                    logger.info(f"✅ ユーザー固有HTMLファイルにも保存成功: user_id={user_id}")
+                else:
+                    logger.warning(f"⚠️ ユーザー固有HTMLファイル保存に失敗: user_id={user_id}")
+            else:
+                logger.warning("⚠️ ユーザーIDが取得できないため、ユーザー固有HTMLファイル保存をスキップ")
 
-    async def _generate_html_from_template(self, ctx: InvocationContext, json_obj):
-        """JSONデータからテンプレートベースでHTMLを確実に生成"""
-        try:
-            school_name = json_obj.get('school_name', 'ERROR')
-            grade = json_obj.get('grade', 'ERROR')
-            author_name = json_obj.get('author', {}).get('name', 'ERROR')
-            author_title = json_obj.get('author', {}).get('title', 'ERROR')
-            issue_date = json_obj.get('issue_date', 'ERROR')
-            main_title = json_obj.get('main_title', 'ERROR')
-
-            color_scheme = json_obj.get('color_scheme', {})
-            primary_color = color_scheme.get('primary', '#FFFF99')
-            secondary_color = color_scheme.get('secondary', '#FFCC99')
-            accent_color = color_scheme.get('accent', '#FF9966')
-
-            sections = json_obj.get('sections', [])
-            main_content = ""
-            for section in sections:
-                content = section.get('content', '')
-                # 改行を<p>タグに変換
-                paragraphs = content.split('\n')
-                for paragraph in paragraphs:
-                    if paragraph.strip():
-                        main_content += f"    <p>{paragraph.strip()}</p>\n"
-
-            # 確実なHTMLテンプレート生成
-            template_html = f'''<!DOCTYPE html>
-<html lang="ja">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <title>{school_name} {grade} {json_obj.get('issue', '学級通信')}</title>
-  <style>
-    @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;500;700&display=swap');
-    
-    body {{
-      font-family: 'Noto Sans JP', 'Hiragino Kaku Gothic ProN', 'Hiragino Sans', 'Yu Gothic', 'Meiryo', sans-serif;
-      margin: 0;
-      padding: 20px;
-      background-color: #ffffff;
-      color: #333333;
-      line-height: 1.6;
-      -webkit-font-smoothing: antialiased;
-      -moz-osx-font-smoothing: grayscale;
-    }}
-    .container {{
-      max-width: 800px;
-      margin: 0 auto;
-      background: white;
-      border-radius: 8px;
-      overflow: hidden;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-    }}
-    .header {{
-      background-color: {primary_color};
-      padding: 20px;
-      text-align: center;
-      border-bottom: 3px solid {accent_color};
-    }}
-    .header h1 {{
-      margin: 0;
-      color: #333333;
-      font-size: 24px;
-      font-family: 'Noto Sans JP', 'Hiragino Kaku Gothic ProN', 'Hiragino Sans', 'Yu Gothic', 'Meiryo', sans-serif;
-      font-weight: 500;
-    }}
-    .header p {{
-      margin: 10px 0 0 0;
-      color: #333333;
-    }}
-    .main-content {{
-      padding: 30px;
-    }}
-    .main-content h2 {{
-      color: {accent_color};
-      border-left: 4px solid {secondary_color};
-      padding-left: 15px;
-      margin-bottom: 20px;
-      font-family: 'Noto Sans JP', 'Hiragino Kaku Gothic ProN', 'Hiragino Sans', 'Yu Gothic', 'Meiryo', sans-serif;
-      font-weight: 500;
-    }}
-    .footer {{
-      background-color: {secondary_color};
-      padding: 15px;
-      text-align: center;
-      color: #333333;
-    }}
-    @media print {{
-      body {{ margin: 0; }}
-      .container {{ box-shadow: none; }}
-    }}
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div class="header">
-      <h1>{school_name} {grade}</h1>
-      <p>{json_obj.get('issue', '学級通信')} - {issue_date}</p>
-      <p>発行者: {author_title} {author_name}</p>
-    </div>
-    <div class="main-content">
-      <h2>{main_title}</h2>
-{main_content}
-    </div>
-    <div class="footer">
-      <p>{school_name} {grade}</p>
-    </div>
-  </div>
-</body>
-</html>'''
-
-            # セッション状態に保存
-            if hasattr(ctx, "session") and hasattr(ctx.session, "state"):
-                ctx.session.state["html"] = template_html
-                logger.info("テンプレートHTMLをセッション状態に保存しました")
-
-            # セッション状態のみでデータ保存
-            logger.info("テンプレートHTMLをセッション状態に保存")
+        logger.info("HTMLをセッション状態とファイルに保存完了")
 
-        except Exception as e:
-            logger.error(f"テンプレートHTML生成エラー: {e}")
 
-    def _get_basic_info_from_session(self, ctx: InvocationContext) -> dict:
-        """セッション状態から基本情報を取得"""
+    def _generate_html_from_template(self, ctx: InvocationContext, basic_info: dict) -> Optional[str]:
+        """構成案（outline）からテンプレートベースでHTMLを生成（構成案が不十分な場合はNone）"""
         try:
             if not hasattr(ctx, "session") or not hasattr(ctx.session, "state"):
-                logger.error("セッション状態にアクセスできません")
                 return None
-            
-            state = ctx.session.state
-            basic_info = {
-                "school_name": state.get("school_name", "○○小学校"),
-                "class_name": state.get("class_name", "3年2組"),
-                "teacher_name": state.get("teacher_name", "田中先生"),
-                "current_date": state.get("current_date", "2025-06-30")
-            }
-            
-            # 基本情報が揃っているかチェック
-            if not basic_info["school_name"] or not basic_info["class_name"] or not basic_info["teacher_name"]:
-                logger.warning(f"基本情報不足: {basic_info}")
+
+            # 前回の構成案（セッション状態・保存済みファイル）は使わず、今回の依頼の構成案がなければLLMで生成する
+            outline = get_outline_for_invocation(ctx.session, ctx.invocation_id, self.name)
+            normalized_outline = validate_outline(outline, basic_info)
+            if not normalized_outline:
+                logger.info("テンプレート生成に使える構成案がありません。LLMで生成します")
                 return None
-                
-            return basic_info
-            
+
+            template_html = render_newsletter_html(normalized_outline)
+
+            # セッション状態とユーザー固有ファイルに保存
+            ctx.session.state["html"] = template_html
+            user_id = get_user_id_from_session(ctx.session)
+            if user_id:
+                save_user_newsletter(user_id, template_html)
+            logger.info(f"テンプレートHTMLを生成しました: {len(template_html)}文字 (layout={normalized_outline['layout']})")
+            return template_html
+
         except Exception as e:
-            logger.error(f"基本情報取得エラー: {e}")
+            logger.error(f"テンプレートHTML生成エラー: {e}")
             return None
 
+    def _get_basic_info_from_session(self, ctx: InvocationContext) -> dict:
+        """セッション状態から基本情報を取得"""
+        if not hasattr(ctx, "session") or not hasattr(ctx.session, "state"):
+            logger.error("セッション状態にアクセスできません")
+            return None
+        return get_basic_info_from_state(ctx.session.state)
+
     def _extract_content_from_conversation(self, ctx: InvocationContext) -> str:
         """会話履歴から学級通信の内容を抽出"""
-        try:
-            # セッションから会話履歴を取得
-            if not hasattr(ctx, "session"):
-                return "学級通信の内容がここに入ります。"
-            
-            # 新しいメッセージから内容を抽出
-            content = ""
-            if hasattr(ctx, 'new_message') and ctx.new_message:
-                if hasattr(ctx.new_message, 'parts'):
-                    for part in ctx.new_message.parts:
-                        if hasattr(part, 'text') and part.text:
-                            content += part.text + "\n"
-            
-            if not content.strip():
-                content = "今日は素晴らしい一日でした。子どもたちは元気に活動し、たくさんのことを学びました。"
-            
-            return content.strip()
-            
-        except Exception as e:
-            logger.error(f"会話内容抽出エラー: {e}")
-            return "学級通信の内容がここに入ります。"
+        return extract_content_from_message(getattr(ctx, "user_content", None))
 
     def _extract_session_id(self, ctx: InvocationContext) -> Optional[str]:
         """InvocationContextからセッションIDを抽出"""
         try:
-            # ADKセッションからセッションIDを取得
-            if hasattr(ctx, "session") and hasattr(ctx.session, "session_id"):
-                session_id = ctx.session.session_id
+            # フロントエンドと同じ "user_id:session_id" 形式でセッションIDを組み立てる
+            if hasattr(ctx, "session") and getattr(ctx.session, "id", None) and getattr(ctx.session, "user_id", None):
+                session_id = f"{ctx.session.user_id}:{ctx.session.id}"
                 logger.info(f"セッションID抽出成功: {session_id}")
                 return session_id
 
@@ -527,44 +589,10 @@ class LayoutAgent(LlmAgent):
 
     def _get_user_images_info(self, ctx: InvocationContext) -> str:
         """セッション状態からユーザーの画像情報を取得してHTML用の文字列を生成"""
-        try:
-            # セッション状態から画像情報を取得
-            if not (hasattr(ctx, "session") and hasattr(ctx.session, "state")):
-                logger.warning("セッション状態にアクセスできません")
-                return ""
-            
-            session_state = ctx.session.state
-            uploaded_images = session_state.get("uploaded_images", [])
-            
-            if not uploaded_images:
-                logger.info("アップロード画像が見つかりません")
-                return ""
-            
-            # 画像情報をHTML生成用のテキストに変換
-            images_text = []
-            for i, image in enumerate(uploaded_images, 1):
-                if isinstance(image, dict):
-                    name = image.get("name", f"image_{i}")
-                    url = image.get("url", "")
-                    description = image.get("description", "")
-                    
-                    if url:
-                        image_text = f"- 画像{i}: {name}"
-                        if description:
-                            image_text += f" ({description})"
-                        image_text += f" - URL: {url}"
-                        images_text.append(image_text)
-            
-            if images_text:
-                logger.info(f"ユーザー画像情報を取得: {len(images_text)}件")
-                return "\n".join(images_text)
-            else:
-                logger.info("有効な画像情報が見つかりません")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"ユーザー画像情報取得エラー: {e}")
+        if not (hasattr(ctx, "session") and hasattr(ctx.session, "state")):
+            logger.warning("セッション状態にアクセスできません")
             return ""
+        return get_user_images_info_from_state(ctx.session.state)
 
 
 def create_layout_agent() -> LayoutAgent:
@@ -4,10 +4,11 @@ LayoutAgent用 HTML配信ツール
 """
 import logging
 import os
+import sys
 from typing import Optional
 
 import httpx
-from google.adk.tools import FunctionTool
+from google.adk.tools import FunctionTool, ToolContext
 
 logger = logging.getLogger(__name__)
 
@@ -21,20 +22,24 @@ class DeliverHtmlTool:
         port = os.getenv("PORT", "8081")
         self.base_url = os.getenv("FASTAPI_BASE_URL", f"http://localhost:{port}")
         self.artifact_endpoint = f"{self.base_url}/api/v1/artifacts/html"
-
-        # 現在のセッションIDを保存するための変数
-        self._current_session_id: Optional[str] = None
-
-    def set_session_id(self, session_id: str):
-        """現在のセッションIDを設定"""
-        self._current_session_id = session_id
-        logger.info(f"DeliverHtmlTool: セッションID設定 - {session_id}")
+        # 配信方式: auto（同一プロセスなら直接、それ以外はHTTP） / inprocess / http
+        self.delivery_mode = os.getenv("ARTIFACT_DELIVERY_MODE", "auto").lower()
+        self._http_client: Optional[httpx.AsyncClient] = None
+
+    def _session_id_from_tool_context(self, tool_context: Optional[ToolContext]) -> Optional[str]:
+        """ToolContextから "user_id:session_id" 形式のセッションIDを取得"""
+        invocation_context = getattr(tool_context, "_invocation_context", None)
+        session = getattr(invocation_context, "session", None)
+        if session is not None and session.id and session.user_id:
+            return f"{session.user_id}:{session.id}"
+        return None
 
     async def deliver_html_to_frontend(
         self,
         html_content: str,
         artifact_type: str,
-        metadata_json: str
+        metadata_json: str,
+        tool_context: ToolContext = None,
     ) -> str:
         """
         HTMLコンテンツをフロントエンドに配信
@@ -47,7 +52,34 @@ class DeliverHtmlTool:
         Returns:
             配信結果のメッセージ
         """
-        if not self._current_session_id:
+        # JSON文字列をDictに変換
+        import json
+        try:
+            metadata = json.loads(metadata_json) if metadata_json.strip() else {}
+        except json.JSONDecodeError:
+            logger.warning(f"Invalid metadata JSON: {metadata_json}, using empty dict")
+            metadata = {}
+
+        return await self.deliver_html(
+            session_id=self._session_id_from_tool_context(tool_context),
+            html_content=html_content,
+            artifact_type=artifact_type,
+            metadata=metadata,
+        )
+
+    async def deliver_html(
+        self,
+        session_id: Optional[str],
+        html_content: str,
+        artifact_type: str = "newsletter",
+        metadata: Optional[dict] = None,
+    ) -> str:
+        """
+        指定セッションにHTMLコンテンツを配信（エージェントから直接呼び出す用）
+
+        セッションIDは呼び出しごとに受け取るため、複数セッションから同時に呼ばれても混ざらない。
+        """
+        if not session_id:
             error_msg = "❌ セッションIDが設定されていません。配信に失敗しました。"
             logger.error("DeliverHtmlTool: セッションIDが未設定")
             return error_msg
@@ -57,41 +89,83 @@ class DeliverHtmlTool:
             logger.warning("DeliverHtmlTool: 空のHTMLコンテンツ")
             return error_msg
 
+        artifact_manager = self._in_process_artifact_manager()
+        if artifact_manager is not None:
+            return await self._publish_in_process(artifact_manager, session_id, html_content, artifact_type, metadata)
+        return await self._post_over_http(session_id, html_content, artifact_type, metadata)
+
+    def _in_process_artifact_manager(self):
+        """
+        同一プロセス内で動作している場合はartifact_managerを返す
+
+        ARTIFACT_DELIVERY_MODE=auto（デフォルト）ではFastAPIアプリがartifact_managerを
+        読み込み済みかどうかで判定する（adk web等の別プロセス実行時はHTTPで配信）。
+        """
+        if self.delivery_mode == "http":
+            return None
+        module = sys.modules.get("app.core.artifact_manager")
+        if module is None and self.delivery_mode == "inprocess":
+            from app.core import artifact_manager as module
+        return getattr(module, "artifact_manager", None)
+
+    async def _publish_in_process(
+        self, artifact_manager, session_id: str, html_content: str, artifact_type: str, metadata: Optional[dict]
+    ) -> str:
+        """artifact_managerに直接保存・配信（シリアライズやHTTP往復なし）"""
+        try:
+            artifact = await artifact_manager.store_html_artifact(
+                session_id=session_id,
+                html_content=html_content,
+                artifact_type=artifact_type,
+                metadata=metadata or {},
+            )
+            logger.info(f"DeliverHtmlTool: HTML配信成功（プロセス内） - セッション:{session_id}, サイズ:{len(artifact.content)}文字")
+            return f"✅ 学級通信をプレビューに送信しました！({len(artifact.content)}文字)"
+        except Exception as e:
+            error_msg = f"❌ 予期しないエラーが発生しました: {str(e)}"
+            logger.error(f"DeliverHtmlTool: プロセス内配信エラー - {e}")
+            return error_msg
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """別プロセスへの配信用に接続を再利用するHTTPクライアント"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0, connect=2.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
+        return self._http_client
+
+    async def aclose(self):
+        """HTTPクライアントを閉じる（アプリ終了時）"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    async def _post_over_http(
+        self, session_id: str, html_content: str, artifact_type: str, metadata: Optional[dict]
+    ) -> str:
+        """FastAPIエンドポイントにHTMLを送信（エージェントが別プロセスで動作している場合）"""
         try:
-            # JSON文字列をDictに変換
-            import json
-            try:
-                metadata = json.loads(metadata_json) if metadata_json.strip() else {}
-            except json.JSONDecodeError:
-                logger.warning(f"Invalid metadata JSON: {metadata_json}, using empty dict")
-                metadata = {}
-
-            # FastAPI エンドポイントにHTMLを送信
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                payload = {
-                    "session_id": self._current_session_id,
-                    "html_content": html_content,
-                    "artifact_type": artifact_type,
-                    "metadata": metadata
-                }
-
-                logger.info(f"DeliverHtmlTool: HTML配信開始 - セッション:{self._current_session_id}, サイズ:{len(html_content)}文字")
-
-                response = await client.post(
-                    self.artifact_endpoint,
-                    json=payload,
-                    headers={"Content-Type": "application/json"}
-                )
-
-                if response.status_code == 200:
-                    result = response.json()
-                    success_msg = f"✅ 学級通信をプレビューに送信しました！({result.get('content_length', 0)}文字)"
-                    logger.info(f"DeliverHtmlTool: HTML配信成功 - セッション:{self._current_session_id}, サイズ:{result.get('content_length', 0)}文字")
-                    return success_msg
-                else:
-                    error_msg = f"❌ プレビュー送信でエラーが発生しました。(HTTP {response.status_code})"
-                    logger.error(f"DeliverHtmlTool: HTTP エラー - {response.status_code}: {response.text}")
-                    return error_msg
+            payload = {
+                "session_id": session_id,
+                "html_content": html_content,
+                "artifact_type": artifact_type,
+                "metadata": metadata or {}
+            }
+
+            logger.info(f"DeliverHtmlTool: HTML配信開始（HTTP） - セッション:{session_id}, サイズ:{len(html_content)}文字")
+
+            response = await self._get_http_client().post(self.artifact_endpoint, json=payload)
+
+            if response.status_code == 200:
+                result = response.json()
+                success_msg = f"✅ 学級通信をプレビューに送信しました！({result.get('content_length', 0)}文字)"
+                logger.info(f"DeliverHtmlTool: HTML配信成功 - セッション:{session_id}, サイズ:{result.get('content_length', 0)}文字")
+                return success_msg
+            else:
+                error_msg = f"❌ プレビュー送信でエラーが発生しました。(HTTP {response.status_code})"
+                logger.error(f"DeliverHtmlTool: HTTP エラー - {response.status_code}: {response.text}")
+                return error_msg
 
         except httpx.TimeoutException:
             error_msg = "❌ プレビュー送信がタイムアウトしました。ネットワークを確認してください。"
@@ -108,6 +182,23 @@ class DeliverHtmlTool:
             logger.error(f"DeliverHtmlTool: 予期しないエラー - {e}")
             return error_msg
 
+    async def deliver_html_delta(self, session_id: Optional[str], delta: str, seq: int) -> bool:
+        """
+        生成途中のHTML差分をプレビューに配信（ベストエフォート）
+
+        差分はプレビュー表示用のため、同一プロセス内のartifact_managerが使える場合のみ送信する。
+        """
+        if not session_id or not delta:
+            return False
+        try:
+            artifact_manager = self._in_process_artifact_manager()
+            if artifact_manager is None:
+                return False
+            return await artifact_manager.publish_html_delta(session_id, delta, seq)
+        except Exception as e:
+            logger.debug(f"DeliverHtmlTool: HTML差分配信をスキップ - {e}")
+            return False
+
     def create_adk_function_tool(self) -> FunctionTool:
         """ADK FunctionTool として使用可能な形式で返す"""
         return FunctionTool(func=self.deliver_html_to_frontend)
@@ -0,0 +1,105 @@
+"""
+LayoutAgent用 HTMLストリーム抽出
+LLMのストリーミング出力（トークン断片）から、HTML部分だけを逐次取り出す
+"""
+from typing import Optional
+
+# HTMLの開始を示すマーカー（```html フェンスはマーカー自体を含めない）
+_FENCE_MARKER = "```html"
+_DOCUMENT_MARKERS = ("<!DOCTYPE html", "<!doctype html", "<html")
+_DOCUMENT_END = "</html>"
+# マーカーが断片の境界で分割されても検出できるよう、再探索時に戻る文字数
+_MARKER_OVERLAP = 16
+
+
+class IncrementalHtmlExtractor:
+    """
+    ストリーム中のHTMLを逐次抽出するクラス
+
+    feed() に断片を渡すと、新たに確定したHTML部分（差分）を返す。
+    ```html フェンスまたは <!DOCTYPE / <html の出現から開始し、
+    閉じフェンスまたは </html> で完了する。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._start: Optional[int] = None
+        self._fenced = False
+        self._emitted = 0
+        self._scanned = 0
+        self.completed = False
+
+    @property
+    def started(self) -> bool:
+        return self._start is not None
+
+    @property
+    def html(self) -> str:
+        """これまでに抽出したHTML"""
+        if self._start is None:
+            return ""
+        return self._buffer[self._start:self._emitted]
+
+    def feed(self, chunk: str) -> str:
+        """断片を追加し、新たに確定したHTMLの差分を返す"""
+        if not chunk or self.completed:
+            return ""
+        self._buffer += chunk
+
+        if self._start is None and not self._find_start():
+            return ""
+
+        end = self._find_end()
+        if end is not None:
+            self.completed = True
+            limit = end
+        elif self._fenced:
+            # 閉じフェンスの途中かもしれない末尾のバッククォートは保留する
+            limit = len(self._buffer.rstrip("`"))
+        else:
+            limit = len(self._buffer)
+
+        if limit <= self._emitted:
+            return ""
+        delta = self._buffer[self._emitted:limit]
+        self._emitted = limit
+        return delta
+
+    def _find_start(self) -> bool:
+        scan_from = max(0, self._scanned - _MARKER_OVERLAP)
+        self._scanned = len(self._buffer)
+
+        candidates = []
+        fence_index = self._buffer.find(_FENCE_MARKER, scan_from)
+        if fence_index != -1:
+            candidates.append((fence_index, True))
+        for marker in _DOCUMENT_MARKERS:
+            index = self._buffer.find(marker, scan_from)
+            if index != -1:
+                candidates.append((index, False))
+        if not candidates:
+            return False
+
+        index, fenced = min(candidates)
+        if fenced:
+            # フェンス直後の改行が届くまで開始位置を確定しない
+            content_start = index + len(_FENCE_MARKER)
+            if content_start >= len(self._buffer):
+                self._scanned = index
+                return False
+            if self._buffer[content_start] == "\n":
+                content_start += 1
+            self._start = content_start
+        else:
+            self._start = index
+        self._fenced = fenced
+        self._emitted = self._start
+        return True
+
+    def _find_end(self) -> Optional[int]:
+        search_from = max(self._start, self._emitted - len(_DOCUMENT_END))
+        if self._fenced:
+            index = self._buffer.find("```", search_from)
+            return index if index != -1 else None
+        index = self._buffer.find(_DOCUMENT_END, search_from)
+        return index + len(_DOCUMENT_END) if index != -1 else None
@@ -0,0 +1,168 @@
+"""
+LayoutAgent用 レスポンスキャッシュ
+同じユーザーの、同じ基本情報・ほぼ同じ内容の依頼に対して、生成済みHTMLを再利用してLLM呼び出しを省略する
+
+- 完全一致層: 正規化したプロンプト（ユーザー・基本情報・内容・画像リストのハッシュ）で検索
+- 類似度層（任意）: 同じユーザー・基本情報の中で、内容の埋め込みベクトルのコサイン類似度がしきい値以上なら再利用
+- 内容には構成案（なければ会話全体）を渡す。「作成してください」のような最新の発言だけではキーにしない
+- 学級通信には児童の名前や写真が含まれうるため、他のユーザーの生成結果は返さない
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+# テキスト -> 疎ベクトル（特徴量 -> 重み）
+EmbeddingFunction = Callable[[str], Dict[str, float]]
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角や空白の揺れを吸収した比較用テキスト"""
+    normalized = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", normalized).strip().lower()
+
+
+def char_ngram_embedding(text: str, n: int = 2) -> Dict[str, float]:
+    """文字n-gramの出現頻度による軽量な埋め込み（外部APIを使わないデフォルト実装）"""
+    normalized = normalize_text(text)
+    return dict(Counter(normalized[i:i + n] for i in range(max(0, len(normalized) - n + 1))))
+
+
+def cosine_similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if not a or not b:
+        return 0.0
+    dot = sum(weight * b.get(feature, 0.0) for feature, weight in a.items())
+    norm = math.sqrt(sum(w * w for w in a.values())) * math.sqrt(sum(w * w for w in b.values()))
+    return dot / norm if norm else 0.0
+
+
+@dataclass
+class CacheEntry:
+    html: str
+    created_at: float
+    basic_key: str
+    embedding: Optional[Dict[str, float]] = None
+
+
+@dataclass
+class CacheHit:
+    html: str
+    tier: str  # "exact" または "similar"
+    similarity: float = 1.0
+
+
+class LayoutResponseCache:
+    """生成済み学級通信HTMLのキャッシュ"""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: int = DEFAULT_TTL_SECONDS,
+        similarity_threshold: float = 0.0,
+        embedding_function: Optional[EmbeddingFunction] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # 0以下なら類似度層は無効
+        self.similarity_threshold = similarity_threshold
+        self.embedding_function = embedding_function or char_ngram_embedding
+
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def similarity_enabled(self) -> bool:
+        return self.similarity_threshold > 0
+
+    def make_keys(
+        self, user_id: str, basic_info: Dict[str, str], content: str, images_info: str
+    ) -> Tuple[str, str]:
+        """
+        キャッシュキーを生成
+
+        Returns:
+            (完全一致キー, ユーザー+基本情報+画像キー)。類似度検索は後者が一致するエントリに限定する。
+        """
+        basic = json.dumps(
+            {k: normalize_text(str(v)) for k, v in sorted(basic_info.items())}, ensure_ascii=False
+        )
+        images_hash = hashlib.sha256(normalize_text(images_info).encode("utf-8")).hexdigest()[:16]
+        basic_key = hashlib.sha256(f"{user_id}|{basic}|{images_hash}".encode("utf-8")).hexdigest()
+        exact_key = hashlib.sha256(f"{basic_key}|{normalize_text(content)}".encode("utf-8")).hexdigest()
+        return exact_key, basic_key
+
+    def _is_expired(self, entry: CacheEntry) -> bool:
+        return entry.created_at + self.ttl_seconds < time.time()
+
+    def get(self, user_id: str, basic_info: Dict[str, str], content: str, images_info: str) -> Optional[CacheHit]:
+        exact_key, basic_key = self.make_keys(user_id, basic_info, content, images_info)
+
+        entry = self._entries.get(exact_key)
+        if entry is not None and not self._is_expired(entry):
+            self._entries.move_to_end(exact_key)
+            self.stats["exact_hits"] += 1
+            return CacheHit(html=entry.html, tier="exact")
+        if entry is not None:
+            del self._entries[exact_key]
+
+        if self.similarity_enabled:
+            hit = self._find_similar(basic_key, content)
+            if hit is not None:
+                self.stats["similar_hits"] += 1
+                return hit
+
+        self.stats["misses"] += 1
+        return None
+
+    def _find_similar(self, basic_key: str, content: str) -> Optional[CacheHit]:
+        query = self.embedding_function(content)
+        best_key, best_score = None, 0.0
+        for key, entry in self._entries.items():
+            if entry.basic_key != basic_key or entry.embedding is None or self._is_expired(entry):
+                continue
+            score = cosine_similarity(query, entry.embedding)
+            if score > best_score:
+                best_key, best_score = key, score
+        if best_key is None or best_score < self.similarity_threshold:
+            return None
+        self._entries.move_to_end(best_key)
+        return CacheHit(html=self._entries[best_key].html, tier="similar", similarity=round(best_score, 4))
+
+    def put(self, user_id: str, basic_info: Dict[str, str], content: str, images_info: str, html: str) -> None:
+        if not html:
+            return
+        exact_key, basic_key = self.make_keys(user_id, basic_info, content, images_info)
+        self._entries[exact_key] = CacheEntry(
+            html=html,
+            created_at=time.time(),
+            basic_key=basic_key,
+            embedding=self.embedding_function(content) if self.similarity_enabled else None,
+        )
+        self._entries.move_to_end(exact_key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), **self.stats}
+
+
+# グローバルインスタンス（LayoutAgentで使用）
+layout_response_cache = LayoutResponseCache(
+    max_entries=int(os.getenv("LAYOUT_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+    ttl_seconds=int(os.getenv("LAYOUT_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+    similarity_threshold=float(os.getenv("LAYOUT_CACHE_SIMILARITY_THRESHOLD", "0")),
+)
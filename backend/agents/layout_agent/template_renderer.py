@@ -0,0 +1,256 @@
+"""
+LayoutAgent用 テンプレートレンダラー
+検証済みの構成案（outline）から、LLMを使わずに学級通信HTMLを生成する高速パス
+
+テンプレートはモジュール読み込み時に一度だけ構築し、
+配色・レイアウトごとのスタイルシートはキャッシュして再利用する。
+"""
+import html
+import json
+import logging
+import re
+from functools import lru_cache
+from string import Template
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COLOR_SCHEME = {
+    "primary": "#FFFF99",
+    "secondary": "#FFCC99",
+    "accent": "#FF9966",
+}
+SUPPORTED_LAYOUTS = ("single", "two_column")
+
+# カスタムデザインを求めていると判断するキーワード（該当時はLLMで生成する）
+CUSTOM_DESIGN_KEYWORDS = (
+    "デザイン",
+    "カスタム",
+    "おしゃれ",
+    "オシャレ",
+    "レイアウトを変",
+    "自由に",
+    "凝った",
+    "雰囲気を変",
+)
+
+_HEX_COLOR = re.compile(r"^#[0-9A-Fa-f]{3,8}$")
+
+_DOCUMENT_TEMPLATE = Template("""<!DOCTYPE html>
+<html lang="ja">
+<head>
+  <meta charset="UTF-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1.0">
+  <title>$title</title>
+  <style>
+$styles
+  </style>
+</head>
+<body>
+  <div class="container">
+    <div class="header">
+      <h1>$school_name $grade</h1>
+      <p>$issue - $issue_date</p>
+      <p>発行者: $author</p>
+    </div>
+    <div class="main-content">
+      <h2 class="main-title">$main_title</h2>
+      <div class="sections">
+$sections
+      </div>
+    </div>
+    <div class="footer">
+      <p>$school_name $grade</p>
+    </div>
+  </div>
+</body>
+</html>""")
+
+_SECTION_TEMPLATE = Template("""        <section class="section">
+$heading$paragraphs
+        </section>""")
+
+_STYLE_TEMPLATE = Template("""    @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;500;700&display=swap');
+
+    body {
+      font-family: 'Noto Sans JP', 'Hiragino Kaku Gothic ProN', 'Hiragino Sans', 'Yu Gothic', 'Meiryo', sans-serif;
+      margin: 0;
+      padding: 20px;
+      background-color: #ffffff;
+      color: #333333;
+      line-height: 1.6;
+      -webkit-font-smoothing: antialiased;
+    }
+    .container {
+      max-width: 800px;
+      margin: 0 auto;
+      background: white;
+      border-radius: 8px;
+      overflow: hidden;
+      box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+    }
+    .header {
+      background-color: $primary;
+      padding: 20px;
+      text-align: center;
+      border-bottom: 3px solid $accent;
+    }
+    .header h1 {
+      margin: 0;
+      font-size: 24px;
+      font-weight: 500;
+    }
+    .header p {
+      margin: 10px 0 0 0;
+    }
+    .main-content {
+      padding: 30px;
+    }
+    .main-title {
+      color: $accent;
+      border-left: 4px solid $secondary;
+      padding-left: 15px;
+      margin-bottom: 20px;
+      font-weight: 500;
+    }
+    .section h3 {
+      color: $accent;
+      border-bottom: 1px dashed $secondary;
+      padding-bottom: 4px;
+    }
+$layout_styles
+    .footer {
+      background-color: $secondary;
+      padding: 15px;
+      text-align: center;
+    }
+    @media print {
+      body { margin: 0; }
+      .container { box-shadow: none; }
+    }""")
+
+_LAYOUT_STYLES = {
+    "single": "",
+    "two_column": """    .sections {
+      column-count: 2;
+      column-gap: 30px;
+    }
+    .section {
+      break-inside: avoid;
+    }
+    @media (max-width: 768px) {
+      .sections { column-count: 1; }
+    }""",
+}
+
+
+def wants_custom_design(message: str) -> bool:
+    """ユーザーのメッセージがカスタムデザインを求めているか判定"""
+    return any(keyword in (message or "") for keyword in CUSTOM_DESIGN_KEYWORDS)
+
+
+def parse_outline(raw_outline: Any) -> Optional[Dict[str, Any]]:
+    """セッション状態のoutline（文字列・```jsonフェンス付き・dict）を辞書に変換"""
+    if isinstance(raw_outline, dict):
+        return raw_outline
+    if not isinstance(raw_outline, str) or not raw_outline.strip():
+        return None
+
+    text = raw_outline.strip()
+    fence = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fence:
+        text = fence.group(1).strip()
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _color(value: Any, default: str) -> str:
+    return value if isinstance(value, str) and _HEX_COLOR.match(value) else default
+
+
+def validate_outline(outline: Optional[Dict[str, Any]], basic_info: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """
+    構成案を検証し、テンプレートで使う形に正規化
+
+    Args:
+        outline: 構成案（フラット形式またはnewsletter_info形式）
+        basic_info: セッション状態の基本情報（構成案に無い項目の補完に使用）
+
+    Returns:
+        正規化した構成案。テンプレート生成に足りない場合はNone
+    """
+    if not outline:
+        return None
+
+    info = outline.get("newsletter_info") if isinstance(outline.get("newsletter_info"), dict) else outline
+    author = outline.get("author") if isinstance(outline.get("author"), dict) else {}
+
+    sections: List[Dict[str, str]] = []
+    for section in outline.get("sections") or []:
+        if not isinstance(section, dict):
+            continue
+        content = str(section.get("content") or "").strip()
+        if content:
+            sections.append({"title": str(section.get("title") or "").strip(), "content": content})
+    if not sections:
+        return None
+
+    color_scheme = outline.get("color_scheme") if isinstance(outline.get("color_scheme"), dict) else {}
+    layout = outline.get("layout") if outline.get("layout") in SUPPORTED_LAYOUTS else (
+        "two_column" if len(sections) >= 4 else "single"
+    )
+
+    return {
+        "school_name": info.get("school_name") or basic_info["school_name"],
+        "grade": info.get("grade") or info.get("class_name") or basic_info["class_name"],
+        "author": " ".join(
+            filter(None, [author.get("title"), author.get("name") or info.get("teacher_name") or basic_info["teacher_name"]])
+        ),
+        "issue": outline.get("issue") or "学級通信",
+        "issue_date": outline.get("issue_date") or basic_info["current_date"],
+        "main_title": outline.get("main_title") or info.get("title") or "学級通信",
+        "sections": sections,
+        "colors": tuple(
+            _color(color_scheme.get(name), DEFAULT_COLOR_SCHEME[name])
+            for name in ("primary", "secondary", "accent")
+        ),
+        "layout": layout,
+    }
+
+
+@lru_cache(maxsize=64)
+def _render_styles(primary: str, secondary: str, accent: str, layout: str) -> str:
+    """配色・レイアウトごとのスタイルシート（キャッシュ済み）"""
+    return _STYLE_TEMPLATE.substitute(
+        primary=primary,
+        secondary=secondary,
+        accent=accent,
+        layout_styles=_LAYOUT_STYLES[layout],
+    )
+
+
+def _render_section(section: Dict[str, str]) -> str:
+    heading = f"          <h3>{html.escape(section['title'])}</h3>\n" if section["title"] else ""
+    paragraphs = "\n".join(
+        f"          <p>{html.escape(line.strip())}</p>"
+        for line in section["content"].split("\n")
+        if line.strip()
+    )
+    return _SECTION_TEMPLATE.substitute(heading=heading, paragraphs=paragraphs)
+
+
+def render_newsletter_html(outline: Dict[str, Any]) -> str:
+    """正規化済みの構成案から学級通信HTMLを生成"""
+    escaped = {
+        key: html.escape(str(outline[key]))
+        for key in ("school_name", "grade", "author", "issue", "issue_date", "main_title")
+    }
+    return _DOCUMENT_TEMPLATE.substitute(
+        title=f"{escaped['school_name']} {escaped['grade']} {escaped['issue']}",
+        styles=_render_styles(*outline["colors"], outline["layout"]),
+        sections="\n".join(_render_section(section) for section in outline["sections"]),
+        **escaped,
+    )
@@ -6,23 +6,38 @@ from typing import AsyncGenerator, Optional
 
 from google.adk.agents import LlmAgent
 from google.adk.agents.invocation_context import InvocationContext
+from google.adk.agents.readonly_context import ReadonlyContext
 from google.adk.events.event import Event
-from google.adk.models.google_llm import Gemini
 from google.adk.tools import FunctionTool, ToolContext
 from google.genai.types import Content, Part
 
-from services.user_settings_service import UserSettingsService
+from services.user_settings_service import settings_version, user_settings_service
+from services.storage import list_user_images
 from agents.shared.file_utils import (
     save_user_outline, 
     get_user_id_from_session,
     get_user_artifacts_dir
 )
+from agents.shared.history_compaction import (
+    compact_history_before_model,
+    record_token_usage_after_model,
+)
+from agents.shared.preflight import PreflightStep, run_preflight
+from agents.shared.llm_limiter import LimitedGemini
+from agents.shared.model_router import (
+    PRO_MODEL,
+    record_model_route_after_model,
+    route_model_before_model,
+)
 
 from .prompt import MAIN_CONVERSATION_INSTRUCTION
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
+# プロンプトに含めるユーザー辞書の登録語の上限
+MAX_DICTIONARY_TERMS_IN_PROMPT = 30
+
 # セッション状態からユーザーIDを取得するためのコンテキスト管理
 # グローバル変数は廃止し、ADK ToolContextを活用
 _current_tool_context = None
@@ -66,10 +81,8 @@ async def get_user_settings_context(tool_context: ToolContext = None) -> str:
     try:
         # ToolContextのセッション状態からユーザーIDを取得
         actual_user_id = None
-        if (tool_context and 
-            hasattr(tool_context, 'session') and 
-            hasattr(tool_context.session, 'state')):
-            actual_user_id = tool_context.session.state.get('user_id')
+        if tool_context and hasattr(tool_context, 'state'):
+            actual_user_id = tool_context.state.get('user_id')
             logger.info(f"ToolContextからユーザーID取得: {actual_user_id}")
         else:
             # フォールバック: グローバルなToolContextから取得
@@ -88,9 +101,8 @@ async def get_user_settings_context(tool_context: ToolContext = None) -> str:
         
         logger.info(f"ユーザー設定を取得中: user_id={actual_user_id}")
 
-        # UserSettingsServiceを使用してユーザー設定を取得
-        service = UserSettingsService()
-        settings = await service.get_user_settings(actual_user_id)
+        # ユーザー設定を取得（user_idごとのキャッシュ経由）
+        settings = await user_settings_service.get_cached_user_settings(actual_user_id)
 
         if settings:
             context_info = {
@@ -174,6 +186,55 @@ def save_json_to_session(json_data: str, tool_context: ToolContext = None) -> st
         return f"❌ 保存中にエラーが発生しました: {str(e)}"
 
 
+async def _load_user_dictionary_terms(user_id: str) -> list:
+    """ユーザー辞書の登録語を取得（プロンプトで表記を揃えるために使用）"""
+    from app.user_dictionary import get_user_custom_dictionary
+
+    custom_terms = await get_user_custom_dictionary(user_id, raise_on_error=True)
+    return sorted(custom_terms)[:MAX_DICTIONARY_TERMS_IN_PROMPT]
+
+
+def build_session_context_block(state) -> str:
+    """セッション状態からプロンプトに追加するセッション情報ブロックを生成"""
+    current_date = state.get("current_date", "2025-06-30")
+    school_name = state.get("school_name", "○○小学校")
+    class_name = state.get("class_name", "3年2組")
+    teacher_name = state.get("teacher_name", "田中先生")
+    settings_complete = state.get("settings_complete", False)
+    dictionary_terms = state.get("user_dictionary_terms") or []
+    dictionary_line = f"\n📖 登録済みの用語（この表記を使用）: {'、'.join(dictionary_terms)}" if dictionary_terms else ""
+
+    return f"""
+
+=== 現在のセッション情報 ===
+📅 今日の日付: {current_date}
+🏫 学校名: {school_name}
+📚 クラス名: {class_name}
+👨‍🏫 担任の先生: {teacher_name}
+⚙️ 設定状況: {'完了' if settings_complete else '未完了'}{dictionary_line}
+
+**重要指示**: 
+- 上記の情報を必ず使用して応答してください
+- 「今日は何日でしょうか？」などの質問は不要です
+- 設定が完了している場合は具体的な情報を使用してください
+- 設定が未完了の場合のみ、設定画面での登録を案内してください
+
+"""
+
+
+def build_main_instruction(context: ReadonlyContext) -> str:
+    """
+    ADK InstructionProvider: 呼び出しごとにセッション状態からプロンプトを組み立てる
+
+    エージェントはプロセス全体で共有されるため、self.instructionは書き換えない。
+    """
+    try:
+        return MAIN_CONVERSATION_INSTRUCTION + build_session_context_block(context.state)
+    except Exception as e:
+        logger.error(f"プロンプト構築エラー: {e}")
+        return MAIN_CONVERSATION_INSTRUCTION
+
+
 class MainConversationAgent(LlmAgent):
     """
     メインの対話エージェント。
@@ -189,8 +250,9 @@ class MainConversationAgent(LlmAgent):
         project_id = os.environ.get("GCP_PROJECT_ID")
         location = os.environ.get("GCP_REGION")
 
+        # 既定はproモデル。呼び出しごとのモデルはroute_model_before_modelが決める
         model_config = {
-            "model_name": "gemini-2.5-pro",
+            "model": PRO_MODEL,
         }
 
         # google-genaiがVertex AIを使うための設定
@@ -218,8 +280,8 @@ class MainConversationAgent(LlmAgent):
 
         super().__init__(
             name="main_conversation_agent",
-            model=Gemini(**model_config),
-            instruction=MAIN_CONVERSATION_INSTRUCTION,
+            model=LimitedGemini(**model_config),
+            instruction=build_main_instruction,
             description="先生方との自然な対話を通じて学級通信の基本情報（学校名、クラス、内容等）を収集し、必要に応じて専門エージェントに委譲する対話管理エージェントです。",
             tools=[
                 FunctionTool(get_current_date),
@@ -227,6 +289,8 @@ class MainConversationAgent(LlmAgent):
             ],
             sub_agents=[layout_agent],  # ADK Auto-Flow対応
             output_key="outline",  # ADK標準のoutput_key機能
+            before_model_callback=[compact_history_before_model, route_model_before_model],
+            after_model_callback=[record_token_usage_after_model, record_model_route_after_model],
         )
 
     async def _run_async_impl(
@@ -242,11 +306,10 @@ class MainConversationAgent(LlmAgent):
             # ユーザー設定の初期取得
             await self._initialize_user_context(ctx)
 
-            # 基本情報をセッション状態に保存
-            await self._save_basic_info_to_session(ctx)
+            # 設定・辞書・画像を並列に取得し、基本情報をセッション状態に保存
+            await self._run_preflight(ctx)
 
-            # プロンプトにセッション状態の情報を動的に追加
-            await self._enhance_prompt_with_session_context(ctx)
+            # セッション状態の情報はbuild_main_instructionで呼び出しごとにプロンプトへ反映される
 
             # ADK標準の親エージェント実行（transfer_to_agentで自動委譲）
             async for event in super()._run_async_impl(ctx):
@@ -298,118 +361,75 @@ class MainConversationAgent(LlmAgent):
             import traceback
             logger.error(f"詳細エラー: {traceback.format_exc()}")
 
-    async def _save_basic_info_to_session(self, ctx: InvocationContext):
-        """基本情報をセッション状態に保存（LayoutAgentで使用）"""
-        try:
-            logger.info("基本情報をセッション状態に保存中...")
-            
-            # ツールを手動実行してデータを取得
-            logger.info("🔧 手動でツールを実行してデータを取得中...")
-            
-            # 1. 現在の日付を取得
-            current_date = get_current_date()
-            logger.info(f"📅 現在の日付取得: {current_date}")
-            
-            # 2. ユーザー設定を取得（セッション状態ベース）
-            user_settings = {}
-            try:
-                # セッション状態から直接ユーザーIDを取得してToolContextを構築
-                if hasattr(ctx, "session"):
-                    # ダミーのToolContextを作成してセッション情報を渡す
-                    class DummyToolContext:
-                        def __init__(self, session):
-                            self.session = session
-                    
-                    dummy_tool_context = DummyToolContext(ctx.session)
-                    user_settings_json = await get_user_settings_context(dummy_tool_context)
-                    if user_settings_json:
-                        import json
-                        user_settings = json.loads(user_settings_json)
-                        logger.info(f"👤 ユーザー設定取得: {user_settings.get('学校名', '未設定')} {user_settings.get('クラス名', '未設定')}")
-            except Exception as e:
-                logger.error(f"ユーザー設定取得エラー: {e}")
-            
-            # セッション状態に基本情報を保存
-            if hasattr(ctx, "session") and hasattr(ctx.session, "state"):
-                # 日付情報を保存
-                ctx.session.state["current_date"] = current_date
-                ctx.session.state["tool_date_retrieved"] = current_date
-                
-                # ユーザー設定を保存
-                ctx.session.state["school_name"] = user_settings.get("学校名", "○○小学校")
-                ctx.session.state["class_name"] = user_settings.get("クラス名", "3年2組") 
-                ctx.session.state["teacher_name"] = user_settings.get("先生名", "田中先生")
-                ctx.session.state["settings_complete"] = user_settings.get("設定完了", False)
-                
-                # エージェントの応答用コンテキストを保存
-                response_context = f"""
-今日の日付: {current_date}
-学校名: {ctx.session.state['school_name']}
-クラス名: {ctx.session.state['class_name']}
-担任の先生: {ctx.session.state['teacher_name']}
-設定状況: {'完了' if ctx.session.state['settings_complete'] else '未完了'}
-"""
-                ctx.session.state["response_context"] = response_context
-                
-                logger.info(f"✅ 基本情報保存完了: {ctx.session.state['school_name']} {ctx.session.state['class_name']} {ctx.session.state['teacher_name']} (日付: {current_date})")
-            else:
-                logger.error("セッション状態にアクセスできません")
-                
-        except Exception as e:
-            logger.error(f"基本情報保存エラー: {e}")
-            import traceback
-            logger.error(f"詳細エラー: {traceback.format_exc()}")
-
-    async def _enhance_prompt_with_session_context(self, ctx: InvocationContext):
-        """セッション状態の情報をプロンプトに動的に追加"""
+    async def _run_preflight(self, ctx: InvocationContext):
+        """LLM呼び出し前に必要な情報を並列に取得してセッション状態に反映"""
         try:
-            logger.info("📝 プロンプトにセッション状態情報を追加中...")
-            
             if not hasattr(ctx, "session") or not hasattr(ctx.session, "state"):
                 logger.error("セッション状態にアクセスできません")
                 return
-            
             state = ctx.session.state
-            
-            # セッション状態から情報を取得
-            current_date = state.get("current_date", "2025-06-30")
-            school_name = state.get("school_name", "○○小学校")
-            class_name = state.get("class_name", "3年2組")
-            teacher_name = state.get("teacher_name", "田中先生")
-            settings_complete = state.get("settings_complete", False)
-            
-            # 動的なコンテキスト情報を作成
-            context_info = f"""
-
-=== 現在のセッション情報 ===
-📅 今日の日付: {current_date}
-🏫 学校名: {school_name}
-📚 クラス名: {class_name}
-👨‍🏫 担任の先生: {teacher_name}
-⚙️ 設定状況: {'完了' if settings_complete else '未完了'}
+            user_id = state.get("user_id")
+            if not user_id:
+                self._apply_basic_info(state, None)
+                return
 
-**重要指示**: 
-- 上記の情報を必ず使用して応答してください
-- 「今日は何日でしょうか？」などの質問は不要です
-- 設定が完了している場合は具体的な情報を使用してください
-- 設定が未完了の場合のみ、設定画面での登録を案内してください
+            # 画像はこのチャットセッションにアップロードされたもの（/upload/images の session_id）のみ毎ターン取得する
+            session_id = ctx.session.id
+            steps = [
+                PreflightStep("settings", lambda: user_settings_service.get_cached_user_settings(user_id)),
+                PreflightStep("dictionary", lambda: _load_user_dictionary_terms(user_id), default=[]),
+                PreflightStep("images", lambda: list_user_images(session_id), default=[]),
+            ]
+
+            results, timings = await run_preflight(steps)
+
+            # 期限切れ・失敗したステップの結果（デフォルト値）ではセッション状態を上書きしない
+            succeeded = {name for name, timing in timings.items() if timing["status"] == "ok"}
+            if "settings" in succeeded:
+                self._apply_basic_info(state, results["settings"])
+            # 登録語が0件になった場合も反映する（削除した用語がプロンプトに残らないように）
+            if "dictionary" in succeeded and state.get("user_dictionary_terms") != results["dictionary"]:
+                state["user_dictionary_terms"] = results["dictionary"]
+            if "images" in succeeded and state.get("uploaded_images") != results["images"]:
+                state["uploaded_images"] = results["images"]
+            state["temp:preflight_timings"] = timings
 
-"""
-            
-            # 既存のプロンプトに動的情報を追加
-            original_instruction = self.instruction
-            enhanced_instruction = original_instruction + context_info
-            
-            # プロンプトを一時的に更新
-            self.instruction = enhanced_instruction
-            
-            logger.info(f"✅ プロンプト拡張完了: 日付={current_date}, 学校={school_name}, クラス={class_name}, 先生={teacher_name}")
-            
         except Exception as e:
-            logger.error(f"プロンプト拡張エラー: {e}")
+            logger.error(f"プリフライトエラー: {e}")
             import traceback
             logger.error(f"詳細エラー: {traceback.format_exc()}")
 
+    def _apply_basic_info(self, state, settings):
+        """日付とユーザー設定をセッション状態に反映（変更がなければ何もしない）"""
+        current_date = get_current_date()
+
+        # 設定のバージョンと日付が変わっていなければセッション状態の更新を省略する
+        version = settings_version(settings)
+        if state.get("user_settings_version") == version and state.get("current_date") == current_date:
+            logger.info(f"ユーザー設定に変更なし（version={version}）: セッション状態の更新をスキップ")
+            return
+
+        state["current_date"] = current_date
+        state["tool_date_retrieved"] = current_date
+        state["school_name"] = (settings.school_name if settings else None) or "○○小学校"
+        state["class_name"] = (settings.class_name if settings else None) or "3年2組"
+        state["teacher_name"] = (settings.teacher_name if settings else None) or "田中先生"
+        state["settings_complete"] = bool(
+            settings and settings.school_name and settings.class_name and settings.teacher_name
+        )
+        state["user_settings_version"] = version
+
+        # エージェントの応答用コンテキストを保存
+        state["response_context"] = f"""
+今日の日付: {current_date}
+学校名: {state['school_name']}
+クラス名: {state['class_name']}
+担任の先生: {state['teacher_name']}
+設定状況: {'完了' if state['settings_complete'] else '未完了'}
+"""
+
+        logger.info(f"✅ 基本情報保存完了: {state['school_name']} {state['class_name']} {state['teacher_name']} (日付: {current_date}, version={version})")
+
 def create_main_conversation_agent() -> MainConversationAgent:
     """MainConversationAgentのインスタンスを生成するファクトリ関数。"""
     return MainConversationAgent()
@@ -0,0 +1,169 @@
+"""
+LLM呼び出し前の会話履歴圧縮
+ADKのbefore_model_callback / after_model_callbackとして各エージェントに登録し、
+過去に生成したHTMLの短い参照への置き換えと、古い対話の要約を行う
+"""
+import hashlib
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai.types import Content, Part
+
+logger = logging.getLogger(__name__)
+
+# 圧縮せずにそのまま送る直近の履歴数
+KEEP_RECENT_CONTENTS = 4
+# 履歴の推定トークン数がこれを超えたら古い対話を要約する
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
+# 要約に残す1発言あたりの文字数
+SUMMARY_CHARS_PER_TURN = 120
+
+_HTML_MARKERS = ("```html", "<!DOCTYPE html", "<!doctype html", "<html")
+
+# プロセス全体のトークン使用量（/metrics 用）
+token_usage_stats: Dict[str, int] = {
+    "model_calls": 0,
+    "prompt_tokens": 0,
+    "output_tokens": 0,
+    "compacted_html_parts": 0,
+    "summarized_contents": 0,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのおおよそのトークン数を推定
+
+    日本語は1文字あたり約1トークン、ASCIIは約4文字で1トークンとして概算する。
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+def _content_text(content: Content) -> str:
+    return "".join(part.text for part in (content.parts or []) if part.text)
+
+
+def _estimate_contents_tokens(contents: List[Content]) -> int:
+    return sum(estimate_tokens(_content_text(content)) for content in contents)
+
+
+def _is_html(text: str) -> bool:
+    return any(marker in text for marker in _HTML_MARKERS)
+
+
+def _html_reference(text: str) -> str:
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+    # モデルはセッション状態を読めないため、省略したことだけを伝える
+    return f"[生成済みHTML {len(text)}文字 (id: {digest}) - 履歴からは省略。内容が必要な場合は作り直す]"
+
+
+def _replace_html_parts(content: Content) -> Content:
+    """テキスト中のHTMLを参照文字列に置き換えたContentを返す"""
+    parts = []
+    changed = False
+    for part in content.parts or []:
+        if part.text and _is_html(part.text):
+            parts.append(Part(text=_html_reference(part.text)))
+            token_usage_stats["compacted_html_parts"] += 1
+            changed = True
+        else:
+            parts.append(part)
+    return Content(role=content.role, parts=parts) if changed else content
+
+
+def _has_function_response(content: Content) -> bool:
+    return any(part.function_response for part in (content.parts or []))
+
+
+def _summarize_contents(contents: List[Content]) -> Content:
+    """古い対話を発言ごとの先頭部分だけに縮めた要約にまとめる"""
+    lines = []
+    for content in contents:
+        text = _content_text(content).strip().replace("\n", " ")
+        if not text:
+            continue
+        speaker = "先生" if content.role == "user" else "アシスタント"
+        if len(text) > SUMMARY_CHARS_PER_TURN:
+            text = text[:SUMMARY_CHARS_PER_TURN] + "…"
+        lines.append(f"- {speaker}: {text}")
+    summary = "\n".join(lines) if lines else "（要約対象の発言なし）"
+    return Content(role="user", parts=[Part(text=f"【これまでの会話の要約】\n{summary}")])
+
+
+def compact_contents(contents: List[Content], token_budget: int = HISTORY_TOKEN_BUDGET) -> List[Content]:
+    """
+    LLMに送る履歴を圧縮
+
+    Args:
+        contents: LlmRequestの履歴
+        token_budget: 推定トークン数の上限
+
+    Returns:
+        圧縮後の履歴（直近KEEP_RECENT_CONTENTS件はそのまま）
+    """
+    if len(contents) <= KEEP_RECENT_CONTENTS:
+        return contents
+
+    split = len(contents) - KEEP_RECENT_CONTENTS
+    older = [_replace_html_parts(content) for content in contents[:split]]
+    recent = list(contents[split:])
+
+    if _estimate_contents_tokens(older + recent) <= token_budget:
+        return older + recent
+
+    # 関数呼び出しと応答の組を分断しないよう、応答で始まる位置は要約側に含める
+    while recent and _has_function_response(recent[0]):
+        older.append(recent.pop(0))
+    if not older:
+        return recent
+
+    token_usage_stats["summarized_contents"] += len(older)
+    return [_summarize_contents(older)] + recent
+
+
+def compact_history_before_model(
+    callback_context: CallbackContext, llm_request: LlmRequest
+) -> Optional[LlmResponse]:
+    """before_model_callback: 履歴を圧縮してからLLMを呼び出す"""
+    try:
+        before_tokens = _estimate_contents_tokens(llm_request.contents)
+        llm_request.contents = compact_contents(llm_request.contents)
+        after_tokens = _estimate_contents_tokens(llm_request.contents)
+        if after_tokens < before_tokens:
+            logger.info(
+                f"履歴圧縮: {callback_context.agent_name} 推定トークン {before_tokens} -> {after_tokens}"
+            )
+    except Exception as e:
+        # 圧縮に失敗しても元の履歴でLLM呼び出しを継続する
+        logger.error(f"履歴圧縮エラー: {e}")
+    return None
+
+
+def record_token_usage_after_model(
+    callback_context: CallbackContext, llm_response: LlmResponse
+) -> Optional[LlmResponse]:
+    """after_model_callback: ターンごとのトークン使用量を記録"""
+    usage = llm_response.usage_metadata
+    if not usage or llm_response.partial:
+        return None
+
+    prompt_tokens = usage.prompt_token_count or 0
+    output_tokens = usage.candidates_token_count or 0
+    token_usage_stats["model_calls"] += 1
+    token_usage_stats["prompt_tokens"] += prompt_tokens
+    token_usage_stats["output_tokens"] += output_tokens
+
+    usage_info: Dict[str, Any] = {
+        "agent": callback_context.agent_name,
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": usage.total_token_count or 0,
+    }
+    callback_context.state["last_token_usage"] = usage_info
+    logger.info(f"トークン使用量: {usage_info}")
+    return None
@@ -0,0 +1,243 @@
+"""
+LLM呼び出しの同時実行数制限（インスタンス全体）
+アクセスが集中したときに全リクエストが一斉にGeminiを呼び出してクォータエラーで一緒に失敗しないよう、
+モデル呼び出しをインスタンス全体で制限し、あふれた分は優先度順に待たせる
+
+- 同時実行数（LLM_MAX_CONCURRENCY）とトークンバケット（LLM_REQUESTS_PER_MINUTE、モデルのクォータに合わせる）で制限する
+- 優先度: interactive（チャット）> batch（バックグラウンドジョブ）。llm_priority コンテキスト変数で指定する
+- 待ち行列が LLM_MAX_QUEUE 件以上のとき、対話リクエストはすぐにLlmOverloadedErrorで断る（API側で503 + Retry-After）
+- 待ち時間を優先度ごとに記録する
+- 枠はモデルのストリームが開いている間保持する。関数呼び出しやターンの終わりの応答が来たら、
+  残りを読み切ってストリームを閉じ、枠を返却してから呼び出し元に返す
+  （ADKはその応答を受け取った時点で関数やtransfer_to_agentのサブエージェントを実行するため、
+  保持したままだと親子のエージェントで枠を2つ使い、同時実行数分の委譲が重なると全体が止まる）
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from contextlib import aclosing, asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from google.adk.models.google_llm import Gemini
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import types as genai_types
+
+from agents.shared.model_resilience import remaining_deadline, resilient_stream
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+_PRIORITY_ORDER = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+# 現在の処理の優先度（バックグラウンドジョブはbatchを設定する）
+llm_priority: ContextVar[str] = ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+
+class LlmOverloadedError(Exception):
+    """LLMの待ち行列が深すぎるため呼び出しを受け付けない"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM capacity exceeded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LlmConcurrencyLimiter:
+    """同時実行数とトークンバケットによる優先度付きのLLM呼び出し制限"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: float = 0,
+        burst: Optional[int] = None,
+        max_queue: int = 32,
+    ):
+        self.max_concurrency = max_concurrency
+        # 0なら回数制限なし（同時実行数のみ）
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst or max_concurrency
+        self.max_queue = max_queue
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        # (優先度, 到着順, 待機中のFuture)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._refill_timer: Optional[asyncio.TimerHandle] = None
+        # 1回の呼び出しの平均所要時間（Retry-Afterの見積もり用）
+        self._avg_hold_seconds = 5.0
+        self.stats: Dict[str, Dict[str, Any]] = {
+            name: {"acquired": 0, "shed": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0} for name in _PRIORITY_ORDER
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def should_shed(self) -> bool:
+        """新しい対話リクエストを断るべきか（待ち行列が上限に達している）"""
+        return self.queue_depth >= self.max_queue
+
+    def retry_after(self) -> int:
+        """待ち行列がはけるまでのおおよその秒数"""
+        return max(1, math.ceil(self._avg_hold_seconds * (self.queue_depth + 1) / self.max_concurrency))
+
+    def _refill(self):
+        if not self.requests_per_minute:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.requests_per_minute / 60)
+        self._refilled_at = now
+
+    def _can_start(self) -> bool:
+        self._refill()
+        return self._in_flight < self.max_concurrency and (not self.requests_per_minute or self._tokens >= 1)
+
+    def _take(self):
+        self._in_flight += 1
+        if self.requests_per_minute:
+            self._tokens -= 1
+
+    def _dispatch(self):
+        """空きがある限り優先度の高い順に待機中の呼び出しを開始させる"""
+        self._refill_timer = None
+        while self._waiters:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)  # キャンセル済み
+                continue
+            if not self._can_start():
+                break
+            _, _, future = heapq.heappop(self._waiters)
+            self._take()
+            future.set_result(True)
+
+        if self._waiters and self._in_flight < self.max_concurrency and self.requests_per_minute:
+            # トークン不足で止まっている場合は次のトークンが貯まる頃に再開する
+            delay = (1 - self._tokens) * 60 / self.requests_per_minute
+            self._refill_timer = asyncio.get_running_loop().call_later(max(delay, 0.01), self._dispatch)
+
+    async def acquire(self, priority: Optional[str] = None):
+        """
+        呼び出し枠を取得（空きがなければ優先度順に待つ）
+
+        Raises:
+            LlmOverloadedError: 対話リクエストで待ち行列が上限に達している場合
+        """
+        priority = priority or llm_priority.get()
+        stats = self.stats[priority]
+        if not self._waiters and self._can_start():
+            self._take()
+            stats["acquired"] += 1
+            return
+
+        if priority == PRIORITY_INTERACTIVE and self.should_shed():
+            stats["shed"] += 1
+            raise LlmOverloadedError(self.retry_after())
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (_PRIORITY_ORDER[priority], next(self._order), future))
+        if self._refill_timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 枠を割り当てられた直後にキャンセルされた場合は返却する
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        wait_ms = (time.monotonic() - started) * 1000
+        stats["acquired"] += 1
+        stats["wait_ms_total"] += wait_ms
+        stats["wait_ms_max"] = max(stats["wait_ms_max"], round(wait_ms, 1))
+
+    def release(self, held_seconds: Optional[float] = None):
+        self._in_flight -= 1
+        if held_seconds is not None:
+            self._avg_hold_seconds = self._avg_hold_seconds * 0.8 + held_seconds * 0.2
+        if self._waiters and self._refill_timer is None:
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None):
+        """呼び出し枠を取得して処理し、終わったら返却する"""
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self._in_flight,
+            "queued": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "requests_per_minute": self.requests_per_minute,
+            "priorities": {
+                name: {
+                    **stats,
+                    "wait_ms_avg": round(stats["wait_ms_total"] / stats["acquired"], 1) if stats["acquired"] else 0.0,
+                }
+                for name, stats in self.stats.items()
+            },
+        }
+
+
+# グローバルシングルトンインスタンス
+llm_limiter = LlmConcurrencyLimiter(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+    requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "0")),
+    burst=int(os.getenv("LLM_BURST", "0")) or None,
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "32")),
+)
+
+
+def _returns_control(response: LlmResponse) -> bool:
+    """呼び出し元（ADK）が関数の実行や次の処理に進む応答か（途中のテキストではない）"""
+    if response.turn_complete or not response.partial:
+        return True
+    parts = response.content.parts if response.content and response.content.parts else []
+    return any(part.function_call for part in parts)
+
+
+class LimitedGemini(Gemini):
+    """llm_limiterの枠を取得してからモデルを呼び出すGemini
+
+    一時的なエラーはmodel_resilienceのリトライ・サーキットブレーカーで処理する。
+    リトライの待機中は枠を返却し、処理の期限（llm_deadline）はリクエストのタイムアウトとして渡す。
+    途中のテキストは枠を保持したまま返し、呼び出し元に制御が移る応答は枠を返却してから返す。
+    """
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        async def attempt():
+            remaining = remaining_deadline()
+            if remaining is not None and llm_request.config is not None:
+                # ヘッダーやbase_urlなど既存の設定は残し、タイムアウトだけを設定する
+                http_options = llm_request.config.http_options or genai_types.HttpOptions()
+                llm_request.config.http_options = http_options.model_copy(
+                    update={"timeout": max(1000, int(remaining * 1000))}
+                )
+            pending: List[LlmResponse] = []
+            generate = super(LimitedGemini, self).generate_content_async
+            async with llm_limiter.slot():
+                async with aclosing(generate(llm_request, stream)) as responses:
+                    async for response in responses:
+                        if _returns_control(response):
+                            # 残りを読み切ってストリームを閉じてから枠を返却する
+                            pending = [response] + [rest async for rest in responses]
+                            break
+                        yield response
+            for response in pending:
+                yield response
+
+        async for response in resilient_stream(attempt):
+            yield response
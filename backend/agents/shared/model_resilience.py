@@ -0,0 +1,201 @@
+"""
+LLM呼び出しのリトライとサーキットブレーカー
+一時的なモデルエラー（429・5xx・タイムアウト）はジッター付き指数バックオフで自動的にやり直し、
+障害が続く間はサーキットブレーカーですぐに失敗させて、劣化したバックエンドにリトライを積み上げない
+
+- リトライするのは応答を1件も受け取っていない呼び出しのみ（途中まで返した応答をやり直すと重複するため）
+- llm_deadline コンテキスト変数に期限（time.monotonic）があれば、期限を超えるリトライはしない
+- 連続 failure_threshold 回の一時的エラーでブレーカーを開き、reset_timeout 秒後に1件だけ試行する（half-open）
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import httpx
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+# 一時的なエラーとして扱うHTTPステータス
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# 現在の処理の期限（time.monotonic()の値。Noneなら期限なし）
+llm_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+retry_stats: Dict[str, int] = {"attempts": 0, "retries": 0, "transient_errors": 0, "gave_up": 0, "deadline_exceeded": 0}
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているためモデルを呼び出さない"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Model circuit breaker is open, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LlmDeadlineExceededError(Exception):
+    """処理の期限を過ぎたためモデルを呼び出さない"""
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """リトライで回復する見込みのあるエラーか"""
+    if isinstance(error, genai_errors.APIError):
+        return error.code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError))
+
+
+def remaining_deadline() -> Optional[float]:
+    """期限までの残り秒数（期限なしはNone）"""
+    deadline = llm_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class RetryPolicy:
+    """ジッター付き指数バックオフ（full jitter）"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def next_delay(self, attempt: int) -> Optional[float]:
+        """attempt回目の失敗後に待つ秒数（これ以上リトライしない場合はNone）"""
+        if attempt >= self.max_attempts:
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """連続した一時的エラーで開き、一定時間後に試行を1件だけ通すサーキットブレーカー"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.stats = {"opened": 0, "short_circuited": 0}
+
+    def before_call(self):
+        """
+        呼び出し前のチェック
+
+        Raises:
+            CircuitOpenError: ブレーカーが開いている、またはhalf-openで試行中の場合
+        """
+        if self.state == self.OPEN:
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_timeout:
+                self.stats["short_circuited"] += 1
+                raise CircuitOpenError(max(1, int(self.reset_timeout - waited)))
+            self.state = self.HALF_OPEN
+            logger.info("サーキットブレーカー: half-open（試行を1件通します）")
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                self.stats["short_circuited"] += 1
+                raise CircuitOpenError(1)
+            self._trial_in_flight = True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("サーキットブレーカー: closed（モデル呼び出しが回復しました）")
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+                logger.warning(f"🚨 サーキットブレーカー: open（連続エラー {self._consecutive_failures}回）")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def record_other(self):
+        """一時的でないエラー（リクエスト不正など）: バックエンドは応答しているので試行枠だけ戻す"""
+        self._trial_in_flight = False
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self._consecutive_failures, **self.stats}
+
+
+# グローバルシングルトンインスタンス
+model_retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", "0.5")),
+    max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", "8")),
+)
+model_circuit_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30")),
+)
+
+
+def get_resilience_metrics() -> Dict[str, Any]:
+    return {"retries": dict(retry_stats), "circuit_breaker": model_circuit_breaker.get_metrics()}
+
+
+async def resilient_stream(
+    call: Callable[[], AsyncIterator[Any]],
+    policy: Optional[RetryPolicy] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> AsyncIterator[Any]:
+    """
+    call() の応答をそのまま返し、一時的エラーはリトライする
+
+    Raises:
+        CircuitOpenError: ブレーカーが開いている場合
+        LlmDeadlineExceededError: 呼び出し前に期限を過ぎている場合
+    """
+    policy = policy or model_retry_policy
+    breaker = breaker or model_circuit_breaker
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = remaining_deadline()
+        if remaining is not None and remaining <= 0:
+            retry_stats["deadline_exceeded"] += 1
+            raise LlmDeadlineExceededError("LLM call deadline exceeded")
+        breaker.before_call()
+        retry_stats["attempts"] += 1
+
+        yielded = False
+        try:
+            async for item in call():
+                yielded = True
+                yield item
+        except Exception as e:
+            if not is_transient_error(e):
+                breaker.record_other()
+                raise
+            retry_stats["transient_errors"] += 1
+            breaker.record_failure()
+            delay = policy.next_delay(attempt)
+            remaining = remaining_deadline()
+            if (
+                yielded
+                or delay is None
+                or breaker.state == CircuitBreaker.OPEN
+                or (remaining is not None and delay >= remaining)
+            ):
+                retry_stats["gave_up"] += 1
+                raise
+            retry_stats["retries"] += 1
+            logger.warning(f"⚠️ モデル呼び出しの一時的エラー（{attempt}回目）: {e} - {delay:.2f}秒後にリトライします")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # キャンセル・途中での打ち切り: half-openの試行枠だけ戻す
+            breaker.record_other()
+            raise
+        breaker.record_success()
+        return
@@ -0,0 +1,165 @@
+"""
+LLMモデルのルーティング
+短い対話ターンや情報収集は高速なflash系モデルに、レイアウト生成や確信度の低いターンはproモデルに振り分ける
+
+ADKのbefore_model_callback / after_model_callbackとして各エージェントに登録し、
+呼び出しごとに llm_request.model を書き換える。ルートごとのレイテンシとトークン数を記録する。
+"""
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+
+logger = logging.getLogger(__name__)
+
+FAST_MODEL = os.getenv("MODEL_FAST_NAME", "gemini-2.5-flash")
+PRO_MODEL = os.getenv("MODEL_PRO_NAME", "gemini-2.5-pro")
+
+# 次のモデル呼び出しをproに昇格させるフラグ（確信度が低い応答の後に立てる）
+ESCALATION_STATE_KEY = "model_escalation_pending"
+_ROUTE_STATE_KEY = "temp:model_route"
+_STARTED_AT_STATE_KEY = "temp:model_route_started_at"
+
+# 修正・やり直しの依頼は確信度が低いターンとしてproで処理する
+LOW_CONFIDENCE_KEYWORDS = ("違う", "違い", "ちがう", "ちがい", "やり直", "修正", "間違", "まちが", "もう一度")
+
+
+@dataclass
+class RoutingPolicy:
+    """ルーティングポリシー"""
+
+    name: str
+    fast_model: str = FAST_MODEL
+    pro_model: str = PRO_MODEL
+    # これ以下の文字数の対話ターンをfastモデルで処理する（0ならすべてpro）
+    short_turn_chars: int = 400
+    # 常にproで処理するエージェント
+    pro_agents: Tuple[str, ...] = ("layout_agent",)
+    low_confidence_keywords: Tuple[str, ...] = field(default=LOW_CONFIDENCE_KEYWORDS)
+
+
+POLICIES: Dict[str, RoutingPolicy] = {
+    "tiered": RoutingPolicy(name="tiered"),
+    "pro_only": RoutingPolicy(name="pro_only", short_turn_chars=0),
+    "fast_only": RoutingPolicy(name="fast_only", short_turn_chars=10 ** 9, pro_agents=(), low_confidence_keywords=()),
+}
+
+# ルートごとの集計（/metrics 用）
+model_route_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def get_policy(name: Optional[str] = None) -> RoutingPolicy:
+    """環境変数 MODEL_ROUTING_POLICY（未指定時はtiered）のポリシーを取得"""
+    policy_name = name or os.getenv("MODEL_ROUTING_POLICY", "tiered")
+    if policy_name not in POLICIES:
+        logger.warning(f"未知のルーティングポリシー '{policy_name}' のためtieredを使用します")
+        policy_name = "tiered"
+    return POLICIES[policy_name]
+
+
+def select_route(
+    agent_name: str, user_text: str, escalation_pending: bool, policy: RoutingPolicy
+) -> Tuple[str, str]:
+    """
+    呼び出しのルートとモデルを決定
+
+    Returns:
+        (ルート名, モデル名)。ルート名は layout / escalated / long_turn / dialogue のいずれか
+    """
+    if agent_name in policy.pro_agents:
+        return "layout", policy.pro_model
+    if escalation_pending or any(keyword in user_text for keyword in policy.low_confidence_keywords):
+        return "escalated", policy.pro_model
+    if len(user_text) > policy.short_turn_chars:
+        return "long_turn", policy.pro_model
+    return "dialogue", policy.fast_model
+
+
+def _user_text(callback_context: CallbackContext) -> str:
+    content = callback_context.user_content
+    if not content or not content.parts:
+        return ""
+    return "".join(part.text for part in content.parts if part.text)
+
+
+def route_model_before_model(
+    callback_context: CallbackContext, llm_request: LlmRequest
+) -> Optional[LlmResponse]:
+    """before_model_callback: ポリシーに従って呼び出すモデルを切り替える"""
+    try:
+        route, model = select_route(
+            callback_context.agent_name,
+            _user_text(callback_context),
+            bool(callback_context.state.get(ESCALATION_STATE_KEY)),
+            get_policy(),
+        )
+        llm_request.model = model
+        callback_context.state[_ROUTE_STATE_KEY] = route
+        callback_context.state[_STARTED_AT_STATE_KEY] = time.monotonic()
+        logger.info(f"モデルルーティング: {callback_context.agent_name} -> {model} ({route})")
+    except Exception as e:
+        # ルーティングに失敗してもエージェント既定のモデルで呼び出しを継続する
+        logger.error(f"モデルルーティングエラー: {e}")
+    return None
+
+
+def _is_low_confidence(llm_response: LlmResponse) -> bool:
+    """エラー終了や空の応答は確信度が低いとみなす"""
+    if llm_response.error_code:
+        return True
+    finish_reason = getattr(llm_response, "finish_reason", None)
+    finish_reason = getattr(finish_reason, "name", finish_reason)
+    if finish_reason and finish_reason not in ("STOP", "MAX_TOKENS"):
+        return True
+    content = llm_response.content
+    return not content or not any(part.text or part.function_call for part in (content.parts or []))
+
+
+def record_model_route_after_model(
+    callback_context: CallbackContext, llm_response: LlmResponse
+) -> Optional[LlmResponse]:
+    """after_model_callback: ルートごとのレイテンシ・トークン数を記録し、必要なら次の呼び出しを昇格させる"""
+    if llm_response.partial:
+        return None
+
+    route = callback_context.state.get(_ROUTE_STATE_KEY)
+    started_at = callback_context.state.get(_STARTED_AT_STATE_KEY)
+    if not route or started_at is None:
+        return None
+
+    latency_ms = (time.monotonic() - started_at) * 1000
+    usage = llm_response.usage_metadata
+    stats = model_route_stats.setdefault(
+        route,
+        {"calls": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0, "prompt_tokens": 0, "output_tokens": 0},
+    )
+    stats["calls"] += 1
+    stats["latency_ms_total"] += latency_ms
+    stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+    if usage:
+        stats["prompt_tokens"] += usage.prompt_token_count or 0
+        stats["output_tokens"] += usage.candidates_token_count or 0
+
+    # fastモデルの応答が不十分なら、次の呼び出しをproで処理する
+    low_confidence = route == "dialogue" and _is_low_confidence(llm_response)
+    if low_confidence:
+        logger.warning(f"⚠️ fastモデルの応答が不十分なため、次の呼び出しをproに昇格します: {callback_context.agent_name}")
+    if low_confidence or callback_context.state.get(ESCALATION_STATE_KEY):
+        callback_context.state[ESCALATION_STATE_KEY] = low_confidence
+    return None
+
+
+def get_model_route_metrics() -> Dict[str, Dict[str, Any]]:
+    """ルートごとの呼び出し数・平均/最大レイテンシ・トークン数"""
+    return {
+        route: {
+            **stats,
+            "latency_ms_avg": round(stats["latency_ms_total"] / stats["calls"], 1) if stats["calls"] else 0.0,
+        }
+        for route, stats in model_route_stats.items()
+    }
@@ -0,0 +1,77 @@
+"""
+エージェント実行前の事前取得（プリフライト）
+ユーザー設定・辞書・画像など互いに独立した取得処理を並列に実行する
+
+各ステップには期限を設け、期限切れや失敗時はデフォルト値で続行する（LLM呼び出しを遅らせない）。
+ステップごとの所要時間と結果（ok / timeout / error）を記録する。
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_STEP_TIMEOUT_SECONDS = float(os.getenv("AGENT_PREFLIGHT_TIMEOUT_SECONDS", "1.5"))
+
+# ステップごとの集計（/metrics 用）
+preflight_stats: Dict[str, Dict[str, Any]] = {}
+
+
+@dataclass
+class PreflightStep:
+    """プリフライトの1ステップ"""
+
+    name: str
+    fetch: Callable[[], Awaitable[Any]]
+    default: Any = None
+    timeout: float = PREFLIGHT_STEP_TIMEOUT_SECONDS
+
+
+async def _run_step(step: PreflightStep) -> Tuple[str, Any, Dict[str, Any]]:
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        value = await asyncio.wait_for(step.fetch(), timeout=step.timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"⏱️ プリフライト '{step.name}' が期限（{step.timeout}秒）内に完了しないためデフォルト値を使用します")
+        value, status = step.default, "timeout"
+    except Exception as e:
+        logger.error(f"プリフライト '{step.name}' エラー: {e}")
+        value, status = step.default, "error"
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    stats = preflight_stats.setdefault(step.name, {"runs": 0, "timeouts": 0, "errors": 0, "ms_total": 0.0, "ms_max": 0.0})
+    stats["runs"] += 1
+    stats["timeouts"] += status == "timeout"
+    stats["errors"] += status == "error"
+    stats["ms_total"] += elapsed_ms
+    stats["ms_max"] = max(stats["ms_max"], elapsed_ms)
+    return step.name, value, {"ms": elapsed_ms, "status": status}
+
+
+async def run_preflight(steps: List[PreflightStep]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    ステップを並列に実行
+
+    Returns:
+        (ステップ名 -> 取得結果, ステップ名 -> {"ms": 所要時間, "status": 結果})
+    """
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(*(_run_step(step) for step in steps))
+
+    results = {name: value for name, value, _ in outcomes}
+    timings = {name: timing for name, _, timing in outcomes}
+    total_ms = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"🚀 プリフライト完了: {total_ms}ms {timings}")
+    return results, timings
+
+
+def get_preflight_metrics() -> Dict[str, Dict[str, Any]]:
+    """ステップごとの実行回数・タイムアウト数・平均/最大所要時間"""
+    return {
+        name: {**stats, "ms_avg": round(stats["ms_total"] / stats["runs"], 1) if stats["runs"] else 0.0}
+        for name, stats in preflight_stats.items()
+    }
@@ -0,0 +1,133 @@
+"""
+HTML Artifact のインスタンス間ブロードキャスト
+LayoutAgentを実行したインスタンスとWebSocketを受け持つインスタンスが異なる場合でも、
+Artifactや生成途中の差分が購読者に届くようにする
+
+- memory: プロセス内のバスで配信（テスト・ローカル開発用。同じバスを共有するマネージャー間で届く）
+- redis: Redis pub/sub で配信（REDIS_URL、redisパッケージが必要）
+"""
+import asyncio
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BroadcastHandler = Callable[[Dict], Awaitable[None]]
+
+DEFAULT_CHANNEL = "gakkoudayori:artifacts"
+
+
+class ArtifactBroadcastBackend(ABC):
+    """インスタンス間でArtifactのメッセージを配信するバックエンド"""
+
+    @abstractmethod
+    async def publish(self, message: Dict) -> None:
+        """全インスタンス（自分を含む）にメッセージを配信"""
+
+    @abstractmethod
+    async def start(self, handler: BroadcastHandler) -> None:
+        """メッセージの受信を開始（受信したメッセージごとにhandlerを呼ぶ）"""
+
+    async def close(self) -> None:
+        """受信を停止して接続を閉じる"""
+
+
+class InMemoryBroadcastBus:
+    """プロセス内のブロードキャストバス（複数のインスタンスを模擬する）"""
+
+    def __init__(self):
+        self.handlers: List[BroadcastHandler] = []
+
+    async def publish(self, message: Dict) -> None:
+        # 実際のpub/subと同様、シリアライズしたものを各受信者に渡す
+        payload = json.dumps(message)
+        for handler in list(self.handlers):
+            try:
+                await handler(json.loads(payload))
+            except Exception as e:
+                logger.error(f"Artifact broadcast handler error: {e}")
+
+
+class InMemoryBroadcastBackend(ArtifactBroadcastBackend):
+    """InMemoryBroadcastBusを使うバックエンド"""
+
+    def __init__(self, bus: Optional[InMemoryBroadcastBus] = None):
+        self.bus = bus or InMemoryBroadcastBus()
+        self._handler: Optional[BroadcastHandler] = None
+
+    async def publish(self, message: Dict) -> None:
+        await self.bus.publish(message)
+
+    async def start(self, handler: BroadcastHandler) -> None:
+        self._handler = handler
+        self.bus.handlers.append(handler)
+
+    async def close(self) -> None:
+        if self._handler in self.bus.handlers:
+            self.bus.handlers.remove(self._handler)
+        self._handler = None
+
+
+class RedisBroadcastBackend(ArtifactBroadcastBackend):
+    """Redis pub/sub を使うバックエンド"""
+
+    def __init__(self, client, channel: str = DEFAULT_CHANNEL, reconnect_delay: float = 1.0):
+        self.client = client
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self, message: Dict) -> None:
+        await self.client.publish(self.channel, json.dumps(message))
+
+    async def start(self, handler: BroadcastHandler) -> None:
+        self._task = asyncio.create_task(self._listen(handler))
+
+    async def _listen(self, handler: BroadcastHandler) -> None:
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                await pubsub.subscribe(self.channel)
+                logger.info(f"Artifact broadcast subscribed: {self.channel}")
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    try:
+                        await handler(json.loads(item["data"]))
+                    except Exception as e:
+                        logger.error(f"Artifact broadcast handler error: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 接続が切れた場合は少し待って再購読する
+                logger.error(f"Artifact broadcast connection error: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def create_artifact_broadcast_backend() -> Optional[ArtifactBroadcastBackend]:
+    """環境変数 ARTIFACT_BROADCAST_BACKEND に応じたバックエンドを生成する
+
+    - none: インスタンス間配信なし（単一インスタンス。デフォルト）
+    - memory: プロセス内のバス
+    - redis: REDIS_URL のRedis pub/sub
+    """
+    backend_name = os.getenv("ARTIFACT_BROADCAST_BACKEND", "none").lower()
+    if backend_name == "none":
+        return None
+    if backend_name == "memory":
+        return InMemoryBroadcastBackend()
+    if backend_name == "redis":
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise ValueError("ARTIFACT_BROADCAST_BACKEND=redis を使用するにはredisパッケージが必要です。") from e
+        return RedisBroadcastBackend(redis_asyncio.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    raise ValueError(f"未対応のARTIFACT_BROADCAST_BACKENDです: {backend_name}")
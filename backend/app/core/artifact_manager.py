@@ -2,14 +2,23 @@
 HTML Artifact 管理サービス
 LayoutAgentからのHTML成果物を管理し、WebSocket経由でフロントエンドに配信
 """
+import asyncio
 import json
 import logging
-from dataclasses import asdict, dataclass
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field, replace
 from datetime import datetime
-from typing import Dict, Optional, Set
+from typing import Callable, Deque, Dict, Optional, Tuple
 
 from fastapi import WebSocket
 
+from app.core.artifact_broadcast import ArtifactBroadcastBackend, create_artifact_broadcast_backend
+from app.core.html_diff import make_compact_patch
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,72 +30,449 @@ class HtmlArtifact:
     artifact_type: str = "newsletter"
     created_at: str = None
     metadata: Optional[Dict] = None
+    # セッション内で単調増加するバージョン番号（エポックミリ秒を基準にするため、退避や再起動の後も前の版より大きい）
+    version: int = 1
+    # 生成したインスタンスのID（インスタンス間で同じバージョンが競合した場合の順序付けに使う）
+    origin: Optional[str] = None
 
     def __post_init__(self):
         if self.created_at is None:
             self.created_at = datetime.now().isoformat()
 
+    @property
+    def etag(self) -> str:
+        """条件付きGET用のETag（本文を読まずにバージョンと作成時刻から作る）"""
+        return f'"{self.session_id}-v{self.version}-{self.created_at}"'
+
     def to_dict(self) -> Dict:
         return asdict(self)
 
 
+@dataclass
+class _StoredArtifact:
+    """ストア内のエントリ（コールドになった本文はzlib圧縮して保持）"""
+    artifact: HtmlArtifact
+    compressed: Optional[bytes]
+    size_bytes: int
+    stored_at: float
+    last_access: float
+    # 過去のバージョン（バージョン番号, zlib圧縮した本文）
+    history: Deque[Tuple[int, bytes]] = field(default_factory=deque)
+    history_bytes: int = 0
+
+
+class ArtifactStore:
+    """
+    HTML Artifactのストア（総バイト数の上限・LRU/TTL退避・コールドエントリの圧縮）
+
+    長時間稼働するインスタンスでもメモリ使用量が一定に収まるようにする。
+    差分配信のため、セッションごとに直近の数バージョンを圧縮して保持する。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: int = 6 * 60 * 60,
+        compress_after_seconds: int = 300,
+        sweep_interval: float = 30.0,
+        history_versions: int = 5,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # 0以下なら圧縮しない
+        self.compress_after_seconds = compress_after_seconds
+        # 期限切れ・圧縮対象の走査間隔（毎回の全件走査を避ける）
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self.history_versions = history_versions
+
+        self._entries: "OrderedDict[str, _StoredArtifact]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "lru_evictions": 0, "ttl_evictions": 0, "compressions": 0}
+
+    def put(self, session_id: str, artifact: HtmlArtifact) -> None:
+        now = time.monotonic()
+        previous = self._entries.get(session_id)
+        history: Deque[Tuple[int, bytes]] = deque()
+        if previous is not None and not self._is_expired(previous, now):
+            history = previous.history
+            if self.history_versions > 0:
+                history.append((previous.artifact.version, self._compressed_content(previous)))
+            while len(history) > self.history_versions:
+                history.popleft()
+        self._remove(session_id)
+
+        size = len(artifact.content.encode("utf-8"))
+        history_bytes = sum(len(data) for _, data in history)
+        self._entries[session_id] = _StoredArtifact(artifact, None, size, now, now, history, history_bytes)
+        self._bytes += size + history_bytes
+        self._maintain(now)
+
+    def latest_version(self, session_id: str) -> int:
+        """最新バージョン番号（Artifactが無い場合は0。統計には含めない）"""
+        return self.latest_order(session_id)[0]
+
+    def latest_order(self, session_id: str) -> Tuple[int, str]:
+        """最新版の順序キー (バージョン, 生成元)（Artifactが無い場合は (0, "")。統計には含めない）"""
+        entry = self._entries.get(session_id)
+        if entry is None or self._is_expired(entry, time.monotonic()):
+            return 0, ""
+        return entry.artifact.version, entry.artifact.origin or ""
+
+    def get_version_content(self, session_id: str, version: int) -> Optional[str]:
+        """指定バージョンの本文（履歴に残っていない場合はNone）"""
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        if entry.artifact.version == version:
+            artifact = self.get(session_id)
+            return artifact.content if artifact else None
+        for history_version, data in entry.history:
+            if history_version == version:
+                return zlib.decompress(data).decode("utf-8")
+        return None
+
+    def _compressed_content(self, entry: _StoredArtifact) -> bytes:
+        if entry.compressed is not None:
+            return entry.compressed
+        return zlib.compress(entry.artifact.content.encode("utf-8"))
+
+    def get(self, session_id: str) -> Optional[HtmlArtifact]:
+        entry = self._entries.get(session_id)
+        now = time.monotonic()
+        if entry is None or self._is_expired(entry, now):
+            if entry is not None:
+                self._remove(session_id)
+                self.stats["ttl_evictions"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        if entry.compressed is not None:
+            # 再びアクセスされたエントリは展開してホットに戻す
+            content = zlib.decompress(entry.compressed).decode("utf-8")
+            entry.artifact = replace(entry.artifact, content=content)
+            self._bytes += len(content.encode("utf-8")) - entry.size_bytes
+            entry.size_bytes = len(content.encode("utf-8"))
+            entry.compressed = None
+
+        entry.last_access = now
+        self._entries.move_to_end(session_id)
+        self.stats["hits"] += 1
+        self._maintain(now)
+        return entry.artifact
+
+    def delete(self, session_id: str) -> bool:
+        return self._remove(session_id)
+
+    def session_ids(self):
+        return list(self._entries.keys())
+
+    def _is_expired(self, entry: _StoredArtifact, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry.stored_at > self.ttl_seconds
+
+    def _remove(self, session_id: str) -> bool:
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry.size_bytes + entry.history_bytes
+        return True
+
+    def _maintain(self, now: float) -> None:
+        """期限切れの退避・コールドエントリの圧縮・上限超過時のLRU退避"""
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            self._sweep(now)
+
+        # 最も長くアクセスされていないものから退避（直近に保存したエントリは残す）
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            session_id = next(iter(self._entries))
+            self._remove(session_id)
+            self.stats["lru_evictions"] += 1
+            logger.info(f"Artifact evicted (LRU) for session: {session_id}")
+
+    def _sweep(self, now: float) -> None:
+        for session_id, entry in list(self._entries.items()):
+            if self._is_expired(entry, now):
+                self._remove(session_id)
+                self.stats["ttl_evictions"] += 1
+            elif (
+                self.compress_after_seconds > 0
+                and entry.compressed is None
+                and now - entry.last_access > self.compress_after_seconds
+            ):
+                self._compress(entry)
+
+    def _compress(self, entry: _StoredArtifact) -> None:
+        compressed = zlib.compress(entry.artifact.content.encode("utf-8"))
+        self._bytes += len(compressed) - entry.size_bytes
+        entry.size_bytes = len(compressed)
+        entry.compressed = compressed
+        entry.artifact = replace(entry.artifact, content="")
+        self.stats["compressions"] += 1
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "compressed_entries": sum(1 for e in self._entries.values() if e.compressed is not None),
+            **self.stats,
+        }
+
+
+@dataclass
+class Subscriber:
+    """セッションを購読する1つのWebSocket接続"""
+    id: str
+    session_id: str
+    websocket: WebSocket
+    # 差分配信に対応したクライアントの配信済みバージョン（非対応クライアントはNone）
+    delivered_version: Optional[int] = None
+    # 送信待ちのメッセージ（種類, 送信するテキスト）
+    queue: Deque[Tuple[str, str]] = field(default_factory=deque)
+    # 最新Artifactの送信待ち（何度更新されても最新の1件だけを送る）
+    artifact_pending: bool = False
+    # キューあふれで生成途中の差分を捨てた場合、次のArtifact送信まで差分を送らない
+    skip_deltas: bool = False
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+    # クライアントから最後にメッセージを受信した時刻（time.monotonic）
+    last_seen: float = field(default_factory=time.monotonic)
+
+
+# Artifactメッセージの生成関数: (セッションID, 配信済みバージョン) -> メッセージ
+ArtifactMessageBuilder = Callable[[str, Optional[int]], Optional[Dict]]
+
+
 class WebSocketManager:
-    """WebSocket接続管理"""
+    """
+    WebSocket接続管理（1セッションに複数の購読者）
+
+    購読者ごとに上限付きの送信キューと送信タスクを持ち、遅いクライアントが
+    他のクライアントや配信元をブロックしないようにする。
+    - Artifactは送信時に最新版からメッセージを組み立てる（古い版は送らずにまとめる）
+    - キューがあふれた場合は生成途中の差分（html_delta）から捨て、完成版で追いつかせる
+    - ping_intervalごとにサーバーからpingを送り、idle_timeoutの間クライアントから
+      何も届かない接続（切断を検知できていない半開きのソケット）を閉じる
+    """
 
-    def __init__(self):
-        # セッションID -> WebSocketのマッピング
-        self._connections: Dict[str, WebSocket] = {}
-        # アクティブな接続を追跡
-        self._active_sessions: Set[str] = set()
+    def __init__(
+        self,
+        artifact_message_builder: Optional[ArtifactMessageBuilder] = None,
+        queue_size: int = 32,
+        send_timeout: float = 10.0,
+        ping_interval: float = 20.0,
+        idle_timeout: float = 75.0,
+    ):
+        self._artifact_message_builder = artifact_message_builder
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        # セッションID -> {購読者ID -> 購読者}
+        self._subscribers: Dict[str, Dict[str, Subscriber]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.stats = {"sent": 0, "dropped": 0, "coalesced": 0, "send_failures": 0, "pings": 0, "reaped": 0}
 
-    async def connect(self, session_id: str, websocket: WebSocket):
-        """WebSocket接続を確立"""
+    async def connect(
+        self, session_id: str, websocket: WebSocket, since_version: Optional[int] = None
+    ) -> Subscriber:
+        """WebSocket接続を確立し、購読者を登録（since_versionを指定したクライアントには差分を配信する）"""
         await websocket.accept()
-        self._connections[session_id] = websocket
-        self._active_sessions.add(session_id)
-        logger.info(f"WebSocket connected for session: {session_id}")
-
-    async def disconnect(self, session_id: str):
-        """WebSocket接続を切断"""
-        if session_id in self._connections:
-            del self._connections[session_id]
-        if session_id in self._active_sessions:
-            self._active_sessions.remove(session_id)
+        subscriber = Subscriber(
+            id=uuid.uuid4().hex, session_id=session_id, websocket=websocket, delivered_version=since_version
+        )
+        subscriber.task = asyncio.create_task(self._sender(subscriber))
+        self._subscribers.setdefault(session_id, {})[subscriber.id] = subscriber
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f"WebSocket connected for session: {session_id} (subscribers: {len(self._subscribers[session_id])})")
+        return subscriber
+
+    def touch(self, subscriber: Subscriber):
+        """クライアントからメッセージを受信したことを記録"""
+        subscriber.last_seen = time.monotonic()
+
+    async def _heartbeat(self):
+        """接続がある間、定期的にpingの送信とアイドル接続の回収を行う"""
+        while self._subscribers:
+            await asyncio.sleep(self.ping_interval)
+            await self.reap_idle()
+            ping = json.dumps({"type": "ping"})
+            for subscribers in list(self._subscribers.values()):
+                for subscriber in list(subscribers.values()):
+                    self.enqueue(subscriber, "ping", ping)
+                    self.stats["pings"] += 1
+
+    async def reap_idle(self) -> int:
+        """idle_timeoutを超えて応答のない接続を閉じて登録解除し、閉じた数を返す"""
+        now = time.monotonic()
+        idle = [
+            subscriber
+            for subscribers in self._subscribers.values()
+            for subscriber in subscribers.values()
+            if now - subscriber.last_seen > self.idle_timeout
+        ]
+        for subscriber in idle:
+            logger.warning(f"Reaping idle WebSocket for session: {subscriber.session_id}")
+            await self.disconnect(subscriber.session_id, subscriber.id)
+            self.stats["reaped"] += 1
+            try:
+                await asyncio.wait_for(subscriber.websocket.close(code=1001), timeout=self.send_timeout)
+            except Exception as e:
+                logger.debug(f"Idle WebSocket close failed: {e}")
+        return len(idle)
+
+    async def disconnect(self, session_id: str, subscriber_id: Optional[str] = None):
+        """購読者を登録解除（subscriber_id未指定時はセッションの全購読者）"""
+        subscribers = self._subscribers.get(session_id, {})
+        targets = [subscriber_id] if subscriber_id else list(subscribers)
+        for target in targets:
+            subscriber = subscribers.pop(target, None)
+            if subscriber and subscriber.task and subscriber.task is not asyncio.current_task():
+                subscriber.task.cancel()
+        if not subscribers:
+            self._subscribers.pop(session_id, None)
+        if not self._subscribers and self._heartbeat_task and self._heartbeat_task is not asyncio.current_task():
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
         logger.info(f"WebSocket disconnected for session: {session_id}")
 
-    async def send_artifact(self, session_id: str, artifact: HtmlArtifact):
-        """指定セッションにHTML Artifactを送信"""
-        if session_id not in self._connections:
+    async def send_message(self, session_id: str, message: Dict) -> bool:
+        """指定セッションの全購読者にJSONメッセージを送信（キューに積むだけで待たない）"""
+        subscribers = self._subscribers.get(session_id)
+        if not subscribers:
             logger.warning(f"No WebSocket connection for session: {session_id}")
             return False
 
+        text = json.dumps(message)
+        for subscriber in list(subscribers.values()):
+            self.enqueue(subscriber, message.get("type", "message"), text)
+        return True
+
+    async def send_artifact(self, session_id: str, artifact: HtmlArtifact):
+        """指定セッションの全購読者に最新のHTML Artifactを送信"""
+        return self.notify_artifact(session_id)
+
+    def notify_artifact(self, session_id: str, subscriber: Optional[Subscriber] = None) -> bool:
+        """最新のArtifactの送信を予約（送信前に更新された場合は最新版だけを送る）"""
+        targets = [subscriber] if subscriber else list(self._subscribers.get(session_id, {}).values())
+        for target in targets:
+            if target.artifact_pending:
+                self.stats["coalesced"] += 1
+            target.artifact_pending = True
+            target.wakeup.set()
+        return bool(targets)
+
+    def enqueue(self, subscriber: Subscriber, kind: str, text: str):
+        """購読者の送信キューにメッセージを追加（あふれた場合の方針を適用）"""
+        if kind == "html_delta" and subscriber.skip_deltas:
+            self.stats["dropped"] += 1
+            return
+
+        if len(subscriber.queue) >= self.queue_size:
+            # 遅いクライアント: 生成途中の差分を捨て、完成版のArtifactで追いつかせる
+            kept = deque(item for item in subscriber.queue if item[0] != "html_delta")
+            dropped = len(subscriber.queue) - len(kept)
+            if dropped:
+                subscriber.queue = kept
+                subscriber.skip_deltas = True
+                self.stats["dropped"] += dropped
+            if kind == "html_delta":
+                subscriber.skip_deltas = True
+                self.stats["dropped"] += 1
+                return
+            if len(subscriber.queue) >= self.queue_size:
+                subscriber.queue.popleft()
+                self.stats["dropped"] += 1
+
+        subscriber.queue.append((kind, text))
+        subscriber.wakeup.set()
+
+    async def _sender(self, subscriber: Subscriber):
+        """購読者ごとの送信ループ（購読者間で並行に送信される）"""
         try:
-            websocket = self._connections[session_id]
-            message = {
-                "type": "html_artifact",
-                "data": artifact.to_dict()
-            }
-            await websocket.send_text(json.dumps(message))
-            logger.info(f"HTML artifact sent to session: {session_id}")
-            return True
+            while True:
+                await subscriber.wakeup.wait()
+                subscriber.wakeup.clear()
+                while subscriber.queue or subscriber.artifact_pending:
+                    if subscriber.queue:
+                        kind, text = subscriber.queue.popleft()
+                        message = None
+                    else:
+                        subscriber.artifact_pending = False
+                        message = self._build_artifact_message(subscriber)
+                        if message is None:
+                            continue
+                        kind, text = message["type"], json.dumps(message)
+
+                    await asyncio.wait_for(subscriber.websocket.send_text(text), timeout=self.send_timeout)
+                    self.stats["sent"] += 1
+                    if message is not None:
+                        subscriber.skip_deltas = False
+                        if subscriber.delivered_version is not None:
+                            subscriber.delivered_version = message["data"]["version"]
+                        logger.info(f"HTML {kind} v{message['data'].get('version')} sent to session: {subscriber.session_id}")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Failed to send artifact to {session_id}: {e}")
-            # 接続エラーの場合は接続を削除
-            await self.disconnect(session_id)
-            return False
+            self.stats["send_failures"] += 1
+            logger.error(f"Failed to send message to {subscriber.session_id}: {e}")
+            # 送信できない接続は登録解除する
+            await self.disconnect(subscriber.session_id, subscriber.id)
+
+    def _build_artifact_message(self, subscriber: Subscriber) -> Optional[Dict]:
+        if self._artifact_message_builder is None:
+            return None
+        return self._artifact_message_builder(subscriber.session_id, subscriber.delivered_version)
 
     def is_connected(self, session_id: str) -> bool:
         """セッションがWebSocketで接続中かチェック"""
-        return session_id in self._active_sessions
+        return bool(self._subscribers.get(session_id))
+
+    def connection_count(self, session_id: Optional[str] = None) -> int:
+        """接続数（session_id未指定時は全体）"""
+        if session_id is not None:
+            return len(self._subscribers.get(session_id, {}))
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._subscribers),
+            "connections": self.connection_count(),
+            "queued": sum(len(s.queue) for subs in self._subscribers.values() for s in subs.values()),
+            **self.stats,
+        }
 
 
 class ArtifactManager:
-    """HTML Artifact 管理サービス"""
+    """HTML Artifact 管理サービス
+
+    broadcast_backendを指定すると、保存したArtifactと生成途中の差分を他のインスタンスにも配信し、
+    他のインスタンスで生成されたものを自インスタンスの購読者に届ける。
+    """
 
-    def __init__(self):
-        # セッションID -> 最新のArtifactのマッピング
-        self._artifacts: Dict[str, HtmlArtifact] = {}
-        self._websocket_manager = WebSocketManager()
+    def __init__(self, broadcast_backend: Optional[ArtifactBroadcastBackend] = None):
+        # セッションID -> 最新のArtifact（容量上限・TTL付き）
+        self._store = ArtifactStore(
+            max_bytes=int(os.getenv("ARTIFACT_STORE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl_seconds=int(os.getenv("ARTIFACT_TTL_SECONDS", str(6 * 60 * 60))),
+            compress_after_seconds=int(os.getenv("ARTIFACT_COMPRESS_AFTER_SECONDS", "300")),
+            history_versions=int(os.getenv("ARTIFACT_HISTORY_VERSIONS", "5")),
+        )
+        self._websocket_manager = WebSocketManager(
+            artifact_message_builder=self._build_artifact_message,
+            queue_size=int(os.getenv("WS_SUBSCRIBER_QUEUE_SIZE", "32")),
+            ping_interval=float(os.getenv("WS_PING_INTERVAL_SECONDS", "20")),
+            idle_timeout=float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "75")),
+        )
+        self._broadcast_backend = broadcast_backend
+        # 自インスタンスが送ったブロードキャストを識別するID
+        self._instance_id = uuid.uuid4().hex
+        self._last_issued_version = 0
+        # セッションID -> 新しいArtifactの到着を待つロングポーリング用イベントと待機数（最後の待機者が抜けたら削除）
+        self._artifact_events: Dict[str, asyncio.Event] = {}
+        self._artifact_waiters: Dict[str, int] = {}
 
     @property
     def websocket_manager(self) -> WebSocketManager:
@@ -101,44 +487,227 @@ class ArtifactManager:
     ) -> HtmlArtifact:
         """HTML Artifactを保存し、WebSocket経由で配信"""
 
-        # Artifactオブジェクト作成
+        # Artifactオブジェクト作成（セッション内のバージョンを進める）
         artifact = HtmlArtifact(
             session_id=session_id,
             content=html_content,
             artifact_type=artifact_type,
-            metadata=metadata or {}
+            metadata=metadata or {},
+            version=self._next_version(session_id),
+            origin=self._instance_id,
         )
 
+        self._accept_artifact(artifact)
+        await self._broadcast({"kind": "artifact", "artifact": artifact.to_dict()})
+        return artifact
+
+    def _next_version(self, session_id: str) -> int:
+        """
+        次のバージョン番号
+
+        ストアの最新版+1だけだと、TTL・LRUで退避した後に1からやり直してしまい、
+        since_versionを持つクライアントやロングポーリングが新しい版を受け取れない。
+        現在時刻（ミリ秒）と自インスタンスが最後に発行した番号を下限にして、退避・再起動の後も前の版より大きい番号にする。
+        """
+        self._last_issued_version = max(
+            self._store.latest_version(session_id) + 1,
+            self._last_issued_version + 1,
+            time.time_ns() // 1_000_000,
+        )
+        return self._last_issued_version
+
+    def _accept_artifact(self, artifact: HtmlArtifact):
+        """Artifactを保存し、自インスタンスの購読者に配信"""
+        session_id = artifact.session_id
         # 内部ストレージに保存
-        self._artifacts[session_id] = artifact
-        logger.info(f"HTML artifact stored for session: {session_id}, size: {len(html_content)} chars")
+        self._store.put(session_id, artifact)
+        # ロングポーリング中のリクエストを起こす
+        event = self._artifact_events.pop(session_id, None)
+        if event is not None:
+            event.set()
+        logger.info(f"HTML artifact stored for session: {session_id}, version: {artifact.version}, size: {len(artifact.content)} chars")
 
-        # WebSocket経由で即座に配信
+        # WebSocket経由で即座に配信（購読者ごとの送信キューに予約）
         if self._websocket_manager.is_connected(session_id):
-            success = await self._websocket_manager.send_artifact(session_id, artifact)
-            if success:
-                logger.info(f"HTML artifact delivered via WebSocket to: {session_id}")
-            else:
-                logger.warning(f"Failed to deliver artifact via WebSocket to: {session_id}")
+            self._websocket_manager.notify_artifact(session_id)
+            logger.info(f"HTML artifact queued for WebSocket delivery to: {session_id}")
         else:
             logger.info(f"WebSocket not connected for session: {session_id}, artifact stored for polling")
 
-        return artifact
+    async def _broadcast(self, message: Dict):
+        """他のインスタンスに配信（失敗してもローカルの配信には影響させない）"""
+        if self._broadcast_backend is None:
+            return
+        try:
+            await self._broadcast_backend.publish({**message, "origin": self._instance_id})
+        except Exception as e:
+            logger.error(f"Artifact broadcast publish error: {e}")
+
+    async def _on_broadcast(self, message: Dict):
+        """他のインスタンスからのブロードキャストを処理"""
+        if message.get("origin") == self._instance_id:
+            return
+        if message.get("kind") == "artifact":
+            artifact = HtmlArtifact(**message["artifact"])
+            # バージョンは時刻基準でインスタンス間でも比較でき、同じ場合は生成元で決める（全インスタンスで同じ版が残る）
+            if (artifact.version, artifact.origin or "") > self._store.latest_order(artifact.session_id):
+                self._accept_artifact(artifact)
+        elif message.get("kind") == "delta":
+            await self._send_delta_locally(message["session_id"], message["delta"], message["seq"])
+
+    async def start_broadcast(self):
+        """インスタンス間配信の受信を開始（アプリ起動時）"""
+        if self._broadcast_backend is not None:
+            await self._broadcast_backend.start(self._on_broadcast)
+            logger.info("Artifact broadcast started")
+
+    async def close_broadcast(self):
+        """インスタンス間配信の受信を停止（アプリ終了時）"""
+        if self._broadcast_backend is not None:
+            await self._broadcast_backend.close()
+
+    def get_changes_since(self, session_id: str, since_version: Optional[int]) -> Optional[Dict]:
+        """
+        指定バージョン以降の変更をWebSocketメッセージ形式で返す
+
+        Returns:
+            - 履歴に基準バージョンがあり差分が十分小さい場合: "html_patch"（行単位パッチ）
+            - それ以外: "html_artifact"（全文スナップショット）
+            - 最新バージョンと同じ、またはArtifactが無い場合: None
+        """
+        artifact = self._store.get(session_id)
+        if artifact is None or since_version == artifact.version:
+            return None
+
+        if since_version:
+            base_content = self._store.get_version_content(session_id, since_version)
+            patch = make_compact_patch(base_content, artifact.content) if base_content is not None else None
+            if patch is not None:
+                return {
+                    "type": "html_patch",
+                    "data": {
+                        "session_id": session_id,
+                        "base_version": since_version,
+                        "version": artifact.version,
+                        "patch": patch,
+                        "created_at": artifact.created_at,
+                        "metadata": artifact.metadata,
+                    },
+                }
+        return {"type": "html_artifact", "data": artifact.to_dict()}
+
+    def _build_artifact_message(self, session_id: str, delivered_version: Optional[int]) -> Optional[Dict]:
+        """購読者に送るArtifactメッセージ（差分非対応のクライアントには常に全文）"""
+        if delivered_version is None:
+            artifact = self._store.get(session_id)
+            return {"type": "html_artifact", "data": artifact.to_dict()} if artifact else None
+        return self.get_changes_since(session_id, delivered_version)
+
+    async def send_latest(self, session_id: str, subscriber: Optional[Subscriber] = None) -> bool:
+        """
+        最新のArtifactをWebSocketで送信
+
+        差分対応クライアントには配信済みバージョンからの差分を、それ以外には全文を送る。
+        """
+        return self._websocket_manager.notify_artifact(session_id, subscriber)
+
+    async def handle_client_message(self, subscriber: Subscriber, text: str) -> Optional[str]:
+        """
+        WebSocketクライアントからのメッセージを処理し、返信があれば返す
+
+        - "ping" -> "pong"
+        - {"type": "sync", "since_version": N} -> 以降を差分配信に切り替え、Nからの変更を送信
+        """
+        self._websocket_manager.touch(subscriber)
+        if text == "ping":
+            return "pong"
+        try:
+            message = json.loads(text)
+        except (json.JSONDecodeError, TypeError):
+            return None
+        if not isinstance(message, dict) or message.get("type") != "sync":
+            return None
+
+        since_version = int(message.get("since_version") or 0)
+        subscriber.delivered_version = since_version
+        if self.get_changes_since(subscriber.session_id, since_version) is None:
+            return json.dumps({
+                "type": "html_unchanged",
+                "data": {"session_id": subscriber.session_id, "version": since_version},
+            })
+        await self.send_latest(subscriber.session_id, subscriber)
+        return None
+
+    async def publish_html_delta(self, session_id: str, delta: str, seq: int) -> bool:
+        """生成途中のHTML差分をWebSocket経由で配信（保存はしない）
+
+        完成したHTMLはstore_html_artifactで "html_artifact" として配信される。
+        """
+        await self._broadcast({"kind": "delta", "session_id": session_id, "delta": delta, "seq": seq})
+        return await self._send_delta_locally(session_id, delta, seq) or self._broadcast_backend is not None
+
+    async def _send_delta_locally(self, session_id: str, delta: str, seq: int) -> bool:
+        if not self._websocket_manager.is_connected(session_id):
+            return False
+        message = {
+            "type": "html_delta",
+            "data": {"session_id": session_id, "seq": seq, "delta": delta},
+        }
+        return await self._websocket_manager.send_message(session_id, message)
 
     def get_artifact(self, session_id: str) -> Optional[HtmlArtifact]:
         """指定セッションの最新Artifactを取得"""
-        return self._artifacts.get(session_id)
+        return self._store.get(session_id)
+
+    async def wait_for_artifact(
+        self, session_id: str, since_version: int, timeout: float
+    ) -> Optional[HtmlArtifact]:
+        """
+        since_versionより新しいArtifactが保存されるまで最大timeout秒待つ（ロングポーリング用）
+
+        Returns:
+            新しいArtifact。期限までに届かなかった場合はNone
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            artifact = self._store.get(session_id)
+            if artifact is not None and artifact.version > since_version:
+                return artifact
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            event = self._artifact_events.setdefault(session_id, asyncio.Event())
+            self._artifact_waiters[session_id] = self._artifact_waiters.get(session_id, 0) + 1
+            try:
+                await asyncio.wait_for(event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                waiters = self._artifact_waiters.pop(session_id) - 1
+                if waiters > 0:
+                    self._artifact_waiters[session_id] = waiters
+                else:
+                    self._artifact_events.pop(session_id, None)
 
     def get_all_artifacts(self) -> Dict[str, HtmlArtifact]:
         """全てのArtifactを取得（デバッグ用）"""
-        return self._artifacts.copy()
+        artifacts = {}
+        for session_id in self._store.session_ids():
+            artifact = self._store.get(session_id)
+            if artifact is not None:
+                artifacts[session_id] = artifact
+        return artifacts
 
     def clear_session_artifacts(self, session_id: str):
         """指定セッションのArtifactをクリア"""
-        if session_id in self._artifacts:
-            del self._artifacts[session_id]
+        if self._store.delete(session_id):
             logger.info(f"Artifacts cleared for session: {session_id}")
 
+    def get_metrics(self) -> Dict[str, Dict[str, int]]:
+        """ストアの使用量・ヒット/ミス/退避数とWebSocket配信の状況"""
+        return {"store": self._store.get_metrics(), "websocket": self._websocket_manager.get_metrics()}
+
 
 # グローバルシングルトンインスタンス
-artifact_manager = ArtifactManager()
+artifact_manager = ArtifactManager(broadcast_backend=create_artifact_broadcast_backend())
@@ -0,0 +1,198 @@
+"""
+チャット実行（ADK invocation）のセッション単位の管理
+同じセッションに対する /adk/chat/stream の同時実行（二重送信・再接続など）でセッション状態が壊れないようにする
+
+- 同一セッションの実行は1つずつ順番に行い、待ち行列は max_pending 件まで（超えた場合はChatSessionBusyError）
+- 実行中または待機中の実行と同じメッセージが届いた場合は新たに実行せず、その実行のイベントストリームに合流する
+  （再接続したクライアントは同じメッセージを送り直すことで実行中のストリームに再接続できる）
+- 各フレームには "<実行ID>:<連番>" のSSE idを付けて実行ごとのリングバッファに保持する。
+  実行はHTTP接続から切り離して最後まで続け、Last-Event-ID付きで再接続したクライアントには
+  取りこぼしたフレームから再送する（完了した実行も retention_seconds の間は再送できる）
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FrameSource = Callable[[], AsyncIterator[Dict]]
+
+
+class ChatSessionBusyError(Exception):
+    """セッションの待ち行列が一杯で新しい実行を受け付けられない"""
+
+
+@dataclass
+class ChatRun:
+    """1回のチャット実行と、そのSSEフレームの配信先"""
+
+    id: str
+    key: Tuple[str, str]
+    message: str
+    # 再接続したクライアントに送り直すためのフレーム（(連番, フレーム) のリングバッファ）
+    frames: Deque[Tuple[int, Dict]] = field(default_factory=deque)
+    listeners: List[asyncio.Queue] = field(default_factory=list)
+    done: bool = False
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    last_seq: int = 0
+
+    def publish(self, frame: Dict):
+        self.last_seq += 1
+        frame = {**frame, "id": f"{self.id}:{self.last_seq}"}
+        self.frames.append((self.last_seq, frame))
+        for queue in self.listeners:
+            queue.put_nowait(frame)
+
+    def finish(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        for queue in self.listeners:
+            queue.put_nowait(None)
+
+    def attach(self, after_seq: int = 0) -> asyncio.Queue:
+        """after_seqより後のフレームを積んだ受信キューを登録"""
+        queue: asyncio.Queue = asyncio.Queue()
+        if self.frames and self.frames[0][0] > after_seq + 1:
+            # リングバッファから溢れて再送できないフレームがある
+            logger.warning(f"チャット実行 {self.id}: {after_seq + 1}〜{self.frames[0][0] - 1} のフレームは再送できません")
+            queue.put_nowait({"event": "replay_gap", "data": '{"type": "replay_gap"}'})
+        for seq, frame in self.frames:
+            if seq > after_seq:
+                queue.put_nowait(frame)
+        if self.done:
+            queue.put_nowait(None)
+        self.listeners.append(queue)
+        return queue
+
+
+class ChatRunManager:
+    """セッションごとのチャット実行の直列化と、同一メッセージの合流"""
+
+    def __init__(self, max_pending: int = 1, max_frames: int = 2000, retention_seconds: float = 120.0):
+        self.max_pending = max_pending
+        self.max_frames = max_frames
+        self.retention_seconds = retention_seconds
+        # (ユーザーID, セッションID) -> 実行中・待機中の実行（開始順）
+        self._runs: Dict[Tuple[str, str], List[ChatRun]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # 実行ID -> 完了した実行（再送用に一定時間保持。完了順）
+        self._finished: "OrderedDict[str, ChatRun]" = OrderedDict()
+        self.stats = {"started": 0, "coalesced": 0, "rejected": 0, "cancelled": 0, "detached": 0, "resumed": 0}
+
+    def _prune_finished(self):
+        now = time.monotonic()
+        while self._finished:
+            run = next(iter(self._finished.values()))
+            if now - run.finished_at <= self.retention_seconds:
+                break
+            self._finished.popitem(last=False)
+
+    def resume(self, user_id: str, session_id: str, last_event_id: Optional[str]) -> Optional[Tuple[ChatRun, int]]:
+        """
+        Last-Event-IDから再接続先の実行と再送開始位置を探す
+
+        Returns:
+            (実行, 受信済みの連番)。該当する実行が無い場合はNone
+        """
+        if not last_event_id or ":" not in last_event_id:
+            return None
+        run_id, _, seq = last_event_id.rpartition(":")
+        self._prune_finished()
+        candidates = list(self._runs.get((user_id, session_id), [])) + [self._finished.get(run_id)]
+        for run in candidates:
+            # 他のユーザー・セッションの実行には再接続させない
+            if run is not None and run.id == run_id and run.key == (user_id, session_id):
+                self.stats["resumed"] += 1
+                logger.info(f"🔌 チャット実行に再接続: session={session_id}, run={run_id}, after={seq}")
+                return run, int(seq) if seq.isdigit() else 0
+        return None
+
+    def submit(self, user_id: str, session_id: str, message: str, source: FrameSource) -> ChatRun:
+        """
+        チャット実行を登録（同じメッセージが実行中・待機中なら既存の実行を返す）
+
+        Raises:
+            ChatSessionBusyError: 実行中の分に加えて max_pending 件が待機している場合
+        """
+        key = (user_id, session_id)
+        runs = self._runs.setdefault(key, [])
+        normalized = message.strip()
+        for run in runs:
+            if run.message == normalized and not run.done:
+                self.stats["coalesced"] += 1
+                logger.info(f"🔁 同一メッセージの実行に合流: session={session_id}, run={run.id}")
+                return run
+
+        if len(runs) > self.max_pending:
+            self.stats["rejected"] += 1
+            raise ChatSessionBusyError(f"Session {session_id} already has {len(runs)} chat runs in progress")
+
+        run = ChatRun(id=uuid.uuid4().hex, key=key, message=normalized, frames=deque(maxlen=self.max_frames))
+        runs.append(run)
+        run.task = asyncio.create_task(self._execute(run, source))
+        self.stats["started"] += 1
+        return run
+
+    async def _execute(self, run: ChatRun, source: FrameSource):
+        lock = self._locks.setdefault(run.key, asyncio.Lock())
+        try:
+            # 同じセッションの前の実行が終わるまで待つ
+            async with lock:
+                async for frame in source():
+                    run.publish(frame)
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            logger.info(f"チャット実行をキャンセル: session={run.key[1]}, run={run.id}")
+        except Exception as e:
+            logger.error(f"チャット実行エラー: {e}")
+        finally:
+            run.finish()
+            self._finished[run.id] = run
+            self._prune_finished()
+            runs = self._runs.get(run.key, [])
+            if run in runs:
+                runs.remove(run)
+            if not runs:
+                self._runs.pop(run.key, None)
+                self._locks.pop(run.key, None)
+
+    async def stream(self, run: ChatRun, after_seq: int = 0) -> AsyncIterator[Dict]:
+        """
+        実行のSSEフレームをafter_seqより後から順に返す
+
+        クライアントが切断しても実行はキャンセルせず最後まで続ける（再接続時に再送する）。
+        """
+        queue = run.attach(after_seq)
+        try:
+            while True:
+                frame = await queue.get()
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            run.listeners.remove(queue)
+            if not run.listeners and not run.done:
+                self.stats["detached"] += 1
+                logger.info(f"チャット実行はクライアント切断後も継続: session={run.key[1]}, run={run.id}")
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._runs),
+            "runs": sum(len(runs) for runs in self._runs.values()),
+            "retained": len(self._finished),
+            **self.stats,
+        }
+
+
+# グローバルシングルトンインスタンス
+chat_run_manager = ChatRunManager(
+    max_pending=int(os.getenv("CHAT_MAX_PENDING_PER_SESSION", "1")),
+    max_frames=int(os.getenv("CHAT_RUN_BUFFER_FRAMES", "2000")),
+    retention_seconds=float(os.getenv("CHAT_RUN_RETENTION_SECONDS", "120")),
+)
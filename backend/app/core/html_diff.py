@@ -0,0 +1,50 @@
+"""
+HTML Artifactの差分（行単位のテキストパッチ）
+改訂時に全文ではなく変更部分だけをWebSocketで送るために使用する
+
+パッチ形式: [[開始行, 終了行, [置き換え後の行, ...]], ...]
+（旧HTMLの行 [開始行, 終了行) を置き換え後の行で置き換える。開始行の昇順）
+"""
+import difflib
+import json
+from typing import List, Optional
+
+Patch = List[list]
+
+
+def make_html_patch(old_html: str, new_html: str) -> Patch:
+    """旧HTMLから新HTMLへの行単位パッチを生成"""
+    old_lines = old_html.splitlines(keepends=True)
+    new_lines = new_html.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(a=old_lines, b=new_lines, autojunk=False)
+    return [
+        [i1, i2, new_lines[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def apply_html_patch(old_html: str, patch: Patch) -> str:
+    """パッチを旧HTMLに適用して新HTMLを復元"""
+    old_lines = old_html.splitlines(keepends=True)
+    result: List[str] = []
+    cursor = 0
+    for start, end, lines in patch:
+        result.extend(old_lines[cursor:start])
+        result.extend(lines)
+        cursor = end
+    result.extend(old_lines[cursor:])
+    return "".join(result)
+
+
+def make_compact_patch(old_html: str, new_html: str, max_ratio: float = 0.5) -> Optional[Patch]:
+    """
+    全文を送るより十分小さい場合のみパッチを返す
+
+    Returns:
+        パッチ。シリアライズ後のサイズが新HTMLの max_ratio 倍を超える場合はNone（全文送信にフォールバック）
+    """
+    patch = make_html_patch(old_html, new_html)
+    if len(json.dumps(patch, ensure_ascii=False)) > len(new_html) * max_ratio:
+        return None
+    return patch
@@ -5,19 +5,52 @@ FastAPI Rate Limiting & API Security
 
 import logging
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from typing import Any, Dict, List
 
 from fastapi import HTTPException, Request
 
 
+class _WindowCounter:
+    """1つの識別子のスライディングウィンドウカウンター（リクエスト数によらず固定サイズ）"""
+
+    __slots__ = ("window", "window_start", "previous_count", "current_count", "last_seen")
+
+    def __init__(self, window: int, now: float):
+        self.window = window
+        self.window_start = now
+        self.previous_count = 0
+        self.current_count = 0
+        self.last_seen = now
+
+    def estimate(self, now: float) -> float:
+        """直近window秒のリクエスト数の推定値（前の窓の件数を経過時間で按分）"""
+        elapsed_windows = int((now - self.window_start) // self.window)
+        if elapsed_windows >= 1:
+            # 窓を進める（2つ以上進んだ場合は前の窓も空）
+            self.previous_count = self.current_count if elapsed_windows == 1 else 0
+            self.current_count = 0
+            self.window_start += elapsed_windows * self.window
+        weight = 1 - (now - self.window_start) / self.window
+        return self.previous_count * weight + self.current_count
+
+
 class InMemoryRateLimiter:
-    """インメモリレート制限（Redis不使用版）"""
+    """インメモリレート制限（Redis不使用版）
 
-    def __init__(self):
-        self.requests: Dict[str, deque] = defaultdict(lambda: deque())
+    識別子ごとにスライディングウィンドウカウンター（前の窓と現在の窓の件数のみ）を持つため、
+    1識別子あたりのメモリはリクエスト数によらず一定。
+    一定時間アクセスのない識別子は定期的に削除し、識別子数も max_keys 件（LRU）までに抑える。
+    """
+
+    def __init__(self, max_keys: int = 100_000, sweep_interval: float = 60.0):
+        self.requests: "OrderedDict[str, _WindowCounter]" = OrderedDict()
         self.blocked_ips: Dict[str, float] = {}
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.time()
+        self.evictions = 0
         self.logger = logging.getLogger(__name__)
 
     def is_allowed(
@@ -35,6 +68,8 @@ class InMemoryRateLimiter:
             (許可可否, メタデータ)
         """
         current_time = time.time()
+        if current_time - self._last_sweep >= self.sweep_interval:
+            self._sweep(current_time)
 
         # ブロック中のIPチェック
         if identifier in self.blocked_ips:
@@ -49,24 +84,22 @@ class InMemoryRateLimiter:
                 # ブロック期間終了
                 del self.blocked_ips[identifier]
 
-        # 古いリクエストを削除
-        request_times = self.requests[identifier]
-        while request_times and request_times[0] < current_time - window:
-            request_times.popleft()
+        counter = self.requests.get(identifier)
+        if counter is None or counter.window != window:
+            counter = _WindowCounter(window, current_time)
+            self.requests[identifier] = counter
+            if len(self.requests) > self.max_keys:
+                # 最も長くアクセスのない識別子を削除
+                self.requests.popitem(last=False)
+                self.evictions += 1
+        self.requests.move_to_end(identifier)
+        counter.last_seen = current_time
 
         # レート制限チェック
-        if len(request_times) >= limit:
-            # 連続違反の場合は一時ブロック
-            if len(request_times) >= limit * 2:
-                self.blocked_ips[identifier] = current_time + 300  # 5分間ブロック
-                
-                # ログインジェクション対策としてIPをサニタイズ
-                safe_identifier = str(identifier).replace('\n', '').replace('\r', '')[:50]
-                self.logger.warning(
-                    f"IP {safe_identifier} blocked for 5 minutes due to excessive requests"
-                )
-
-            remaining_time = int(window - (current_time - request_times[0]))
+        estimated = counter.estimate(current_time)
+        if estimated + 1 > limit:
+            # 現在の窓が終わると前の窓の件数の重みが下がり始める
+            remaining_time = max(1, int(counter.window_start + window - current_time))
             return False, {
                 "blocked": False,
                 "limit": limit,
@@ -76,15 +109,32 @@ class InMemoryRateLimiter:
             }
 
         # リクエストを記録
-        request_times.append(current_time)
+        counter.current_count += 1
 
         return True, {
             "blocked": False,
             "limit": limit,
-            "remaining": limit - len(request_times),
+            "remaining": int(limit - estimated - 1),
             "reset_time": window,
         }
 
+    def _sweep(self, current_time: float):
+        """2窓分以上アクセスのない識別子と期限切れのブロックを削除"""
+        self._last_sweep = current_time
+        idle = [
+            identifier
+            for identifier, counter in self.requests.items()
+            if current_time - counter.last_seen >= counter.window * 2
+        ]
+        for identifier in idle:
+            del self.requests[identifier]
+        expired = [ip for ip, until in self.blocked_ips.items() if until <= current_time]
+        for ip in expired:
+            del self.blocked_ips[ip]
+        self.evictions += len(idle)
+        if idle:
+            self.logger.info(f"Rate limiter sweep: evicted {len(idle)} idle keys ({len(self.requests)} remaining)")
+
 
 class APISecurityMonitor:
     """API セキュリティ監視"""
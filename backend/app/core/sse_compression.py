@@ -0,0 +1,74 @@
+"""
+SSE（text/event-stream）レスポンスのgzip圧縮
+StarletteのGZipMiddlewareはSSEを圧縮対象から除外するため、イベントごとに
+Z_SYNC_FLUSHして遅延なく届くように圧縮するミドルウェアを用意する
+
+クライアントが Accept-Encoding: gzip を送った場合のみ圧縮する。
+途中のプロキシがgzipのストリームをバッファしてしまう環境では SSE_COMPRESSION=off で無効化する。
+"""
+import logging
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+SSE_COMPRESSION_ENABLED = os.getenv("SSE_COMPRESSION", "auto").lower() != "off"
+
+# 圧縮前後のバイト数（/metrics 用）
+sse_compression_stats = {"streams": 0, "raw_bytes": 0, "compressed_bytes": 0}
+
+
+class SSECompressionMiddleware:
+    """text/event-stream のレスポンスをイベント単位でフラッシュしながらgzip圧縮する"""
+
+    def __init__(self, app: ASGIApp, enabled: bool = SSE_COMPRESSION_ENABLED, level: int = 6):
+        self.app = app
+        self.enabled = enabled
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            not self.enabled
+            or scope["type"] != "http"
+            or "gzip" not in Headers(scope=scope).get("accept-encoding", "")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        compressor = None
+
+        async def send_compressed(message: Message):
+            nonlocal compressor
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=list(message.get("headers", [])))
+                if headers.get("content-type", "").startswith("text/event-stream") and "content-encoding" not in headers:
+                    compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    headers["Content-Encoding"] = "gzip"
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                    message = {**message, "headers": headers.raw}
+                    sse_compression_stats["streams"] += 1
+            elif message["type"] == "http.response.body" and compressor is not None:
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                data = compressor.compress(body)
+                # イベントがプロキシやクライアント側で溜まらないよう、チャンクごとにフラッシュする
+                data += compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+                sse_compression_stats["raw_bytes"] += len(body)
+                sse_compression_stats["compressed_bytes"] += len(data)
+                message = {**message, "body": data}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+def get_sse_compression_metrics():
+    raw = sse_compression_stats["raw_bytes"]
+    return {
+        **sse_compression_stats,
+        "ratio": round(sse_compression_stats["compressed_bytes"] / raw, 3) if raw else None,
+    }
@@ -0,0 +1,97 @@
+"""
+チャットストリーム（/api/v1/adk/chat/stream）のSSEイベント変換
+ADKイベント全体（関数呼び出しの引数・応答、state_deltaに入ったHTMLなど）ではなく、
+フロントエンドが使うフィールドだけに絞ったイベントを送る
+
+- SSE_EVENT_FORMAT=compact（デフォルト）: テキストパートと関数名のみ
+- SSE_EVENT_FORMAT=full: 従来通り event.model_dump_json() をそのまま送る
+"""
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SSE_EVENT_FORMAT = os.getenv("SSE_EVENT_FORMAT", "compact").lower()
+
+# 完成HTMLの参照先（ポーリング用エンドポイント）
+ARTIFACT_URL_TEMPLATE = "/api/v1/artifacts/html/{session_id}"
+
+
+def compact_event_payload(event) -> Optional[Dict]:
+    """
+    ADKイベントをフロントエンド向けの最小限の形に変換
+
+    フロントエンドは content.parts[].text だけを読むため、それ以外は関数名と
+    エラー・ターン完了の情報のみ残す。送る内容がなければNone。
+    """
+    parts = []
+    content = getattr(event, "content", None)
+    for part in (content.parts or []) if content else []:
+        if part.text:
+            parts.append({"text": part.text})
+        elif part.function_call:
+            parts.append({"function_call": {"name": part.function_call.name}})
+        elif part.function_response:
+            parts.append({"function_response": {"name": part.function_response.name}})
+
+    error_message = getattr(event, "error_message", None)
+    if not parts and not error_message:
+        return None
+
+    payload = {
+        "id": event.id,
+        "author": event.author,
+        "content": {"role": content.role if content else "model", "parts": parts},
+    }
+    if getattr(event, "turn_complete", None):
+        payload["turn_complete"] = True
+    if error_message:
+        payload["error_code"] = getattr(event, "error_code", None)
+        payload["error_message"] = error_message
+    return payload
+
+
+def event_frame(event) -> Optional[Dict]:
+    """ADKイベントをSSEフレームに変換（送る内容がなければNone）"""
+    if SSE_EVENT_FORMAT == "full":
+        return {"data": event.model_dump_json()}
+    payload = compact_event_payload(event)
+    if payload is None:
+        return None
+    return {"data": json.dumps(payload, ensure_ascii=False)}
+
+
+def html_stream_frame(event, session_id: str, artifact_lookup: Optional[Callable] = None) -> Optional[Dict]:
+    """
+    LayoutAgentのHTML差分/完成イベントをSSEフレームに変換（該当しなければNone）
+
+    完成HTMLがArtifactストアに保存済みの場合は、本文の代わりに参照（URL・バージョン・ETag）を送る。
+    本文はWebSocketまたはポーリングで取得される。
+    """
+    metadata = event.custom_metadata or {}
+    if "html_delta" in metadata:
+        frame_type, html = "html_delta", metadata["html_delta"]
+    elif "html_complete" in metadata:
+        frame_type, html = "html_complete", metadata["html_complete"]
+    else:
+        return None
+    payload = {
+        "type": frame_type,
+        "session_id": session_id,
+        "seq": metadata.get("seq", 0),
+        "data": html,
+    }
+
+    if frame_type == "html_complete" and artifact_lookup is not None and SSE_EVENT_FORMAT != "full":
+        artifact = artifact_lookup(session_id)
+        if artifact is not None and artifact.content == html:
+            del payload["data"]
+            payload["artifact"] = {
+                "url": ARTIFACT_URL_TEMPLATE.format(session_id=session_id),
+                "version": artifact.version,
+                "etag": artifact.etag,
+                "size": len(html),
+            }
+    return {"event": frame_type, "data": json.dumps(payload, ensure_ascii=False)}
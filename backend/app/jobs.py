@@ -0,0 +1,78 @@
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
+
+from services.job_service import JobQueueFullError, job_manager
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["Background Jobs"],
+)
+
+DEFAULT_NEWSLETTER_MESSAGE = "これまでの内容で学級通信を作成してください。"
+
+
+class NewsletterJobRequest(BaseModel):
+    # フロントエンドと同じ "user_id:session_id" 形式も受け付ける
+    session_id: str
+    message: str = DEFAULT_NEWSLETTER_MESSAGE
+
+
+def _require_user(x_user_id: Optional[str]) -> str:
+    if not x_user_id:
+        raise HTTPException(status_code=400, detail="X-User-ID header is required")
+    return x_user_id
+
+
+async def _get_owned_job(job_id: str, user_id: str):
+    job = await job_manager.get(job_id)
+    # 他のユーザーのジョブは存在しないものとして扱う
+    if job is None or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
+
+
+@router.post("/newsletter", status_code=202, summary="学級通信の生成をバックグラウンドジョブとして開始")
+async def create_newsletter_job(req: NewsletterJobRequest, x_user_id: str = Header(None, alias="X-User-ID")):
+    """
+    学級通信の生成ジョブを登録し、ジョブレコードを返す
+
+    生成はリクエストの寿命と切り離して実行される。進捗は /jobs/{job_id}/events、
+    結果は /jobs/{job_id} で取得する。待ち行列が一杯の場合は503。
+    """
+    user_id = _require_user(x_user_id)
+    session_id = req.session_id.split(":", 1)[1] if ":" in req.session_id else req.session_id
+    try:
+        job = await job_manager.submit("newsletter", user_id, session_id, req.message)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    return job.to_dict()
+
+
+@router.get("/{job_id}", summary="ジョブの状態と結果を取得")
+async def get_job(job_id: str, x_user_id: str = Header(None, alias="X-User-ID")):
+    job = await _get_owned_job(job_id, _require_user(x_user_id))
+    return job.to_dict()
+
+
+@router.get("/{job_id}/events", summary="ジョブの進捗をSSEで購読")
+async def stream_job_events(
+    job_id: str,
+    x_user_id: str = Header(None, alias="X-User-ID"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """記録済みの進捗（Last-Event-IDより後）を送ってから、完了までライブで配信する"""
+    await _get_owned_job(job_id, _require_user(x_user_id))
+    after_seq = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+
+    async def event_generator():
+        async for entry in job_manager.subscribe(job_id, after_seq):
+            frame = {"event": entry["event"], "data": json.dumps(entry, ensure_ascii=False)}
+            if "seq" in entry:
+                frame["id"] = str(entry["seq"])
+            yield frame
+
+    return EventSourceResponse(event_generator())
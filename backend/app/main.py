@@ -1,31 +1,51 @@
 import json
 import os
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import Optional
 
 import google.genai.types as genai_types
 from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
-from google.adk.sessions.in_memory_session_service import InMemorySessionService
 from pydantic import BaseModel
 from sse_starlette.sse import EventSourceResponse
 
 # 実行対象のエージェントを直接インポート
 from agents.main_conversation_agent.agent import root_agent
 from app import classroom as classroom_api
+from app import jobs as jobs_api
 from app import pdf as pdf_api
 from app import stt as stt_api
 from app import upload as upload_api
 from app import user_dictionary as user_dictionary_api
 from app.api.v1.endpoints import documents as documents_api
 from app.auth import User, get_current_user, initialize_firebase_app
+from services.session_service import create_session_service
 
 # HTML Artifact 管理
 from app.core.artifact_manager import artifact_manager
+from app.core.chat_runs import ChatSessionBusyError, chat_run_manager
+from services.job_service import Job, job_manager
+from app.core.sse_compression import SSECompressionMiddleware, get_sse_compression_metrics
+from app.core.sse_events import event_frame, html_stream_frame
+from agents.layout_agent.response_cache import layout_response_cache
+from agents.shared.history_compaction import token_usage_stats
+from agents.shared.llm_limiter import PRIORITY_BATCH, llm_limiter, llm_priority
+from agents.shared.model_resilience import get_resilience_metrics, llm_deadline
+from agents.shared.model_router import get_model_route_metrics
+from agents.shared.preflight import get_preflight_metrics
+from services.user_settings_service import user_settings_cache
 
 # --- 環境設定 ---
 ENVIRONMENT = os.getenv("ENVIRONMENT", "production")
+# ロングポーリングで1リクエストを待たせる最大秒数
+ARTIFACT_LONG_POLL_MAX_SECONDS = float(os.getenv("ARTIFACT_LONG_POLL_MAX_SECONDS", "30"))
+# チャット1回分のモデル呼び出し（リトライを含む）の期限
+CHAT_LLM_DEADLINE_SECONDS = float(os.getenv("CHAT_LLM_DEADLINE_SECONDS", "240"))
 
 # --- FastAPIのライフサイクル管理 ---
 @asynccontextmanager
@@ -33,9 +53,21 @@ async def lifespan(app: FastAPI):
     # アプリケーション起動時に実行
     print("🚀 Application startup...")
     initialize_firebase_app()
+    # 他のインスタンスで生成されたArtifactの受信を開始
+    await artifact_manager.start_broadcast()
+    # 学級通信生成などのバックグラウンドジョブのワーカーを起動
+    job_manager.start()
     yield
     # アプリケーション終了時に実行
     print("👋 Application shutdown...")
+    await job_manager.stop()
+    # 未反映のセッション書き込みを永続ストアへ反映
+    if hasattr(session_service, "close"):
+        await session_service.close()
+    # 別プロセス配信用のHTTP接続プールを閉じる
+    from agents.layout_agent.deliver_html_tool import html_delivery_tool
+    await html_delivery_tool.aclose()
+    await artifact_manager.close_broadcast()
 
 # --- FastAPIアプリの初期化 ---
 app = FastAPI(
@@ -62,11 +94,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 条件付きGET（If-None-Match）のためにETagをブラウザから読めるようにする
+    expose_headers=["ETag"],
 )
+# チャットストリーム（SSE）をgzip圧縮（Accept-Encodingで交渉）
+app.add_middleware(SSECompressionMiddleware)
 print(f"✅ CORS settings applied for origins: {origins} and regex.")
 
 # --- ADK v1.0.0手動セットアップ ---
-session_service = InMemorySessionService()
+# セッションは永続ストアに保存し、インスタンス間で共有する（SESSION_BACKENDで切り替え）
+session_service = create_session_service()
 runner = Runner(
     app_name="gakkoudayori-agent", agent=root_agent, session_service=session_service
 )
@@ -82,6 +119,7 @@ app.include_router(upload_api.router, prefix="/api/v1")
 app.include_router(user_dictionary_api.router, prefix="/api/v1")
 app.include_router(documents_api.router, prefix="/api/v1")
 app.include_router(user_settings_api.router, prefix="/api/v1")
+app.include_router(jobs_api.router, prefix="/api/v1")
 
 
 # --- モデル定義 ---
@@ -100,15 +138,104 @@ class HtmlArtifactRequest(BaseModel):
 
 
 # --- ADKチャットエンドポイント ---
+async def _chat_event_stream(user_id: str, session_id: str, client_session_id: str, message: str):
+    """チャット1回分（ADK invocation）を実行し、SSEフレームを返す
+
+    client_session_id はフロントエンドが使う "user_id:session_id" 形式のセッションID。
+    """
+    # この実行中のモデル呼び出し（リトライを含む）はこの期限までに終える
+    llm_deadline.set(time.monotonic() + CHAT_LLM_DEADLINE_SECONDS)
+    try:
+        print(
+            f"🔧 Processing ADK chat stream for user: {user_id}, session: {session_id}"
+        )
+
+        # セッションが存在しない場合は作成
+        existing_session = await session_service.get_session(
+            app_name="gakkoudayori-agent", user_id=user_id, session_id=session_id
+        )
+
+        if not existing_session:
+            print(
+                f"📝 Creating new session for user: {user_id}, session: {session_id}"
+            )
+            # セッション状態にユーザーIDとメタデータを保存（作成時に渡して永続化）
+            new_session = await session_service.create_session(
+                app_name="gakkoudayori-agent",
+                user_id=user_id,
+                session_id=session_id,
+                state={
+                    "user_id": user_id,
+                    "session_created_at": datetime.now().isoformat(),
+                    "user_isolation_enabled": True,
+                },
+            )
+            if new_session and hasattr(new_session, 'state'):
+                print(f"✅ User ID and metadata saved to new session: {user_id}")
+
+                # ユーザー固有のディレクトリ作成を確実に実行
+                from agents.shared.file_utils import get_user_artifacts_dir
+                try:
+                    user_dir = get_user_artifacts_dir(user_id)
+                    print(f"✅ User artifacts directory created: {user_dir}")
+                except Exception as dir_error:
+                    print(f"⚠️ User artifacts directory creation failed: {dir_error}")
+        else:
+            # 既存セッションにもユーザーIDとメタデータを更新
+            if hasattr(existing_session, 'state'):
+                existing_session.state["user_id"] = user_id
+                existing_session.state["session_updated_at"] = datetime.now().isoformat()
+                existing_session.state["user_isolation_enabled"] = True
+                print(f"✅ User ID and metadata updated in existing session: {user_id}")
+
+                # ユーザー固有のディレクトリが存在することを確認
+                from agents.shared.file_utils import get_user_artifacts_dir
+                try:
+                    user_dir = get_user_artifacts_dir(user_id)
+                    print(f"✅ User artifacts directory verified: {user_dir}")
+                except Exception as dir_error:
+                    print(f"⚠️ User artifacts directory verification failed: {dir_error}")
+
+        # ADKのrun_asyncを呼び出してイベントストリームを取得
+        # SSEモードでLayoutAgentの生成途中HTMLを受け取る
+        async for event in runner.run_async(
+            user_id=user_id,
+            session_id=session_id,
+            new_message=genai_types.Content(
+                role="user", parts=[genai_types.Part(text=message)]
+            ),
+            run_config=RunConfig(streaming_mode=StreamingMode.SSE),
+        ):
+            stream_frame = html_stream_frame(event, client_session_id, artifact_manager.get_artifact)
+            if stream_frame:
+                yield stream_frame
+                continue
+            if event.partial:
+                # テキストの途中経過は従来通り確定イベントでまとめて送る
+                continue
+            # フロントエンドが使うフィールドだけに絞ってJSON文字列に変換
+            frame = event_frame(event)
+            if frame:
+                yield frame
+
+    except Exception as e:
+        print(f"❌ Error during streaming: {e}")
+        # エラー情報をフロントエンドに送信
+        error_data = {"type": "error", "message": f"An error occurred: {str(e)}"}
+        yield {"data": json.dumps(error_data), "event": "error"}
+
+
 @app.post("/api/v1/adk/chat/stream")
 async def adk_chat_stream(
     req: AdkChatRequest,
-    x_user_id: str = Header(None, alias="X-User-ID")
+    x_user_id: str = Header(None, alias="X-User-ID"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
     # current_user: User = Depends(get_current_user) # 将来の認証完全実装用
 ):
     """
     ADK v1.0.0互換のチャットストリーミングエンドポイント
     X-User-IDヘッダーからユーザーIDを取得します。
+    Last-Event-IDヘッダー付きの再接続では、実行中（または直前に完了した）実行の取りこぼしたイベントから再送します。
     """
 
     # X-User-IDヘッダーからユーザーIDを取得
@@ -125,74 +252,66 @@ async def adk_chat_stream(
         # 分割できない場合はデフォルト値を使用
         session_id = "default"
 
-    async def event_generator():
-        try:
-            print(
-                f"🔧 Processing ADK chat stream for user: {user_id}, session: {session_id}"
-            )
-
-            # セッションが存在しない場合は作成
-            existing_session = await session_service.get_session(
-                app_name="gakkoudayori-agent", user_id=user_id, session_id=session_id
-            )
-
-            if not existing_session:
-                print(
-                    f"📝 Creating new session for user: {user_id}, session: {session_id}"
-                )
-                new_session = await session_service.create_session(
-                    app_name="gakkoudayori-agent",
-                    user_id=user_id,
-                    session_id=session_id,
-                )
-                # セッション状態にユーザーIDとメタデータを保存
-                if new_session and hasattr(new_session, 'state'):
-                    new_session.state["user_id"] = user_id
-                    new_session.state["session_created_at"] = datetime.now().isoformat()
-                    new_session.state["user_isolation_enabled"] = True
-                    print(f"✅ User ID and metadata saved to new session: {user_id}")
-                    
-                    # ユーザー固有のディレクトリ作成を確実に実行
-                    from agents.shared.file_utils import get_user_artifacts_dir
-                    try:
-                        user_dir = get_user_artifacts_dir(user_id)
-                        print(f"✅ User artifacts directory created: {user_dir}")
-                    except Exception as dir_error:
-                        print(f"⚠️ User artifacts directory creation failed: {dir_error}")
-            else:
-                # 既存セッションにもユーザーIDとメタデータを更新
-                if hasattr(existing_session, 'state'):
-                    existing_session.state["user_id"] = user_id
-                    existing_session.state["session_updated_at"] = datetime.now().isoformat()
-                    existing_session.state["user_isolation_enabled"] = True
-                    print(f"✅ User ID and metadata updated in existing session: {user_id}")
-                    
-                    # ユーザー固有のディレクトリが存在することを確認
-                    from agents.shared.file_utils import get_user_artifacts_dir
-                    try:
-                        user_dir = get_user_artifacts_dir(user_id)
-                        print(f"✅ User artifacts directory verified: {user_dir}")
-                    except Exception as dir_error:
-                        print(f"⚠️ User artifacts directory verification failed: {dir_error}")
-
-            # ADKのrun_asyncを呼び出してイベントストリームを取得
-            async for event in runner.run_async(
-                user_id=user_id,
-                session_id=session_id,
-                new_message=genai_types.Content(
-                    role="user", parts=[genai_types.Part(text=req.message)]
-                ),
-            ):
-                # フロントエンドがデシリアライズできるよう、eventオブジェクトをJSON文字列に変換
-                yield {"data": event.model_dump_json()}
-
-        except Exception as e:
-            print(f"❌ Error during streaming: {e}")
-            # エラー情報をフロントエンドに送信
-            error_data = {"type": "error", "message": f"An error occurred: {str(e)}"}
-            yield {"data": json.dumps(error_data), "event": "error"}
+    # 切断前に受信したイベントIDがあれば、新たに実行せず続きから再送する
+    resumed = chat_run_manager.resume(user_id, session_id, last_event_id)
+    if resumed:
+        run, after_seq = resumed
+        return EventSourceResponse(chat_run_manager.stream(run, after_seq))
+
+    # LLMの待ち行列が深すぎる場合は、実行を始める前にすぐ断る
+    if llm_limiter.should_shed():
+        retry_after = llm_limiter.retry_after()
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
 
-    return EventSourceResponse(event_generator())
+    # 同じセッションの実行は直列化し、実行中と同じメッセージは既存の実行に合流する
+    try:
+        run = chat_run_manager.submit(
+            user_id,
+            session_id,
+            req.message,
+            lambda: _chat_event_stream(user_id, session_id, req.session_id, req.message),
+        )
+    except ChatSessionBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    return EventSourceResponse(chat_run_manager.stream(run))
+
+
+# --- バックグラウンドジョブ ---
+async def _run_newsletter_job(job: Job, report):
+    """学級通信生成ジョブ: チャット実行として直列化して実行し、生成されたArtifactの参照を返す"""
+    # ジョブのLLM呼び出しは対話チャットより後回しにする（チャット実行のタスクにも引き継がれる）
+    llm_priority.set(PRIORITY_BATCH)
+    client_session_id = f"{job.user_id}:{job.session_id}"
+    previous = artifact_manager.get_artifact(client_session_id)
+    previous_version = previous.version if previous else 0
+
+    run = chat_run_manager.submit(
+        job.user_id,
+        job.session_id,
+        job.message,
+        lambda: _chat_event_stream(job.user_id, job.session_id, client_session_id, job.message),
+    )
+    async for frame in chat_run_manager.stream(run):
+        if frame.get("event") == "error":
+            raise RuntimeError(json.loads(frame["data"]).get("message", "chat run failed"))
+        await report(frame)
+
+    artifact = artifact_manager.get_artifact(client_session_id)
+    if artifact is None or artifact.version <= previous_version:
+        raise RuntimeError("学級通信のHTMLが生成されませんでした")
+    return {
+        "session_id": client_session_id,
+        "url": f"/api/v1/artifacts/html/{client_session_id}",
+        "version": artifact.version,
+        "etag": artifact.etag,
+    }
+
+
+job_manager.register("newsletter", _run_newsletter_job)
 
 
 # --- ヘルスチェックエンドポイント ---
@@ -217,6 +336,29 @@ def warmup():
         return {"status": "error", "error": str(e)}
 
 
+@app.get("/metrics")
+def metrics():
+    """インスタンス内のリソース使用状況（セッション数・保持バイト数など）"""
+    session_metrics = (
+        session_service.get_metrics() if hasattr(session_service, "get_metrics") else {}
+    )
+    return {
+        "environment": ENVIRONMENT,
+        "sessions": session_metrics,
+        "llm_tokens": dict(token_usage_stats),
+        "layout_cache": layout_response_cache.get_metrics(),
+        "model_routes": get_model_route_metrics(),
+        "user_settings_cache": user_settings_cache.get_metrics(),
+        "preflight": get_preflight_metrics(),
+        "artifacts": artifact_manager.get_metrics(),
+        "sse_compression": get_sse_compression_metrics(),
+        "chat_runs": chat_run_manager.get_metrics(),
+        "jobs": job_manager.get_metrics(),
+        "llm_limiter": llm_limiter.get_metrics(),
+        "llm_resilience": get_resilience_metrics(),
+    }
+
+
 # --- HTML Artifact エンドポイント ---
 @app.post("/api/v1/artifacts/html")
 async def receive_html_artifact(request: HtmlArtifactRequest):
@@ -241,34 +383,67 @@ async def receive_html_artifact(request: HtmlArtifactRequest):
 
 
 @app.websocket("/ws/artifacts/{session_id}")
-async def websocket_artifacts(websocket: WebSocket, session_id: str):
-    """HTML Artifactを配信するWebSocketエンドポイント"""
-    await artifact_manager.websocket_manager.connect(session_id, websocket)
+async def websocket_artifacts(websocket: WebSocket, session_id: str, since_version: Optional[int] = None):
+    """HTML Artifactを配信するWebSocketエンドポイント
+
+    接続時に保存済みのArtifactがあれば即座に送信する（再接続したクライアントがすぐ表示できる）。
+    since_versionを指定したクライアントには、以降の改訂を差分（html_patch）で配信する。
+    応答のない接続はWebSocketManagerのハートビートで回収される。
+    """
+    websocket_manager = artifact_manager.websocket_manager
+    subscriber = await websocket_manager.connect(session_id, websocket, since_version=since_version)
     try:
+        # 既存のArtifactがあれば送信（since_version指定時はそれ以降の変更のみ）
+        await artifact_manager.send_latest(session_id, subscriber)
+
         # WebSocket接続を維持
         while True:
-            # クライアントからのメッセージを待機（pingなど）
+            # クライアントからのメッセージを待機（ping・syncなど）
             data = await websocket.receive_text()
-            if data == "ping":
-                await websocket.send_text("pong")
+            reply = await artifact_manager.handle_client_message(subscriber, data)
+            if reply is not None:
+                # 返信も購読者の送信キュー経由で送る（送信タスクと同時に書き込まない）
+                websocket_manager.enqueue(subscriber, "reply", reply)
     except WebSocketDisconnect:
-        await artifact_manager.websocket_manager.disconnect(session_id)
+        await websocket_manager.disconnect(session_id, subscriber.id)
         print(f"WebSocket disconnected for session: {session_id}")
     except Exception as e:
         print(f"WebSocket error: {e}")
-        await artifact_manager.websocket_manager.disconnect(session_id)
+        await websocket_manager.disconnect(session_id, subscriber.id)
 
 
 @app.get("/api/v1/artifacts/html/{session_id}")
-async def get_html_artifact(session_id: str):
-    """指定セッションの最新HTML Artifactを取得（ポーリング用）"""
+async def get_html_artifact(
+    session_id: str,
+    wait: Optional[float] = None,
+    since_version: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    """指定セッションの最新HTML Artifactを取得（ポーリング用）
+
+    - If-None-Match が最新ArtifactのETagと一致する場合は 304 を返す
+    - wait と since_version を指定すると、since_version より新しいArtifactが保存されるまで
+      最大 wait 秒（上限 ARTIFACT_LONG_POLL_MAX_SECONDS）待ってから返す。届かなければ 304
+    """
     try:
-        artifact = artifact_manager.get_artifact(session_id)
+        if wait and since_version is not None:
+            timeout = min(wait, ARTIFACT_LONG_POLL_MAX_SECONDS)
+            artifact = await artifact_manager.wait_for_artifact(session_id, since_version, timeout)
+            if artifact is None:
+                return Response(status_code=304)
+        else:
+            artifact = artifact_manager.get_artifact(session_id)
+
         if artifact:
-            return {
-                "status": "found",
-                "artifact": artifact.to_dict()
-            }
+            if if_none_match == artifact.etag:
+                return Response(status_code=304, headers={"ETag": artifact.etag})
+            return JSONResponse(
+                content={
+                    "status": "found",
+                    "artifact": artifact.to_dict()
+                },
+                headers={"ETag": artifact.etag},
+            )
         else:
             return {
                 "status": "not_found",
@@ -277,30 +452,3 @@ async def get_html_artifact(session_id: str):
     except Exception as e:
         print(f"❌ HTML Artifact取得エラー: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve HTML artifact: {str(e)}")
-
-
-@app.websocket("/ws/artifacts/{session_id}")
-async def artifact_websocket(websocket: WebSocket, session_id: str):
-    """HTML Artifact配信用WebSocketエンドポイント"""
-    try:
-        await artifact_manager.websocket_manager.connect(session_id, websocket)
-        print(f"🔌 WebSocket connected for session: {session_id}")
-
-        # 既存のArtifactがあれば即座に送信
-        existing_artifact = artifact_manager.get_artifact(session_id)
-        if existing_artifact:
-            await artifact_manager.websocket_manager.send_artifact(session_id, existing_artifact)
-            print(f"📤 Existing artifact sent to session: {session_id}")
-
-        # 接続を維持（クライアントからの切断またはエラーまで）
-        try:
-            while True:
-                # Ping-Pong でコネクション維持
-                await websocket.receive_text()
-        except WebSocketDisconnect:
-            print(f"🔌 WebSocket disconnected for session: {session_id}")
-
-    except Exception as e:
-        print(f"❌ WebSocket error for session {session_id}: {e}")
-    finally:
-        await artifact_manager.websocket_manager.disconnect(session_id)
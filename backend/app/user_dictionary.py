@@ -109,9 +109,15 @@ DEFAULT_SCHOOL_TERMS = {
 
 
 # Firestoreヘルパー関数
-async def get_user_custom_dictionary(user_id: str) -> Dict[str, Any]:
-    """Firestoreからユーザーのカスタム辞書を取得"""
+async def get_user_custom_dictionary(user_id: str, raise_on_error: bool = False) -> Dict[str, Any]:
+    """Firestoreからユーザーのカスタム辞書を取得
+
+    raise_on_error=True の場合、取得できなかったときは空の辞書ではなく例外を送出する
+    （登録語が0件になったことと取得の失敗を区別したい呼び出し元で使用）
+    """
     if not firestore_available:
+        if raise_on_error:
+            raise RuntimeError("Firestoreが利用できません")
         return {}
 
     try:
@@ -123,6 +129,8 @@ async def get_user_custom_dictionary(user_id: str) -> Dict[str, Any]:
             return data.get("custom_terms", {})
         return {}
     except Exception:
+        if raise_on_error:
+            raise
         # ログを控えめに
         return {}
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+InMemoryRateLimiter のベンチマーク
+スライディングウィンドウカウンター版と、従来のタイムスタンプdeque版のスループットとメモリ使用量を比較する
+
+使い方:
+    python benchmark_rate_limiter.py [--requests 200000] [--keys 20000] [--limit 100]
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+from app.core.rate_limiter import InMemoryRateLimiter
+
+
+class DequeRateLimiter:
+    """従来の実装（識別子ごとに許可したリクエストの時刻をdequeに保持し、削除しない）"""
+
+    def __init__(self):
+        self.requests = defaultdict(lambda: deque())
+        self.blocked_ips = {}
+
+    def is_allowed(self, identifier: str, limit: int, window: int):
+        current_time = time.time()
+        if identifier in self.blocked_ips:
+            if current_time < self.blocked_ips[identifier]:
+                return False, {"blocked": True}
+            del self.blocked_ips[identifier]
+        request_times = self.requests[identifier]
+        while request_times and request_times[0] < current_time - window:
+            request_times.popleft()
+        if len(request_times) >= limit:
+            if len(request_times) >= limit * 2:
+                self.blocked_ips[identifier] = current_time + 300
+            remaining_time = int(window - (current_time - request_times[0]))
+            return False, {
+                "blocked": False,
+                "limit": limit,
+                "remaining": 0,
+                "reset_time": remaining_time,
+                "reason": f"Rate limit exceeded: {limit} requests per {window} seconds",
+            }
+        request_times.append(current_time)
+        return True, {
+            "blocked": False,
+            "limit": limit,
+            "remaining": limit - len(request_times),
+            "reset_time": window,
+        }
+
+
+def run(limiter_factory, identifiers, limit: int, window: int):
+    # スループット（計測のオーバーヘッドを避けるためメモリは別に測る）
+    limiter = limiter_factory()
+    started = time.perf_counter()
+    allowed = 0
+    for identifier in identifiers:
+        allowed += limiter.is_allowed(identifier, limit, window)[0]
+    elapsed = time.perf_counter() - started
+
+    # 保持しているメモリ
+    tracemalloc.start()
+    limiter = limiter_factory()
+    for identifier in identifiers:
+        limiter.is_allowed(identifier, limit, window)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "requests_per_sec": round(len(identifiers) / elapsed),
+        "allowed": allowed,
+        "keys": len(limiter.requests),
+        "retained_mb": round(retained / 1024 / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--keys", type=int, default=20_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--window", type=int, default=3600)
+    args = parser.parse_args()
+
+    random.seed(0)
+    # 半分は少数のホットな識別子、残りは多数の識別子に散らばる分布
+    hot_keys = max(1, args.keys // 100)
+    identifiers = [
+        f"10.0.{random.randrange(hot_keys)}" if random.random() < 0.5 else f"10.1.{random.randrange(args.keys)}"
+        for _ in range(args.requests)
+    ]
+
+    for name, factory in (("deque", DequeRateLimiter), ("sliding_window", InMemoryRateLimiter)):
+        print(f"{name:>15}: {run(factory, identifiers, args.limit, args.window)}")
+
+
+if __name__ == "__main__":
+    main()
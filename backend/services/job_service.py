@@ -0,0 +1,370 @@
+"""
+バックグラウンドジョブ（学級通信の生成など）の管理
+HTTPリクエスト（SSE）の寿命に縛られずに処理を最後まで実行し、状態・進捗・結果をジョブレコードに保存する
+
+- プロセス内のワーカー（JOB_WORKERS）がキューからジョブを取り出して実行する
+- キューが一杯（JOB_MAX_QUEUED）の場合は受け付けずJobQueueFullErrorを送出する（呼び出し側で503を返す）
+- ジョブレコードはJobStoreに保存する（JOB_STORE_BACKEND: firestore / memory）
+- クライアントはsubscribeで進捗イベントを受け取る（保存済みの進捗を先に返し、以降はライブで配信）
+- 実行中・待機中のジョブは実行するインスタンス（owner）が定期的にheartbeat_atを更新する。
+  インスタンスが途中で停止してリース（JOB_LEASE_SECONDS）が切れたジョブは、読み出したインスタンスが失敗として記録する
+"""
+import abc
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_SUCCEEDED = "succeeded"
+JOB_STATUS_FAILED = "failed"
+TERMINAL_STATUSES = (JOB_STATUS_SUCCEEDED, JOB_STATUS_FAILED)
+
+# ジョブレコードに残す進捗イベントの件数
+MAX_RECORDED_PROGRESS = 50
+
+DEFAULT_LEASE_SECONDS = 60.0
+LEASE_EXPIRED_ERROR = "ジョブを実行していたインスタンスが停止しました"
+
+
+class JobQueueFullError(Exception):
+    """ジョブの待ち行列が一杯で受け付けられない"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+@dataclass
+class Job:
+    """ジョブレコード"""
+
+    id: str
+    kind: str
+    user_id: str
+    session_id: str
+    message: str
+    status: str = JOB_STATUS_QUEUED
+    # 進捗イベント（{"seq", "event", "data"}。直近MAX_RECORDED_PROGRESS件）
+    progress: List[Dict[str, Any]] = field(default_factory=list)
+    progress_count: int = 0
+    # 結果（学級通信ジョブではArtifactの参照）
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: str = field(default_factory=_now)
+    updated_at: str = field(default_factory=_now)
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    # 実行するインスタンスのIDと最終heartbeat（time.time()）
+    owner: Optional[str] = None
+    heartbeat_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Job":
+        return cls(**{key: data[key] for key in cls.__dataclass_fields__ if key in data})
+
+
+# --- ジョブレコードの保存先 ---
+class JobStore(abc.ABC):
+    """ジョブレコードの永続化先を抽象化するインターフェース"""
+
+    @abc.abstractmethod
+    async def save(self, job: Job) -> None:
+        """ジョブレコードを上書き保存する"""
+
+    @abc.abstractmethod
+    async def load(self, job_id: str) -> Optional[Job]:
+        """ジョブレコードを読み込む。存在しない場合はNone"""
+
+
+class InMemoryJobStore(JobStore):
+    """プロセス内に保存するジョブストア（ローカル開発・テスト用）"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    async def save(self, job: Job) -> None:
+        self._jobs[job.id] = job.to_dict()
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        data = self._jobs.get(job_id)
+        return Job.from_dict(data) if data else None
+
+
+class FirestoreJobStore(JobStore):
+    """Firestoreの `jobs/{job_id}` に保存するジョブストア"""
+
+    def __init__(self, collection: str = "jobs"):
+        self.collection = collection
+
+    def _db(self):
+        # クライアント生成はテスト時にモックできるよう遅延させる
+        from services.firestore_service import get_db_client
+        return get_db_client()
+
+    async def save(self, job: Job) -> None:
+        await self._db().collection(self.collection).document(job.id).set(job.to_dict())
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        doc = await self._db().collection(self.collection).document(job_id).get()
+        return Job.from_dict(doc.to_dict()) if doc.exists else None
+
+
+# ジョブの実行関数: (ジョブ, 進捗の報告関数) -> 結果
+ProgressReporter = Callable[[Dict[str, Any]], Awaitable[None]]
+JobExecutor = Callable[[Job, ProgressReporter], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class JobManager:
+    """ジョブの受付・ワーカーでの実行・進捗の配信"""
+
+    def __init__(
+        self,
+        store: JobStore,
+        workers: int = 2,
+        max_queued: int = 20,
+        persist_every: int = 10,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ):
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        # 進捗はこの件数ごとに保存する（状態の変化は毎回保存する）
+        self.persist_every = persist_every
+        # heartbeatがこの秒数途絶えたジョブは実行インスタンスが停止したとみなす（heartbeatはその1/3ごと）
+        self.lease_seconds = lease_seconds
+        self.instance_id = uuid.uuid4().hex
+        self._executors: Dict[str, JobExecutor] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # 実行中・待機中のジョブ（ジョブID -> ジョブ）と進捗の購読者
+        self._active: Dict[str, Job] = {}
+        self._listeners: Dict[str, List[asyncio.Queue]] = {}
+        self.stats = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0, "lease_expired": 0}
+
+    def register(self, kind: str, executor: JobExecutor):
+        """ジョブの種類ごとの実行関数を登録"""
+        self._executors[kind] = executor
+
+    def start(self):
+        """ワーカーを起動（起動済みなら何もしない）"""
+        if self._worker_tasks and not all(task.done() for task in self._worker_tasks):
+            return
+        self._queue = asyncio.Queue()
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f"ジョブワーカーを起動: {self.workers}件")
+
+    async def stop(self):
+        """ワーカーを停止（実行中のジョブは失敗として記録される）"""
+        tasks = self._worker_tasks + ([self._heartbeat_task] if self._heartbeat_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._heartbeat_task = None
+
+    async def submit(self, kind: str, user_id: str, session_id: str, message: str) -> Job:
+        """
+        ジョブを登録してキューに積む
+
+        Raises:
+            JobQueueFullError: 待機中のジョブが max_queued 件に達している場合
+        """
+        if kind not in self._executors:
+            raise ValueError(f"未対応のジョブ種別です: {kind}")
+        self.start()
+        if self._queue.qsize() >= self.max_queued:
+            self.stats["rejected"] += 1
+            raise JobQueueFullError(f"Job queue is full ({self.max_queued} jobs waiting)")
+
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            user_id=user_id,
+            session_id=session_id,
+            message=message,
+            owner=self.instance_id,
+            heartbeat_at=time.time(),
+        )
+        await self.store.save(job)
+        self._active[job.id] = job
+        self._queue.put_nowait(job)
+        self.stats["submitted"] += 1
+        logger.info(f"📥 ジョブを受付: {job.id} ({kind}, session={session_id}, queued={self._queue.qsize()})")
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        """
+        ジョブを取得（自インスタンスで実行中・待機中はメモリ上の最新状態）
+
+        他のインスタンスのジョブでリースが切れているものは、失敗として記録してから返す。
+        """
+        job = self._active.get(job_id)
+        if job is not None:
+            return job
+        job = await self.store.load(job_id)
+        if job is not None and job.status not in TERMINAL_STATUSES and self._lease_expired(job):
+            logger.warning(f"⚠️ ジョブ {job.id} のリースが切れています（owner={job.owner}）。失敗として記録します")
+            job.status, job.error, job.finished_at = JOB_STATUS_FAILED, LEASE_EXPIRED_ERROR, _now()
+            self.stats["lease_expired"] += 1
+            await self._save(job)
+        return job
+
+    def _lease_expired(self, job: Job) -> bool:
+        return job.heartbeat_at is None or time.time() - job.heartbeat_at > self.lease_seconds
+
+    async def _heartbeat(self):
+        """自インスタンスの実行中・待機中のジョブのリースを更新する"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            for job in list(self._active.values()):
+                await self._save(job)
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status, job.started_at = JOB_STATUS_RUNNING, _now()
+        await self._save(job)
+        self._notify(job.id, {"event": "job_status", "status": job.status})
+
+        async def report(frame: Dict[str, Any]):
+            job.progress_count += 1
+            entry = {"seq": job.progress_count, "event": frame.get("event", "message"), "data": frame.get("data")}
+            # 生成途中のHTML差分はライブ配信のみで、レコードには残さない
+            if entry["event"] != "html_delta":
+                job.progress = (job.progress + [entry])[-MAX_RECORDED_PROGRESS:]
+            self._notify(job.id, entry)
+            if job.progress_count % self.persist_every == 0:
+                await self._save(job)
+
+        try:
+            job.result = await self._executors[job.kind](job, report)
+            job.status = JOB_STATUS_SUCCEEDED
+        except asyncio.CancelledError:
+            job.status, job.error = JOB_STATUS_FAILED, "cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"ジョブ {job.id} の実行エラー: {e}")
+            job.status, job.error = JOB_STATUS_FAILED, str(e)
+        finally:
+            job.finished_at = _now()
+            self.stats[job.status] = self.stats.get(job.status, 0) + 1
+            await self._save(job)
+            self._notify(job.id, {"event": "job_status", "status": job.status, "result": job.result, "error": job.error})
+            for queue in self._listeners.pop(job.id, []):
+                queue.put_nowait(None)
+            self._active.pop(job.id, None)
+            logger.info(f"ジョブ完了: {job.id} status={job.status}")
+
+    async def _save(self, job: Job):
+        job.updated_at = _now()
+        if job.id in self._active:
+            job.heartbeat_at = time.time()
+        try:
+            await self.store.save(job)
+        except Exception as e:
+            # 保存に失敗してもジョブの実行は続ける
+            logger.error(f"ジョブ {job.id} の保存エラー: {e}")
+
+    def _notify(self, job_id: str, entry: Dict[str, Any]):
+        for queue in self._listeners.get(job_id, []):
+            queue.put_nowait(entry)
+
+    async def subscribe(self, job_id: str, after_seq: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        ジョブの進捗を返す
+
+        保存済みの進捗（after_seqより後）と現在の状態を先に返し、実行中であれば完了までライブで配信する。
+        他のインスタンスで実行中のジョブは、完了（またはリース切れ）までジョブレコードを定期的に読み直して配信する。
+        """
+        job = await self.get(job_id)
+        if job is None:
+            return
+        queue: Optional[asyncio.Queue] = None
+        if job.id in self._active:
+            queue = asyncio.Queue()
+            self._listeners.setdefault(job.id, []).append(queue)
+        last_seq = after_seq
+        try:
+            for entry in list(job.progress):
+                if entry["seq"] > last_seq:
+                    last_seq = entry["seq"]
+                    yield entry
+            yield {"event": "job_status", "status": job.status, "result": job.result, "error": job.error}
+            while queue is not None:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                # 再送した保存済みの進捗と重複するものは送らない
+                if entry.get("seq", last_seq + 1) <= last_seq:
+                    continue
+                last_seq = entry.get("seq", last_seq)
+                yield entry
+
+            status = job.status
+            while status not in TERMINAL_STATUSES:
+                await asyncio.sleep(min(self.lease_seconds / 3, 5.0))
+                job = await self.get(job_id)
+                if job is None:
+                    return
+                for entry in list(job.progress):
+                    if entry["seq"] > last_seq:
+                        last_seq = entry["seq"]
+                        yield entry
+                if job.status != status:
+                    status = job.status
+                    yield {"event": "job_status", "status": job.status, "result": job.result, "error": job.error}
+        finally:
+            if queue is not None and queue in self._listeners.get(job_id, []):
+                self._listeners[job_id].remove(queue)
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {
+            "workers": len(self._worker_tasks),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "active": len(self._active),
+            **self.stats,
+        }
+
+
+def create_job_store() -> JobStore:
+    """環境変数に応じたジョブストアを生成する
+
+    JOB_STORE_BACKEND:
+      - firestore: Firestoreに保存（本番デフォルト）
+      - memory: プロセス内に保存（ローカル開発デフォルト）
+    """
+    environment = os.getenv("ENVIRONMENT", "production")
+    backend_name = os.getenv("JOB_STORE_BACKEND", "firestore" if environment == "production" else "memory")
+    if backend_name == "firestore":
+        return FirestoreJobStore()
+    if backend_name == "memory":
+        return InMemoryJobStore()
+    raise ValueError(f"未対応のJOB_STORE_BACKENDです: {backend_name}")
+
+
+# グローバルシングルトンインスタンス
+job_manager = JobManager(
+    create_job_store(),
+    workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_queued=int(os.getenv("JOB_MAX_QUEUED", "20")),
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", str(DEFAULT_LEASE_SECONDS))),
+)
@@ -0,0 +1,730 @@
+"""
+永続セッションサービス
+ADKのセッションをFirestore（本番）またはRedis互換ストア（ローカル）に保存し、
+複数のCloud Runインスタンス間でセッションを共有する
+
+- 書き込みはイベントをバッファしてまとめて反映（write-behind）
+- 最終更新からTTLを過ぎたセッションは期限切れとして扱う
+- 直近に使われたセッションはプロセス内LRUキャッシュ（ホット層）に保持
+  （返す前にバックエンドのイベント数と照合し、他インスタンスが書き込んでいれば読み直す）
+- イベントの連番はバックエンドへの書き込み時に採番する（インスタンス間で番号が重複しない）
+- ホット層はアイドル時間で追い出し、セッションごとのイベント履歴サイズに上限を設ける
+"""
+import abc
+import asyncio
+import copy
+import fnmatch
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.adk.events.event import Event
+from google.adk.sessions.base_session_service import (
+    BaseSessionService,
+    GetSessionConfig,
+    ListSessionsResponse,
+)
+from google.adk.sessions.session import Session
+from google.adk.sessions.state import State
+from google.genai.types import Content, Part
+
+logger = logging.getLogger(__name__)
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_SESSION_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_HOT_CACHE_SIZE = 256
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.5
+DEFAULT_MAX_BUFFERED_EVENTS = 20
+DEFAULT_IDLE_SECONDS = 30 * 60
+DEFAULT_SWEEP_INTERVAL_SECONDS = 60
+DEFAULT_MAX_SESSION_BYTES = 2 * 1024 * 1024
+# 履歴圧縮時にそのまま残す直近イベント数と、省略対象にするテキストの長さ
+COMPACT_KEEP_RECENT_EVENTS = 6
+COMPACT_TEXT_THRESHOLD = 2000
+
+
+def make_session_key(app_name: str, user_id: str, session_id: str) -> str:
+    """セッションを一意に識別するキーを生成（FirestoreのドキュメントIDとしても使用）"""
+    return f"{app_name}:{user_id}:{session_id}".replace("/", "_")
+
+
+def _event_to_dict(event: Event) -> Dict[str, Any]:
+    return event.model_dump(mode="json", exclude_none=True)
+
+
+def _event_from_dict(data: Dict[str, Any]) -> Event:
+    return Event.model_validate(data)
+
+
+def _persistable_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """temp: プレフィックスの値を除いたセッション状態を返す"""
+    return {k: v for k, v in state.items() if not k.startswith(State.TEMP_PREFIX)}
+
+
+def _event_size(event: Event) -> int:
+    """イベントが保持するおおよそのバイト数"""
+    return len(event.model_dump_json(exclude_none=True).encode("utf-8"))
+
+
+def _compact_event(event: Event) -> Optional[Event]:
+    """長いテキスト（生成済みHTMLなど）を短い参照に置き換えたイベントを返す。変更不要ならNone"""
+    if not event.content or not event.content.parts:
+        return None
+    parts = []
+    changed = False
+    for part in event.content.parts:
+        if part.text and len(part.text) > COMPACT_TEXT_THRESHOLD:
+            parts.append(Part(text=f"[省略された出力: {len(part.text)}文字]"))
+            changed = True
+        else:
+            parts.append(part)
+    if not changed:
+        return None
+    return event.model_copy(update={"content": Content(role=event.content.role, parts=parts)})
+
+
+# --- ストレージバックエンド ---
+class SessionBackend(abc.ABC):
+    """セッションの永続化先を抽象化するインターフェース
+
+    セッションは「メタ情報（状態・更新時刻など）」と「イベント列」に分けて保存する。
+    """
+
+    @abc.abstractmethod
+    async def load(self, key: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """メタ情報とイベント列を読み込む。存在しない場合はNone"""
+
+    @abc.abstractmethod
+    async def load_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        """メタ情報のみを読み込む（event_countは保存済みのイベント数）。存在しない場合はNone"""
+
+    @abc.abstractmethod
+    async def save(
+        self,
+        key: str,
+        meta: Dict[str, Any],
+        new_events: List[Dict[str, Any]],
+        ttl_seconds: int,
+    ) -> int:
+        """メタ情報を上書きし、イベントを末尾に追加する。追加後のイベント数を返す"""
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> None:
+        """セッションを削除する"""
+
+    @abc.abstractmethod
+    async def list_meta(self, app_name: str, user_id: str) -> List[Dict[str, Any]]:
+        """指定ユーザーのセッションのメタ情報一覧を返す"""
+
+
+class FirestoreSessionBackend(SessionBackend):
+    """Firestoreを使ったセッションバックエンド
+
+    `adk_sessions/{key}` にメタ情報、`adk_sessions/{key}/events` にイベントを保存する。
+    メタ情報とイベントの両方に書き込むタイムスタンプ型の `expire_at_ts` フィールドにFirestoreのTTLポリシーを
+    設定すれば、期限切れドキュメントは自動削除される（`expire_at` は数値のためTTLポリシーには使えない）。
+    """
+
+    def __init__(self, collection: str = "adk_sessions"):
+        self.collection = collection
+
+    def _db(self):
+        # クライアント生成はテスト時にモックできるよう遅延させる
+        from services.firestore_service import get_db_client
+        return get_db_client()
+
+    async def load(self, key: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        doc_ref = self._db().collection(self.collection).document(key)
+        doc = await doc_ref.get()
+        if not doc.exists:
+            return None
+        meta = doc.to_dict()
+        events = []
+        async for event_doc in doc_ref.collection("events").order_by("seq").stream():
+            events.append(json.loads(event_doc.to_dict()["event"]))
+        return meta, events
+
+    async def load_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        doc = await self._db().collection(self.collection).document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    async def save(
+        self,
+        key: str,
+        meta: Dict[str, Any],
+        new_events: List[Dict[str, Any]],
+        ttl_seconds: int,
+    ) -> int:
+        from google.cloud import firestore
+
+        db = self._db()
+        doc_ref = db.collection(self.collection).document(key)
+        expire_at = datetime.fromtimestamp(meta["expire_at"], tz=timezone.utc)
+
+        @firestore.async_transactional
+        async def append(transaction) -> int:
+            # 連番は保存済みのevent_countから採番し、同じ番号のドキュメントがあれば失敗させる（他インスタンスと競合した場合はリトライされる）
+            snapshot = await doc_ref.get(transaction=transaction)
+            first_seq = (snapshot.to_dict() or {}).get("event_count", 0) if snapshot.exists else 0
+            event_count = first_seq + len(new_events)
+            transaction.set(doc_ref, {**meta, "event_count": event_count, "expire_at_ts": expire_at})
+            for offset, event_data in enumerate(new_events):
+                seq = first_seq + offset
+                # イベントはネストが深いためJSON文字列として保存する
+                transaction.create(
+                    doc_ref.collection("events").document(f"{seq:08d}"),
+                    {"seq": seq, "event": json.dumps(event_data, ensure_ascii=False), "expire_at_ts": expire_at},
+                )
+            return event_count
+
+        return await append(db.transaction())
+
+    async def delete(self, key: str) -> None:
+        doc_ref = self._db().collection(self.collection).document(key)
+        async for event_doc in doc_ref.collection("events").stream():
+            await event_doc.reference.delete()
+        await doc_ref.delete()
+
+    async def list_meta(self, app_name: str, user_id: str) -> List[Dict[str, Any]]:
+        query = (
+            self._db()
+            .collection(self.collection)
+            .where("app_name", "==", app_name)
+            .where("user_id", "==", user_id)
+        )
+        return [doc.to_dict() async for doc in query.stream()]
+
+
+class FakeRedis:
+    """redis.asyncio.Redis のサブセットを実装したインメモリ版（ローカル開発・テスト用）
+
+    RedisSessionBackendが使うコマンド（get/set/delete/rpush/llen/lrange/expire/scan_iter）のみ対応。
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+
+    def _alive(self, key: str) -> bool:
+        expire_at = self._expires.get(key)
+        if expire_at is not None and expire_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._data.get(key) if self._alive(key) else None
+
+    async def set(self, key: str, value: str, ex: Optional[int] = None) -> bool:
+        self._data[key] = value
+        if ex:
+            self._expires[key] = time.time() + ex
+        else:
+            self._expires.pop(key, None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        deleted = 0
+        for key in keys:
+            if self._alive(key):
+                deleted += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return deleted
+
+    async def rpush(self, key: str, *values: str) -> int:
+        if not self._alive(key):
+            self._data[key] = []
+        self._data[key].extend(values)
+        return len(self._data[key])
+
+    async def llen(self, key: str) -> int:
+        return len(self._data[key]) if self._alive(key) else 0
+
+    async def lrange(self, key: str, start: int, end: int) -> List[str]:
+        if not self._alive(key):
+            return []
+        items = self._data[key]
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        if not self._alive(key):
+            return False
+        self._expires[key] = time.time() + seconds
+        return True
+
+    async def scan_iter(self, match: str = "*"):
+        for key in list(self._data.keys()):
+            if self._alive(key) and fnmatch.fnmatchcase(key, match):
+                yield key
+
+
+class RedisSessionBackend(SessionBackend):
+    """Redis（またはFakeRedis）を使ったセッションバックエンド
+
+    メタ情報はJSON文字列、イベントはリストとして保存し、どちらにもTTLを設定する。
+    """
+
+    def __init__(self, client, prefix: str = "adk:session:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _meta_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _events_key(self, key: str) -> str:
+        return f"{self.prefix}{key}:events"
+
+    async def load(self, key: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        raw_meta = await self.client.get(self._meta_key(key))
+        if raw_meta is None:
+            return None
+        raw_events = await self.client.lrange(self._events_key(key), 0, -1)
+        meta = json.loads(raw_meta)
+        meta["event_count"] = len(raw_events)
+        return meta, [json.loads(raw) for raw in raw_events]
+
+    async def load_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        raw_meta = await self.client.get(self._meta_key(key))
+        if raw_meta is None:
+            return None
+        meta = json.loads(raw_meta)
+        # イベント数はメタ情報ではなくリストの長さを正とする（メタ情報は他インスタンスに上書きされうる）
+        meta["event_count"] = await self.client.llen(self._events_key(key))
+        return meta
+
+    async def save(
+        self,
+        key: str,
+        meta: Dict[str, Any],
+        new_events: List[Dict[str, Any]],
+        ttl_seconds: int,
+    ) -> int:
+        # RPUSHはアトミックなので、複数インスタンスから追加してもイベントは失われない
+        if new_events:
+            event_count = await self.client.rpush(
+                self._events_key(key),
+                *[json.dumps(event, ensure_ascii=False) for event in new_events],
+            )
+        else:
+            event_count = await self.client.llen(self._events_key(key))
+        await self.client.set(
+            self._meta_key(key), json.dumps({**meta, "event_count": event_count}, ensure_ascii=False), ex=ttl_seconds
+        )
+        await self.client.expire(self._events_key(key), ttl_seconds)
+        return event_count
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self._meta_key(key), self._events_key(key))
+
+    async def list_meta(self, app_name: str, user_id: str) -> List[Dict[str, Any]]:
+        pattern = f"{self.prefix}{make_session_key(app_name, user_id, '*')}"
+        metas = []
+        async for meta_key in self.client.scan_iter(match=pattern):
+            if isinstance(meta_key, bytes):
+                meta_key = meta_key.decode()
+            if meta_key.endswith(":events"):
+                continue
+            raw_meta = await self.client.get(meta_key)
+            if raw_meta is not None:
+                metas.append(json.loads(raw_meta))
+        return metas
+
+
+# --- セッションサービス本体 ---
+@dataclass
+class _PendingWrite:
+    """未反映の書き込み（最新のメタ情報と追加待ちイベント）"""
+    meta: Dict[str, Any]
+    events: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class PersistentSessionService(BaseSessionService):
+    """外部ストアに永続化するADKセッションサービス
+
+    InMemorySessionServiceと同様に、呼び出し元には常にコピーを返す。
+    """
+
+    def __init__(
+        self,
+        backend: SessionBackend,
+        ttl_seconds: int = DEFAULT_SESSION_TTL_SECONDS,
+        hot_cache_size: int = DEFAULT_HOT_CACHE_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+        max_buffered_events: int = DEFAULT_MAX_BUFFERED_EVENTS,
+        idle_seconds: int = DEFAULT_IDLE_SECONDS,
+        max_session_bytes: int = DEFAULT_MAX_SESSION_BYTES,
+        sweep_interval: float = DEFAULT_SWEEP_INTERVAL_SECONDS,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hot_cache_size = hot_cache_size
+        self.flush_interval = flush_interval
+        self.max_buffered_events = max_buffered_events
+        self.idle_seconds = idle_seconds
+        self.max_session_bytes = max_session_bytes
+        self.sweep_interval = sweep_interval
+
+        # ホット層: セッションキー -> Session（LRU順）
+        self._hot: "OrderedDict[str, Session]" = OrderedDict()
+        # write-behindバッファ: セッションキー -> 未反映の書き込み
+        self._pending: Dict[str, _PendingWrite] = {}
+        # ホット層のセッションに反映済みのバックエンドのイベント数（他インスタンスの書き込みの検出用）
+        self._synced_counts: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        # メモリ使用量の計測: セッションキー -> (イベント履歴のバイト数, 最終アクセス時刻)
+        self._session_bytes: Dict[str, int] = {}
+        self._last_access: Dict[str, float] = {}
+        self._last_sweep = time.time()
+        self._stats = {"idle_evictions": 0, "lru_evictions": 0, "compacted_events": 0, "dropped_events": 0}
+
+    # --- ホット層 ---
+    def _is_expired(self, last_update_time: float) -> bool:
+        return last_update_time + self.ttl_seconds < time.time()
+
+    def _put_hot(self, key: str, session: Session) -> None:
+        self._hot[key] = session
+        self._hot.move_to_end(key)
+        self._last_access[key] = time.time()
+        self._session_bytes[key] = sum(_event_size(e) for e in session.events)
+        self._enforce_byte_budget(key, session)
+        while len(self._hot) > self.hot_cache_size:
+            evicted_key, _ = self._hot.popitem(last=False)
+            self._forget_hot(evicted_key)
+            self._stats["lru_evictions"] += 1
+            # 未反映の書き込みは_pendingに残っているため、ここで失われることはない
+            logger.debug(f"Session evicted from hot tier: {evicted_key}")
+
+    def _touch_hot(self, key: str) -> None:
+        self._hot.move_to_end(key)
+        self._last_access[key] = time.time()
+
+    def _forget_hot(self, key: str) -> None:
+        self._session_bytes.pop(key, None)
+        self._last_access.pop(key, None)
+        self._synced_counts.pop(key, None)
+
+    def _drop_hot(self, key: str) -> None:
+        self._hot.pop(key, None)
+        self._forget_hot(key)
+
+    def _enforce_byte_budget(self, key: str, session: Session) -> None:
+        """イベント履歴が上限を超えたら古いイベントを圧縮し、それでも超える場合は古い順に破棄する"""
+        if self._session_bytes.get(key, 0) <= self.max_session_bytes:
+            return
+
+        compact_until = max(0, len(session.events) - COMPACT_KEEP_RECENT_EVENTS)
+        for index in range(compact_until):
+            compacted = _compact_event(session.events[index])
+            if compacted is None:
+                continue
+            self._session_bytes[key] += _event_size(compacted) - _event_size(session.events[index])
+            session.events[index] = compacted
+            self._stats["compacted_events"] += 1
+
+        while (
+            self._session_bytes[key] > self.max_session_bytes
+            and len(session.events) > COMPACT_KEEP_RECENT_EVENTS
+        ):
+            dropped = session.events.pop(0)
+            self._session_bytes[key] -= _event_size(dropped)
+            self._stats["dropped_events"] += 1
+        logger.info(f"Session history compacted: {key}, bytes={self._session_bytes[key]}")
+
+    def evict_idle(self) -> int:
+        """一定時間アクセスのないセッションをホット層から追い出す（永続ストアには残る）"""
+        now = time.time()
+        self._last_sweep = now
+        idle_keys = [
+            key for key, accessed in self._last_access.items()
+            if accessed + self.idle_seconds < now and key in self._hot
+        ]
+        for key in idle_keys:
+            self._drop_hot(key)
+        self._stats["idle_evictions"] += len(idle_keys)
+        if idle_keys:
+            logger.info(f"Idle sessions evicted from hot tier: {len(idle_keys)}")
+        return len(idle_keys)
+
+    def _maybe_sweep(self) -> None:
+        if self._last_sweep + self.sweep_interval < time.time():
+            self.evict_idle()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """ホット層のセッション数と保持バイト数などの統計情報"""
+        return {
+            "live_sessions": len(self._hot),
+            "bytes_held": sum(self._session_bytes.values()),
+            "max_session_bytes": self.max_session_bytes,
+            "pending_sessions": len(self._pending),
+            "pending_events": sum(len(p.events) for p in self._pending.values()),
+            **self._stats,
+        }
+
+    def _build_meta(self, key: str, session: Session) -> Dict[str, Any]:
+        return {
+            "app_name": session.app_name,
+            "user_id": session.user_id,
+            "session_id": session.id,
+            "state": _persistable_state(session.state),
+            "last_update_time": session.last_update_time,
+            "expire_at": session.last_update_time + self.ttl_seconds,
+        }
+
+    # --- write-behind ---
+    def _enqueue(self, key: str, session: Session, events: List[Event]) -> None:
+        pending = self._pending.setdefault(key, _PendingWrite(meta={}))
+        pending.meta = self._build_meta(key, session)
+        pending.events.extend(_event_to_dict(event) for event in events)
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+        except RuntimeError:
+            # イベントループ外では次回のflush()呼び出しまで保持
+            pass
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self, key: Optional[str] = None) -> None:
+        """バッファ中の書き込みをバックエンドに反映する（key指定時はそのセッションのみ）"""
+        async with self._flush_lock:
+            keys = [key] if key is not None else list(self._pending.keys())
+            for pending_key in keys:
+                pending = self._pending.pop(pending_key, None)
+                if pending is None:
+                    continue
+                try:
+                    event_count = await self.backend.save(pending_key, pending.meta, pending.events, self.ttl_seconds)
+                    synced = self._synced_counts.get(pending_key)
+                    if synced is not None and event_count == synced + len(pending.events):
+                        self._synced_counts[pending_key] = event_count
+                    else:
+                        # 他インスタンスのイベントが間に入った: ホット層のコピーは古いので次回読み直す
+                        self._drop_hot(pending_key)
+                except Exception as e:
+                    logger.error(f"セッション書き込みエラー (key: {pending_key}): {e}")
+                    # 次回のflushで再試行できるよう、後から積まれたイベントの前に戻す
+                    newer = self._pending.get(pending_key)
+                    if newer is not None:
+                        pending.meta = newer.meta
+                        pending.events.extend(newer.events)
+                    self._pending[pending_key] = pending
+
+    async def close(self) -> None:
+        """シャットダウン時に未反映の書き込みを全て反映する"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    # --- BaseSessionService 実装 ---
+    async def create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        state: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+    ) -> Session:
+        session_id = session_id.strip() if session_id and session_id.strip() else str(uuid.uuid4())
+        session = Session(
+            app_name=app_name,
+            user_id=user_id,
+            id=session_id,
+            state=state or {},
+            last_update_time=time.time(),
+        )
+        key = make_session_key(app_name, user_id, session_id)
+        self._pending.pop(key, None)
+        self._put_hot(key, session)
+
+        # 作成は他インスタンスからすぐに見えるよう同期的に書き込む
+        self._synced_counts[key] = await self.backend.save(
+            key, self._build_meta(key, session), [], self.ttl_seconds
+        )
+        return copy.deepcopy(session)
+
+    async def get_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        config: Optional[GetSessionConfig] = None,
+    ) -> Optional[Session]:
+        self._maybe_sweep()
+        key = make_session_key(app_name, user_id, session_id)
+        session = self._hot.get(key)
+        if session is not None:
+            session = await self._revalidate_hot(key, session)
+        if session is not None:
+            self._touch_hot(key)
+        else:
+            session = await self._load_session(key)
+            if session is None:
+                return None
+
+        if self._is_expired(session.last_update_time):
+            logger.info(f"Session expired: {key}")
+            await self.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            return None
+
+        copied_session = copy.deepcopy(session)
+        if config:
+            if config.num_recent_events:
+                copied_session.events = copied_session.events[-config.num_recent_events:]
+            if config.after_timestamp:
+                copied_session.events = [
+                    e for e in copied_session.events if e.timestamp >= config.after_timestamp
+                ]
+        return copied_session
+
+    async def _revalidate_hot(self, key: str, session: Session) -> Optional[Session]:
+        """ホット層のコピーがバックエンドの最新と一致するか確認する。古ければ追い出してNoneを返す"""
+        if key in self._pending:
+            await self.flush(key)
+            if key in self._pending:
+                # バックエンドに書き込めない間は自インスタンスの内容を優先する
+                return session
+            if key not in self._hot:
+                return None
+        try:
+            meta = await self.backend.load_meta(key)
+        except Exception as e:
+            logger.error(f"セッションのメタ情報読み込みエラー (key: {key}): {e}")
+            return session
+        if meta is not None and meta.get("event_count") == self._synced_counts.get(key):
+            return session
+        logger.info(f"Session changed by another instance, reloading: {key}")
+        self._drop_hot(key)
+        return None
+
+    async def _load_session(self, key: str) -> Optional[Session]:
+        # 自インスタンスの未反映分があれば先に書き込んでから読む
+        if key in self._pending:
+            await self.flush(key)
+        try:
+            loaded = await self.backend.load(key)
+        except Exception as e:
+            logger.error(f"セッション読み込みエラー (key: {key}): {e}")
+            return None
+        if loaded is None:
+            return None
+
+        meta, event_dicts = loaded
+        session = Session(
+            app_name=meta["app_name"],
+            user_id=meta["user_id"],
+            id=meta["session_id"],
+            state=meta.get("state", {}),
+            events=[_event_from_dict(data) for data in event_dicts],
+            last_update_time=meta.get("last_update_time", 0.0),
+        )
+        self._put_hot(key, session)
+        self._synced_counts[key] = meta.get("event_count", len(event_dicts))
+        return session
+
+    async def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        await self.flush()
+        sessions = []
+        for meta in await self.backend.list_meta(app_name, user_id):
+            if self._is_expired(meta.get("last_update_time", 0.0)):
+                continue
+            sessions.append(
+                Session(
+                    app_name=meta["app_name"],
+                    user_id=meta["user_id"],
+                    id=meta["session_id"],
+                    last_update_time=meta.get("last_update_time", 0.0),
+                )
+            )
+        return ListSessionsResponse(sessions=sessions)
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        key = make_session_key(app_name, user_id, session_id)
+        self._drop_hot(key)
+        self._pending.pop(key, None)
+        await self.backend.delete(key)
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
+
+        # 呼び出し元のセッションを更新
+        await super().append_event(session=session, event=event)
+        session.last_update_time = event.timestamp
+
+        key = make_session_key(session.app_name, session.user_id, session.id)
+        storage_session = self._hot.get(key)
+        if storage_session is None:
+            # ホット層から追い出されていた場合は呼び出し元のセッションを基に復元
+            # （反映済みのイベント数が不明なため、書き込み後の次回取得時に読み直される）
+            storage_session = copy.deepcopy(session)
+            self._put_hot(key, storage_session)
+        else:
+            storage_session.events.append(event)
+            self._touch_hot(key)
+            self._session_bytes[key] = self._session_bytes.get(key, 0) + _event_size(event)
+            self._enforce_byte_budget(key, storage_session)
+        # エージェントがstateを直接更新するケースも反映するため、状態はスナップショットで保存
+        storage_session.state = _persistable_state(session.state)
+        storage_session.last_update_time = event.timestamp
+
+        self._enqueue(key, storage_session, [event])
+        self._maybe_sweep()
+        if len(self._pending[key].events) >= self.max_buffered_events:
+            await self.flush(key)
+        else:
+            self._schedule_flush()
+        return event
+
+
+def create_session_service() -> BaseSessionService:
+    """環境変数に応じたセッションサービスを生成する
+
+    SESSION_BACKEND:
+      - firestore: Firestoreに保存（本番デフォルト）
+      - redis: REDIS_URL のRedisに保存（redisパッケージが必要）
+      - fake: プロセス内のFakeRedisに保存（ローカル開発デフォルト）
+    """
+    environment = os.getenv("ENVIRONMENT", "production")
+    backend_name = os.getenv(
+        "SESSION_BACKEND", "firestore" if environment == "production" else "fake"
+    )
+
+    if backend_name == "firestore":
+        backend: SessionBackend = FirestoreSessionBackend()
+    elif backend_name == "redis":
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise ValueError("SESSION_BACKEND=redis を使用するにはredisパッケージが必要です。") from e
+        backend = RedisSessionBackend(
+            redis_asyncio.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        )
+    elif backend_name == "fake":
+        backend = RedisSessionBackend(FakeRedis())
+    else:
+        raise ValueError(f"未対応のSESSION_BACKENDです: {backend_name}")
+
+    service = PersistentSessionService(
+        backend,
+        ttl_seconds=int(os.getenv("SESSION_TTL_SECONDS", DEFAULT_SESSION_TTL_SECONDS)),
+        hot_cache_size=int(os.getenv("SESSION_HOT_CACHE_SIZE", DEFAULT_HOT_CACHE_SIZE)),
+        idle_seconds=int(os.getenv("SESSION_IDLE_SECONDS", DEFAULT_IDLE_SECONDS)),
+        max_session_bytes=int(os.getenv("SESSION_MAX_BYTES", DEFAULT_MAX_SESSION_BYTES)),
+    )
+    logger.info(f"セッションサービスを初期化: backend={backend_name}")
+    return service
@@ -80,3 +80,29 @@ async def upload_image_to_gcs(
 
     # バケットが公開設定されていることを前提とします
     return blob.public_url
+
+
+def _list_images_sync(session_id: str) -> list:
+    """【同期】セッションのアップロード画像を一覧する内部関数"""
+    storage_client = get_storage_client()
+    blobs = storage_client.list_blobs(bucket_name, prefix=f"user_images/{session_id}/")
+    images = []
+    for blob in blobs:
+        # upload_image_to_gcsが付与したタイムスタンプ接頭辞を除いて元のファイル名に戻す
+        name = blob.name.rsplit("/", 1)[-1].split("_", 1)[-1]
+        images.append({"name": name, "url": blob.public_url})
+    return images
+
+
+async def list_user_images(session_id: str) -> list:
+    """
+    upload_image_to_gcsで保存した画像の一覧を返します。
+
+    Args:
+        session_id: アップロード時のセッションID（未指定時は "user_<uid>"）。
+
+    Returns:
+        {"name", "url"} の辞書のリスト。
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _list_images_sync, session_id)
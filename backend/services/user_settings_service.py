@@ -1,7 +1,11 @@
+import hashlib
 import logging
+import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from functools import lru_cache
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from google.cloud import firestore
 
@@ -31,14 +35,83 @@ def get_db_client() -> Optional[firestore.AsyncClient]:
         return None
 
 
+def settings_version(settings: Optional[UserSettings]) -> str:
+    """設定内容から算出するバージョン（内容が変わったときだけ変化する）"""
+    if settings is None:
+        return "none"
+    return hashlib.sha1(settings.model_dump_json().encode("utf-8")).hexdigest()[:12]
+
+
+class UserSettingsCache:
+    """
+    user_idごとのユーザー設定キャッシュ（TTL・件数上限付き）
+
+    設定が存在しない場合（None）もキャッシュし、会話の各ターンでFirestoreを読まないようにする。
+    UserSettingsServiceの設定を変更するメソッドが、書き込み後に該当ユーザーのエントリを無効化する。
+    """
+
+    def __init__(self, ttl_seconds: int = 300, max_entries: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[Optional[UserSettings], float]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, user_id: str) -> Tuple[bool, Optional[UserSettings]]:
+        """(キャッシュ済みか, 設定) を返す"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self._entries.pop(user_id, None)
+            self.stats["misses"] += 1
+            return False, None
+        self._entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return True, entry[0]
+
+    def set(self, user_id: str, settings: Optional[UserSettings]) -> None:
+        self._entries[user_id] = (settings, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        if self._entries.pop(user_id, None) is not None:
+            self.stats["invalidations"] += 1
+
+    def get_metrics(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), **self.stats}
+
+
+user_settings_cache = UserSettingsCache(
+    ttl_seconds=int(os.getenv("USER_SETTINGS_CACHE_TTL_SECONDS", "300")),
+)
+
+
 class UserSettingsService:
     """ユーザー設定管理サービス"""
 
-    def __init__(self):
+    def __init__(self, cache: Optional[UserSettingsCache] = None):
         self.db = get_db_client()
+        self.cache = cache or user_settings_cache
         if self.db is None:
             logger.warning("Firestore接続に失敗しました。一部の機能が制限されます。")
 
+    async def get_cached_user_settings(self, user_id: str) -> Optional[UserSettings]:
+        """ユーザー設定をキャッシュ経由で取得（エージェントの各ターンで使用）"""
+        cached, settings = self.cache.get(user_id)
+        if cached:
+            return settings
+
+        settings = await self.get_user_settings(user_id)
+        # Firestoreが利用できない場合はキャッシュせず、復旧後に再取得する
+        if self.db is not None:
+            self.cache.set(user_id, settings)
+        return settings
+
+    def invalidate_cache(self, user_id: str) -> None:
+        """ユーザー設定キャッシュを無効化（設定を変更する各メソッドの書き込み後に呼ぶ）"""
+        self.cache.invalidate(user_id)
+        logger.info(f"ユーザー設定キャッシュを無効化しました (user_id: {user_id})")
+
     async def get_user_settings(self, user_id: str) -> Optional[UserSettings]:
         """ユーザー設定を取得"""
         if self.db is None:
@@ -97,6 +170,7 @@ class UserSettingsService:
             # Pydanticモデルを辞書に変換してFirestoreに保存
             settings_dict = settings.dict()
             await doc_ref.set(settings_dict)
+            self.invalidate_cache(user_id)
 
             logger.info(f"ユーザー設定作成完了 (user_id: {user_id})")
             return settings
@@ -119,6 +193,7 @@ class UserSettingsService:
             update_data['updated_at'] = datetime.now(timezone.utc)
 
             await doc_ref.update(update_data)
+            self.invalidate_cache(user_id)
 
             # 更新後の設定を取得して返す
             updated_settings = await self.get_user_settings(user_id)
@@ -134,6 +209,7 @@ class UserSettingsService:
         try:
             doc_ref = self.db.collection("users").document(user_id).collection("settings").document("main")
             await doc_ref.delete()
+            self.invalidate_cache(user_id)
             logger.info(f"ユーザー設定削除完了 (user_id: {user_id})")
             return True
 
@@ -159,6 +235,7 @@ class UserSettingsService:
                 'title_templates': settings.title_templates.dict(),
                 'updated_at': settings.updated_at
             })
+            self.invalidate_cache(user_id)
 
             logger.info(f"タイトルテンプレート追加完了 (user_id: {user_id}, template: {template.name})")
             return True
@@ -192,6 +269,7 @@ class UserSettingsService:
                 'title_templates': settings.title_templates.dict(),
                 'updated_at': settings.updated_at
             })
+            self.invalidate_cache(user_id)
 
             logger.info(f"タイトルテンプレート削除完了 (user_id: {user_id}, template_id: {template_id})")
             return True
@@ -285,6 +363,7 @@ class UserSettingsService:
                     'title_templates': settings.title_templates.dict(),
                     'updated_at': settings.updated_at
                 })
+                self.invalidate_cache(user_id)
 
             logger.info(f"タイトル使用統計更新完了 (user_id: {user_id}, title: {title})")
             return True
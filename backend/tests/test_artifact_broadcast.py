@@ -0,0 +1,60 @@
+import asyncio
+
+from app.core.artifact_broadcast import InMemoryBroadcastBackend, InMemoryBroadcastBus
+from app.core.artifact_manager import ArtifactManager
+from tests.test_websocket_hub import FakeWebSocket
+
+
+async def test_artifact_produced_on_one_instance_reaches_subscriber_on_another():
+    """別インスタンスで生成されたArtifactと差分が、WebSocketを持つインスタンスの購読者に届くかテストする"""
+    bus = InMemoryBroadcastBus()
+    producer = ArtifactManager(broadcast_backend=InMemoryBroadcastBackend(bus))
+    websocket_instance = ArtifactManager(broadcast_backend=InMemoryBroadcastBackend(bus))
+    await producer.start_broadcast()
+    await websocket_instance.start_broadcast()
+
+    websocket = FakeWebSocket()
+    await websocket_instance.websocket_manager.connect("s1", websocket)
+
+    await producer.publish_html_delta("s1", "<html>", 1)
+    produced = await producer.store_html_artifact("s1", "<html>完成</html>")
+    await asyncio.sleep(0.05)
+
+    assert [m["type"] for m in websocket.sent] == ["html_delta", "html_artifact"]
+    assert websocket_instance.get_artifact("s1").content == "<html>完成</html>"
+    assert websocket_instance.get_artifact("s1").version == produced.version
+
+    await websocket_instance.websocket_manager.disconnect("s1")
+    await producer.close_broadcast()
+    await websocket_instance.close_broadcast()
+
+
+async def test_newer_artifact_from_other_instance_wins_regardless_of_local_count():
+    """別インスタンスの新しい版は、自インスタンスで保存した版の数によらず採用され、同じ版は全インスタンスで同じものが残るかテストする"""
+    bus = InMemoryBroadcastBus()
+    instance_a = ArtifactManager(broadcast_backend=InMemoryBroadcastBackend(bus))
+    instance_b = ArtifactManager(broadcast_backend=InMemoryBroadcastBackend(bus))
+    await instance_a.start_broadcast()
+    await instance_b.start_broadcast()
+
+    await instance_b.close_broadcast()
+    for version in range(3):
+        await instance_b.store_html_artifact("s1", f"<html>B{version}</html>")
+    await instance_b.start_broadcast()
+    await asyncio.sleep(0.01)
+    await instance_a.store_html_artifact("s1", "<html>A</html>")
+
+    assert instance_b.get_artifact("s1").content == "<html>A</html>"
+
+    # 同じバージョンが競合した場合は生成元の順序で決まる
+    version = instance_a.get_artifact("s1").version + 1
+    for origin in ("x", "y"):
+        artifact = {"session_id": "s2", "content": f"<html>{origin}</html>", "version": version, "origin": origin}
+        await instance_a._on_broadcast({"kind": "artifact", "artifact": artifact, "origin": origin})
+    for origin in ("y", "x"):
+        artifact = {"session_id": "s2", "content": f"<html>{origin}</html>", "version": version, "origin": origin}
+        await instance_b._on_broadcast({"kind": "artifact", "artifact": artifact, "origin": origin})
+    assert instance_a.get_artifact("s2").content == instance_b.get_artifact("s2").content == "<html>y</html>"
+
+    await instance_a.close_broadcast()
+    await instance_b.close_broadcast()
@@ -0,0 +1,41 @@
+from app.core.artifact_manager import ArtifactStore, HtmlArtifact
+
+
+def _artifact(session_id, content):
+    return HtmlArtifact(session_id=session_id, content=content)
+
+
+def test_lru_eviction_keeps_total_bytes_within_budget():
+    """総バイト数の上限を超えると最も古くアクセスされたArtifactから退避されるかテストする"""
+    store = ArtifactStore(max_bytes=2500, compress_after_seconds=0)
+    store.put("a", _artifact("a", "a" * 1000))
+    store.put("b", _artifact("b", "b" * 1000))
+    store.get("a")
+    store.put("c", _artifact("c", "c" * 1000))
+
+    assert store.get("b") is None
+    assert store.get("a").content == "a" * 1000
+    metrics = store.get_metrics()
+    assert metrics["bytes"] <= 2500
+    assert metrics["lru_evictions"] == 1
+    assert metrics["misses"] == 1
+
+
+def test_cold_entries_are_compressed_and_expired(mocker):
+    """アクセスのないArtifactが圧縮され、再取得で展開され、TTL経過で退避されるかテストする"""
+    clock = mocker.patch("app.core.artifact_manager.time.monotonic", return_value=1000.0)
+    store = ArtifactStore(ttl_seconds=3600, compress_after_seconds=60, sweep_interval=0)
+    html = "<html>" + "学級通信" * 500 + "</html>"
+    store.put("a", _artifact("a", html))
+
+    clock.return_value = 1100.0
+    store.put("b", _artifact("b", "<html></html>"))
+    metrics = store.get_metrics()
+    assert metrics["compressed_entries"] == 1
+    assert metrics["bytes"] < len(html.encode("utf-8"))
+
+    assert store.get("a").content == html
+
+    clock.return_value = 5000.0
+    assert store.get("a") is None
+    assert store.get_metrics()["ttl_evictions"] >= 1
@@ -0,0 +1,75 @@
+import json
+
+from app.core.artifact_manager import ArtifactManager
+from app.core.html_diff import apply_html_patch
+
+BASE_HTML = "<html>\n" + "".join(f"<p>段落{i}</p>\n" for i in range(200)) + "</html>\n"
+
+
+async def test_changes_since_version_are_sent_as_patch():
+    """履歴にあるバージョンからの変更が、適用可能な差分として返されるかテストする"""
+    manager = ArtifactManager()
+    first = await manager.store_html_artifact("s1", BASE_HTML)
+    revised = BASE_HTML.replace("<p>段落100</p>", "<p>修正した段落</p>")
+    artifact = await manager.store_html_artifact("s1", revised)
+
+    message = manager.get_changes_since("s1", first.version)
+
+    assert artifact.version > first.version
+    assert message["type"] == "html_patch"
+    assert message["data"]["base_version"] == first.version and message["data"]["version"] == artifact.version
+    assert apply_html_patch(BASE_HTML, message["data"]["patch"]) == revised
+    assert len(json.dumps(message, ensure_ascii=False)) < len(revised) / 4
+    assert manager.get_changes_since("s1", artifact.version) is None
+
+
+async def test_unknown_base_version_falls_back_to_full_snapshot():
+    """履歴に無いバージョンや全面的な書き換えでは全文スナップショットが返されるかテストする"""
+    manager = ArtifactManager()
+    first = await manager.store_html_artifact("s1", BASE_HTML)
+    latest = await manager.store_html_artifact("s1", "<html><body>全面改訂</body></html>")
+
+    assert manager.get_changes_since("s1", 99)["type"] == "html_artifact"
+    assert manager.get_changes_since("s1", first.version)["type"] == "html_artifact"
+    assert manager.get_changes_since("s1", None)["data"]["version"] == latest.version
+
+
+async def test_version_keeps_increasing_after_eviction():
+    """TTL・LRUで退避された後に保存した版も、以前の版より大きいバージョンになるかテストする"""
+    manager = ArtifactManager()
+    evicted = await manager.store_html_artifact("s1", "<html>v1</html>")
+    manager.clear_session_artifacts("s1")
+
+    artifact = await manager.store_html_artifact("s1", "<html>v2</html>")
+
+    assert artifact.version > evicted.version
+    assert (await manager.wait_for_artifact("s1", evicted.version, timeout=0.01)) is artifact
+
+
+async def test_polling_endpoint_supports_etag_and_long_poll(monkeypatch):
+    """ETagが一致すれば304を返し、ロングポーリングは新しいArtifactの保存で返るかテストする"""
+    import asyncio
+
+    from app import main
+
+    manager = ArtifactManager()
+    monkeypatch.setattr(main, "artifact_manager", manager)
+    v1 = await manager.store_html_artifact("s1", "<html>v1</html>")
+
+    first = await main.get_html_artifact("s1")
+    etag = first.headers["etag"]
+    assert (await main.get_html_artifact("s1", if_none_match=etag)).status_code == 304
+
+    waiting = asyncio.create_task(main.get_html_artifact("s1", wait=5, since_version=v1.version))
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    v2 = await manager.store_html_artifact("s1", "<html>v2</html>")
+    response = await asyncio.wait_for(waiting, timeout=1)
+    assert json.loads(response.body)["artifact"]["version"] == v2.version
+    assert response.headers["etag"] != etag
+
+    timed_out = await main.get_html_artifact("s1", wait=0.05, since_version=v2.version)
+    assert timed_out.status_code == 304
+    # 待機が終わったセッションのイベントは残らない
+    await main.get_html_artifact("never-stored", wait=0.01, since_version=0)
+    assert manager._artifact_events == {} and manager._artifact_waiters == {}
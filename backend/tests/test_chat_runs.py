@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from app.core.chat_runs import ChatRunManager, ChatSessionBusyError
+
+
+def make_source(log, name, release):
+    async def source():
+        log.append(f"{name}:start")
+        await release.wait()
+        yield {"data": name}
+        log.append(f"{name}:end")
+    return source
+
+
+async def collect(manager, run):
+    return [frame async for frame in manager.stream(run)]
+
+
+async def test_runs_are_serialized_coalesced_and_bounded_per_session():
+    """同一セッションの実行が順番に行われ、同じメッセージは合流し、待ち行列の上限を超えると拒否されるかテストする"""
+    manager = ChatRunManager(max_pending=1)
+    log, release = [], asyncio.Event()
+    first = manager.submit("u1", "s1", "こんにちは", make_source(log, "first", release))
+    second = manager.submit("u1", "s1", "続き", make_source(log, "second", release))
+    duplicate = manager.submit("u1", "s1", " こんにちは ", make_source(log, "duplicate", release))
+    other_session = manager.submit("u1", "s2", "続き", make_source(log, "other", release))
+    assert duplicate is first
+
+    with pytest.raises(ChatSessionBusyError):
+        manager.submit("u1", "s1", "三つ目", make_source(log, "third", release))
+
+    streams = [asyncio.create_task(collect(manager, run)) for run in (first, duplicate, second, other_session)]
+    await asyncio.sleep(0.01)
+    assert "second:start" not in log
+    release.set()
+    results = await asyncio.gather(*streams)
+
+    assert [[frame["data"] for frame in frames] for frames in results] == [["first"], ["first"], ["second"], ["other"]]
+    assert log.index("first:end") < log.index("second:start")
+    assert manager.get_metrics()["coalesced"] == 1
+    assert manager.get_metrics()["runs"] == 0
+
+
+async def test_run_continues_after_disconnect_and_replays_from_last_event_id():
+    """クライアントが切断しても実行が続き、Last-Event-IDの続きから再送されるかテストする"""
+    manager = ChatRunManager()
+    release = asyncio.Event()
+
+    async def source():
+        for i in range(1, 4):
+            if i == 3:
+                await release.wait()
+            yield {"data": f"frame{i}"}
+
+    run = manager.submit("u1", "s1", "こんにちは", source)
+    stream = manager.stream(run)
+    first = await stream.__anext__()
+    await stream.aclose()  # 1件受信したところで切断
+    assert first["id"] == f"{run.id}:1"
+
+    release.set()
+    await asyncio.sleep(0.01)
+    assert run.done and not run.task.cancelled()
+
+    assert manager.resume("u1", "s1", f"{run.id}:1") == (run, 1)
+    assert manager.resume("u2", "s1", f"{run.id}:1") is None
+    replayed = [frame async for frame in manager.stream(run, 1)]
+    assert [frame["data"] for frame in replayed] == ["frame2", "frame3"]
+    assert [frame["id"] for frame in replayed] == [f"{run.id}:2", f"{run.id}:3"]
@@ -0,0 +1,30 @@
+from google.genai.types import Content, Part
+
+from agents.shared.history_compaction import KEEP_RECENT_CONTENTS, compact_contents
+
+
+def _content(role, text):
+    return Content(role=role, parts=[Part(text=text)])
+
+
+def test_old_html_is_replaced_with_reference():
+    """古いターンのHTMLが参照文字列に置き換えられ、直近の履歴はそのまま残るかテストする"""
+    html = "<!DOCTYPE html><html>" + "x" * 1000 + "</html>"
+    contents = [_content("model", html)] + [_content("user", "ありがとう")] * KEEP_RECENT_CONTENTS
+
+    compacted = compact_contents(contents, token_budget=100_000)
+
+    assert compacted[0].parts[0].text.startswith("[生成済みHTML")
+    # モデルが参照できないセッション状態を案内しない
+    assert "セッション状態" not in compacted[0].parts[0].text
+    assert compacted[1:] == contents[1:]
+
+
+def test_old_dialogue_is_summarized_over_budget():
+    """推定トークン数が上限を超えると古い対話が1件の要約にまとめられるかテストする"""
+    contents = [_content("user", "運動会の様子" * 100)] * 10
+
+    compacted = compact_contents(contents, token_budget=100)
+
+    assert len(compacted) == KEEP_RECENT_CONTENTS + 1
+    assert compacted[0].parts[0].text.startswith("【これまでの会話の要約】")
@@ -0,0 +1,23 @@
+from agents.layout_agent.html_stream import IncrementalHtmlExtractor
+
+
+def _feed_in_chunks(text, size):
+    extractor = IncrementalHtmlExtractor()
+    deltas = [extractor.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    return extractor, "".join(deltas)
+
+
+def test_fenced_html_is_extracted_incrementally():
+    """```html フェンス内のHTMLが断片の区切り方に関係なく抽出されるかテストする"""
+    text = "作成しました。\n```html\n<!DOCTYPE html>\n<html><body>通信</body></html>\n```\n以上です"
+    for size in (1, 4, 9):
+        extractor, html = _feed_in_chunks(text, size)
+        assert html == "<!DOCTYPE html>\n<html><body>通信</body></html>\n"
+        assert extractor.completed
+
+
+def test_unfenced_document_stops_at_closing_tag():
+    """フェンスなしのHTMLが</html>で完了し、前後の説明文が含まれないかテストする"""
+    extractor, html = _feed_in_chunks("説明です<!DOCTYPE html><html>x</html>補足", 3)
+    assert html == "<!DOCTYPE html><html>x</html>"
+    assert extractor.completed
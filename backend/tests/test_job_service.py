@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from services.job_service import InMemoryJobStore, JobManager, JobQueueFullError
+
+
+async def test_job_runs_detached_and_records_progress_and_result():
+    """ジョブが購読者なしで最後まで実行され、進捗と結果がレコードに保存されるかテストする"""
+    store = InMemoryJobStore()
+    manager = JobManager(store, workers=1, max_queued=5, persist_every=1)
+
+    async def executor(job, report):
+        await report({"data": "構成案を作成中"})
+        await report({"event": "html_delta", "data": "<html>"})
+        return {"version": 1}
+
+    manager.register("newsletter", executor)
+    job = await manager.submit("newsletter", "u1", "s1", "作成してください")
+
+    async def collect():
+        return [entry async for entry in manager.subscribe(job.id)]
+
+    # 完了のjob_statusが届くまで待つ（レコードは通知の前に保存される）
+    live = await asyncio.wait_for(collect(), timeout=5)
+    assert live[-1]["status"] == "succeeded"
+
+    saved = await store.load(job.id)
+    assert saved.status == "succeeded"
+    assert saved.result == {"version": 1}
+    assert [entry["data"] for entry in saved.progress] == ["構成案を作成中"]
+
+    events = await collect()
+    assert events[-1]["status"] == "succeeded"
+    await manager.stop()
+
+
+async def test_submit_is_rejected_when_queue_is_full():
+    """待ち行列が一杯のときに新しいジョブを受け付けないかテストする"""
+    manager = JobManager(InMemoryJobStore(), workers=1, max_queued=1)
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def executor(job, report):
+        started.set()
+        await release.wait()
+
+    manager.register("newsletter", executor)
+    await manager.submit("newsletter", "u1", "s1", "1")
+    await asyncio.wait_for(started.wait(), timeout=5)  # 1件目はワーカーが実行中
+    await manager.submit("newsletter", "u1", "s2", "2")
+    with pytest.raises(JobQueueFullError):
+        await manager.submit("newsletter", "u1", "s3", "3")
+
+    release.set()
+    await manager.stop()
+
+
+async def test_job_of_stopped_instance_is_failed_after_lease_expires():
+    """実行中のインスタンスが停止してリースが切れたジョブは、別のインスタンスで失敗として扱われるかテストする"""
+    import time
+
+    from services.job_service import Job
+
+    store = InMemoryJobStore()
+    other_instance = JobManager(store, lease_seconds=0.3)
+    await store.save(Job(id="live", kind="newsletter", user_id="u1", session_id="s1", message="",
+                         status="running", owner="alive", heartbeat_at=time.time()))
+    await store.save(Job(id="lost", kind="newsletter", user_id="u1", session_id="s1", message="",
+                         status="running", owner="stopped", heartbeat_at=time.time() - 60))
+
+    assert (await other_instance.get("live")).status == "running"
+    events = [entry async for entry in other_instance.subscribe("lost")]
+
+    assert events[-1]["status"] == "failed"
+    assert (await store.load("lost")).status == "failed"
+    # 生存中のインスタンスのジョブも、heartbeatが途絶えれば購読は終了する
+    events = [entry async for entry in other_instance.subscribe("live")]
+    assert [e["status"] for e in events] == ["running", "failed"]
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+from google.genai.types import Content, Part
+
+from agents.layout_agent.agent import build_layout_instruction
+
+
+def _context(school_name, message):
+    return SimpleNamespace(
+        state={"school_name": school_name, "class_name": "1年1組", "teacher_name": "山田先生"},
+        user_content=Content(role="user", parts=[Part(text=message)]),
+    )
+
+
+def test_layout_prompt_is_built_from_each_invocation_context():
+    """レイアウト用プロンプトが呼び出しごとのコンテキストから組み立てられるかテストする"""
+    prompt_a = build_layout_instruction(_context("A小学校", "遠足に行きました"))
+    prompt_b = build_layout_instruction(_context("B小学校", "運動会がありました"))
+
+    assert "A小学校" in prompt_a and "遠足に行きました" in prompt_a
+    assert "B小学校" in prompt_b and "運動会がありました" in prompt_b
+    assert "A小学校" not in prompt_b
+
+
+async def test_deliver_html_publishes_in_process_without_http(mocker):
+    """同一プロセス内ではHTTPを使わずartifact_managerに直接配信されるかテストする"""
+    from agents.layout_agent.deliver_html_tool import DeliverHtmlTool
+    from app.core.artifact_manager import artifact_manager
+
+    tool = DeliverHtmlTool()
+    post = mocker.patch("httpx.AsyncClient.post")
+
+    result = await tool.deliver_html("user-1:session-1", "<html>通信</html>")
+
+    assert result.startswith("✅")
+    assert artifact_manager.get_artifact("user-1:session-1").content == "<html>通信</html>"
+    post.assert_not_called()
+    # セッションIDはToolContextからのみ取得する（無ければ配信しない）
+    assert (await tool.deliver_html_to_frontend("<html>通信</html>", "newsletter", "{}")).startswith("❌")
+
+
+def test_outline_from_previous_newsletter_is_not_reused():
+    """前回のレイアウト生成より前の構成案は使われず、その後に提示された構成案のみ使われるかテストする"""
+    from google.adk.events.event import Event, EventActions
+
+    from agents.layout_agent.agent import get_outline_for_invocation
+
+    def outline_event(invocation_id, outline):
+        return Event(
+            author="main_conversation_agent",
+            invocation_id=invocation_id,
+            actions=EventActions(state_delta={"outline": outline}),
+        )
+
+    events = [
+        outline_event("inv-1", '{"title": "運動会"}'),
+        Event(author="layout_agent", invocation_id="inv-2"),
+        Event(author="user", invocation_id="inv-3"),
+        Event(author="layout_agent", invocation_id="inv-3"),
+    ]
+    session = SimpleNamespace(events=events)
+    assert get_outline_for_invocation(session, "inv-3") is None
+
+    # 前回の生成後に新しい構成案が提示され、今回の依頼で確定した場合は使う
+    events.insert(3, outline_event("inv-3", '{"title": "遠足"}'))
+    assert get_outline_for_invocation(session, "inv-3") == {"title": "遠足"}
+    # 最新の応答が構成案でなければ使わない
+    events.insert(4, outline_event("inv-3", "承知しました！"))
+    assert get_outline_for_invocation(session, "inv-3") is None
@@ -0,0 +1,62 @@
+from agents.layout_agent.response_cache import LayoutResponseCache
+
+BASIC_INFO = {
+    "school_name": "テスト小学校",
+    "class_name": "3年2組",
+    "teacher_name": "田中先生",
+    "current_date": "2025-10-01",
+}
+
+
+def test_exact_hit_ignores_whitespace_and_width_differences():
+    """空白や全角・半角の違いだけの依頼が完全一致でヒットするかテストする"""
+    cache = LayoutResponseCache()
+    cache.put("u1", BASIC_INFO, "運動会の練習をがんばりました 1位", "", "<html>cached</html>")
+
+    hit = cache.get("u1", BASIC_INFO, "  運動会の練習をがんばりました　　１位\n", "")
+
+    assert hit is not None and hit.tier == "exact"
+    assert hit.html == "<html>cached</html>"
+    assert cache.get("u1", {**BASIC_INFO, "class_name": "4年1組"}, "運動会の練習をがんばりました 1位", "") is None
+    assert cache.get_metrics()["exact_hits"] == 1
+
+
+def test_similarity_tier_is_scoped_to_basic_info_and_threshold():
+    """類似度層がしきい値以上かつ同じ基本情報の場合のみヒットするかテストする"""
+    cache = LayoutResponseCache(similarity_threshold=0.8)
+    cache.put("u1", BASIC_INFO, "今日は運動会の練習をしました。みんながんばりました。", "", "<html>cached</html>")
+
+    hit = cache.get("u1", BASIC_INFO, "今日は運動会の練習をしました。みんなとてもがんばりました。", "")
+    assert hit is not None and hit.tier == "similar"
+    assert 0.8 <= hit.similarity < 1.0
+
+    assert cache.get("u1", BASIC_INFO, "遠足で動物園に行きました。", "") is None
+    assert cache.get("u1", BASIC_INFO, "今日は運動会の練習をしました。みんながんばりました。", "- 画像1: photo") is None
+
+
+def test_same_trigger_phrase_misses_across_users_and_outlines():
+    """同じ「作成してください」でも、別のユーザーや別の構成案の依頼ではヒットしないかテストする"""
+    from types import SimpleNamespace
+
+    from google.adk.events.event import Event, EventActions
+    from google.genai.types import Content, Part
+
+    from agents.layout_agent.agent import build_cache_content
+
+    def session_with_outline(title):
+        return SimpleNamespace(events=[
+            Event(
+                author="main_conversation_agent",
+                invocation_id="inv-1",
+                actions=EventActions(state_delta={"outline": f'{{"title": "{title}"}}'}),
+            ),
+            Event(author="user", invocation_id="inv-2", content=Content(parts=[Part(text="作成してください")])),
+        ])
+
+    cache = LayoutResponseCache()
+    sports_day = build_cache_content(session_with_outline("運動会"), "inv-2")
+    cache.put("u1", BASIC_INFO, sports_day, "", "<html>運動会</html>")
+
+    assert cache.get("u1", BASIC_INFO, sports_day, "").html == "<html>運動会</html>"
+    assert cache.get("u2", BASIC_INFO, sports_day, "") is None
+    assert cache.get("u1", BASIC_INFO, build_cache_content(session_with_outline("遠足"), "inv-2"), "") is None
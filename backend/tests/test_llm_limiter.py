@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+from google.adk.models.google_llm import Gemini
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import types
+
+from agents.shared import llm_limiter as llm_limiter_module
+from agents.shared.model_resilience import llm_deadline
+from agents.shared.llm_limiter import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    LimitedGemini,
+    LlmConcurrencyLimiter,
+    LlmOverloadedError,
+)
+
+
+async def test_waiters_are_served_by_priority_and_shed_when_queue_is_deep():
+    """空いた枠が対話リクエストから割り当てられ、待ち行列が深いときは対話リクエストを断るかテストする"""
+    limiter = LlmConcurrencyLimiter(max_concurrency=1, max_queue=2)
+    order = []
+
+    async def call(name, priority):
+        async with limiter.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    await limiter.acquire(PRIORITY_INTERACTIVE)  # 枠を埋めておく
+    batch = asyncio.create_task(call("batch", PRIORITY_BATCH))
+    await asyncio.sleep(0)
+    interactive = asyncio.create_task(call("interactive", PRIORITY_INTERACTIVE))
+    await asyncio.sleep(0)
+
+    assert limiter.should_shed()
+    with pytest.raises(LlmOverloadedError) as exc_info:
+        await limiter.acquire(PRIORITY_INTERACTIVE)
+    assert exc_info.value.retry_after >= 1
+
+    limiter.release()
+    await asyncio.gather(batch, interactive)
+    assert order == ["interactive", "batch"]
+    metrics = limiter.get_metrics()
+    assert metrics["priorities"]["interactive"]["shed"] == 1
+    assert metrics["priorities"]["batch"]["wait_ms_max"] > 0
+    assert metrics["in_flight"] == 0
+
+
+async def test_token_bucket_paces_calls_to_quota():
+    """トークンバケットでクォータを超える呼び出しが次のトークンまで待たされるかテストする"""
+    limiter = LlmConcurrencyLimiter(max_concurrency=10, requests_per_minute=600, burst=1)  # 0.1秒に1回
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for _ in range(3):
+        async with limiter.slot():
+            pass
+    assert loop.time() - started >= 0.18
+
+
+class FakeGeminiStream:
+    """ADKのストリーミング応答（途中のテキスト -> 関数呼び出し -> まとめたテキスト）を返し、開いているストリーム数を数える"""
+
+    def __init__(self):
+        self.open = 0
+        self.max_open = 0
+
+    async def generate(self, llm_request, stream=False):
+        self.open += 1
+        self.max_open = max(self.max_open, self.open)
+        try:
+            for text in ("途中", "経過"):
+                await asyncio.sleep(0.005)
+                yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=text)]), partial=True)
+            call = types.Part(function_call=types.FunctionCall(name="transfer_to_agent", args={}))
+            yield LlmResponse(content=types.Content(role="model", parts=[call]))
+            yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text="完了")]))
+        finally:
+            self.open -= 1
+
+
+def patch_gemini(mocker, monkeypatch, limiter):
+    monkeypatch.setattr(llm_limiter_module, "llm_limiter", limiter)
+    fake = FakeGeminiStream()
+
+    async def generate(self, llm_request, stream=False):
+        async for response in fake.generate(llm_request, stream):
+            yield response
+
+    mocker.patch.object(Gemini, "generate_content_async", generate)
+    return fake, LimitedGemini(model="gemini-2.5-flash")
+
+
+async def consume(model, on_function_call=None):
+    request = LlmRequest(model=model.model, config=types.GenerateContentConfig())
+    texts = []
+    async for response in model.generate_content_async(request, stream=True):
+        part = response.content.parts[0]
+        if part.function_call and on_function_call:
+            await on_function_call()
+        texts.append(part.text or part.function_call.name)
+    return texts
+
+
+async def test_open_model_streams_never_exceed_max_concurrency(mocker, monkeypatch):
+    """同時に開いているモデルのストリーム数が同時実行数の上限を超えないかテストする"""
+    limiter = LlmConcurrencyLimiter(max_concurrency=2)
+    fake, model = patch_gemini(mocker, monkeypatch, limiter)
+
+    results = await asyncio.wait_for(asyncio.gather(*(consume(model) for _ in range(10))), timeout=5)
+
+    assert all(texts == ["途中", "経過", "transfer_to_agent", "完了"] for texts in results)
+    assert fake.max_open == 2
+    assert limiter.get_metrics()["in_flight"] == 0
+
+
+async def test_nested_call_at_function_call_does_not_deadlock(mocker, monkeypatch):
+    """関数呼び出しの応答を受けて呼び出し元が次のLLM呼び出しをしても、同時実行数1で止まらないかテストする"""
+    limiter = LlmConcurrencyLimiter(max_concurrency=1)
+    fake, model = patch_gemini(mocker, monkeypatch, limiter)
+    nested = []
+
+    async def run_sub_agent():
+        # ADKが関数・サブエージェントを実行するのは、この応答を受け取った直後
+        assert limiter.get_metrics()["in_flight"] == 0
+        nested.append(await consume(model))
+
+    outer = await asyncio.wait_for(consume(model, on_function_call=run_sub_agent), timeout=2)
+
+    assert outer == nested[0] == ["途中", "経過", "transfer_to_agent", "完了"]
+    assert fake.max_open == 1
+    assert limiter.get_metrics()["in_flight"] == 0
+
+
+async def test_deadline_sets_timeout_without_dropping_http_options(mocker, monkeypatch):
+    """期限をタイムアウトとして渡すとき、既存のヘッダーやbase_urlを残すかテストする"""
+    import time
+
+    _, model = patch_gemini(mocker, monkeypatch, LlmConcurrencyLimiter(max_concurrency=1))
+    http_options = types.HttpOptions(headers={"x-test": "1"}, base_url="https://example.com")
+    request = LlmRequest(model=model.model, config=types.GenerateContentConfig(http_options=http_options))
+    token = llm_deadline.set(time.monotonic() + 30)
+    try:
+        [response async for response in model.generate_content_async(request, stream=True)]
+    finally:
+        llm_deadline.reset(token)
+
+    options = request.config.http_options
+    assert options.headers["x-test"] == "1" and options.base_url == "https://example.com"
+    assert 1000 <= options.timeout <= 30000
@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+from agents.main_conversation_agent.agent import build_main_instruction, root_agent
+from agents.main_conversation_agent.prompt import MAIN_CONVERSATION_INSTRUCTION
+
+
+def test_instruction_is_built_per_session_without_mutating_agent():
+    """セッションごとにプロンプトが組み立てられ、共有エージェントが書き換えられないことをテストする"""
+    original_instruction = root_agent.instruction
+
+    prompt_a = build_main_instruction(SimpleNamespace(state={"school_name": "A小学校"}))
+    prompt_b = build_main_instruction(SimpleNamespace(state={"school_name": "B小学校"}))
+
+    assert "A小学校" in prompt_a and "B小学校" not in prompt_a
+    assert "B小学校" in prompt_b and "A小学校" not in prompt_b
+    assert len(prompt_a) == len(prompt_b)
+    assert prompt_a.startswith(MAIN_CONVERSATION_INSTRUCTION)
+    assert root_agent.instruction is original_instruction
+
+
+def _preflight_context(user_id, state=None):
+    return SimpleNamespace(session=SimpleNamespace(id="s1", state={"user_id": user_id, **(state or {})}))
+
+
+async def test_user_settings_are_cached_and_session_refreshed_only_on_version_change(mocker):
+    """ユーザー設定がキャッシュされ、設定が変わったときだけセッション状態が更新されるかテストする"""
+    from models.user_settings import UserSettings
+    from services.user_settings_service import user_settings_service
+
+    settings = UserSettings(school_name="テスト小学校", class_name="3年2組", teacher_name="田中先生")
+    mocker.patch.object(user_settings_service, "db", object())
+    fetch = mocker.patch.object(user_settings_service, "get_user_settings", return_value=settings)
+    mocker.patch("agents.main_conversation_agent.agent._load_user_dictionary_terms", return_value=[])
+    mocker.patch("agents.main_conversation_agent.agent.list_user_images", return_value=[])
+    user_settings_service.invalidate_cache("cache-user")
+    ctx = _preflight_context("cache-user")
+
+    await root_agent._run_preflight(ctx)
+    ctx.session.state["school_name"] = "書き換え検出用"
+    await root_agent._run_preflight(ctx)
+
+    assert fetch.call_count == 1
+    assert ctx.session.state["school_name"] == "書き換え検出用"
+
+    fetch.return_value = settings.model_copy(update={"school_name": "新小学校"})
+    user_settings_service.invalidate_cache("cache-user")
+    await root_agent._run_preflight(ctx)
+
+    assert fetch.call_count == 2
+    assert ctx.session.state["school_name"] == "新小学校"
+
+
+async def test_failed_preflight_steps_keep_existing_session_state(mocker):
+    """設定・画像の取得が失敗した場合に、既存の基本情報や画像がデフォルト値で上書きされないかテストする"""
+    from services.user_settings_service import user_settings_service
+
+    mocker.patch.object(user_settings_service, "get_cached_user_settings", side_effect=RuntimeError("unavailable"))
+    mocker.patch("agents.main_conversation_agent.agent._load_user_dictionary_terms", return_value=[])
+    list_images = mocker.patch(
+        "agents.main_conversation_agent.agent.list_user_images", side_effect=RuntimeError("unavailable")
+    )
+    images = [{"name": "photo.jpg", "url": "https://example.com/photo.jpg"}]
+    ctx = _preflight_context("failing-user", {"school_name": "本物小学校", "uploaded_images": images})
+
+    await root_agent._run_preflight(ctx)
+
+    assert ctx.session.state["school_name"] == "本物小学校"
+    assert ctx.session.state["uploaded_images"] == images
+    # 画像はユーザー全体ではなくこのチャットセッションの分のみ取得する
+    list_images.assert_called_once_with("s1")
+
+
+async def test_emptied_dictionary_clears_terms_but_failed_fetch_keeps_them(mocker):
+    """登録語をすべて削除した場合はセッションの用語も消え、取得に失敗した場合は残るかテストする"""
+    from services.user_settings_service import user_settings_service
+
+    mocker.patch.object(user_settings_service, "get_cached_user_settings", return_value=None)
+    mocker.patch("agents.main_conversation_agent.agent.list_user_images", return_value=[])
+    load_terms = mocker.patch(
+        "agents.main_conversation_agent.agent._load_user_dictionary_terms", side_effect=RuntimeError("unavailable")
+    )
+    ctx = _preflight_context("dictionary-user", {"user_dictionary_terms": ["削除した用語"]})
+
+    await root_agent._run_preflight(ctx)
+    assert ctx.session.state["user_dictionary_terms"] == ["削除した用語"]
+
+    load_terms.side_effect = None
+    load_terms.return_value = []
+    await root_agent._run_preflight(ctx)
+    assert ctx.session.state["user_dictionary_terms"] == []
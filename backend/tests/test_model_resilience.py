@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from google.genai import errors as genai_errors
+
+from agents.shared.model_resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    resilient_stream,
+)
+
+
+def flaky_call(failures, code=503, yield_before_error=False):
+    calls = {"count": 0}
+
+    async def call():
+        calls["count"] += 1
+        if yield_before_error:
+            yield "partial"
+        if calls["count"] <= failures:
+            raise genai_errors.ServerError(code, {"error": {"message": "unavailable"}})
+        yield "ok"
+
+    return call, calls
+
+
+async def collect(call, policy, breaker):
+    return [item async for item in resilient_stream(call, policy, breaker)]
+
+
+async def test_transient_errors_are_retried_but_not_after_partial_output():
+    """一時的エラーはリトライされ、応答を返し始めた後のエラーはリトライされないかテストする"""
+    policy = RetryPolicy(max_attempts=3, base_delay=0.001)
+    call, calls = flaky_call(failures=2)
+    assert await collect(call, policy, CircuitBreaker()) == ["ok"]
+    assert calls["count"] == 3
+
+    call, calls = flaky_call(failures=1, yield_before_error=True)
+    with pytest.raises(genai_errors.ServerError):
+        await collect(call, policy, CircuitBreaker())
+    assert calls["count"] == 1
+
+    call, calls = flaky_call(failures=1, code=400)
+    with pytest.raises(genai_errors.APIError):
+        await collect(call, policy, CircuitBreaker())
+    assert calls["count"] == 1
+
+
+async def test_circuit_breaker_fails_fast_during_outage_and_recovers():
+    """障害が続くとブレーカーが開いて即座に失敗し、期限後の試行が成功すると閉じるかテストする"""
+    policy = RetryPolicy(max_attempts=1)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    call, calls = flaky_call(failures=2)
+    for _ in range(2):
+        with pytest.raises(genai_errors.ServerError):
+            await collect(call, policy, breaker)
+
+    with pytest.raises(CircuitOpenError):
+        await collect(call, policy, breaker)
+    assert calls["count"] == 2
+    assert breaker.get_metrics()["short_circuited"] == 1
+
+    await asyncio.sleep(0.06)
+    assert await collect(call, policy, breaker) == ["ok"]
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai.types import Content, Part
+
+from agents.shared.model_router import (
+    ESCALATION_STATE_KEY,
+    get_policy,
+    record_model_route_after_model,
+    route_model_before_model,
+    select_route,
+)
+
+
+def test_select_route_by_agent_and_turn():
+    """レイアウト生成・修正依頼はpro、短い対話はfastに振り分けられるかテストする"""
+    policy = get_policy("tiered")
+
+    assert select_route("layout_agent", "作成してください", False, policy) == ("layout", policy.pro_model)
+    assert select_route("main_conversation_agent", "3年2組です", False, policy) == ("dialogue", policy.fast_model)
+    assert select_route("main_conversation_agent", "内容が違います", False, policy)[0] == "escalated"
+    assert select_route("main_conversation_agent", "あ" * 1000, False, policy)[0] == "long_turn"
+    assert select_route("main_conversation_agent", "はい", False, get_policy("pro_only"))[1] == policy.pro_model
+
+
+def test_empty_fast_response_escalates_next_call():
+    """fastモデルの応答が空の場合、次の呼び出しがproに昇格するかテストする"""
+    callback_context = SimpleNamespace(
+        agent_name="main_conversation_agent",
+        user_content=Content(role="user", parts=[Part(text="はい")]),
+        state={},
+    )
+    llm_request = LlmRequest()
+
+    route_model_before_model(callback_context=callback_context, llm_request=llm_request)
+    assert llm_request.model == get_policy().fast_model
+
+    record_model_route_after_model(callback_context=callback_context, llm_response=LlmResponse())
+    assert callback_context.state[ESCALATION_STATE_KEY] is True
+
+    route_model_before_model(callback_context=callback_context, llm_request=llm_request)
+    assert llm_request.model == get_policy().pro_model
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+from agents.shared.preflight import PreflightStep, run_preflight
+
+
+async def test_steps_run_concurrently_and_slow_step_falls_back_to_default():
+    """各ステップが並列に実行され、期限切れのステップはデフォルト値になるかテストする"""
+
+    async def fetch(value, delay):
+        await asyncio.sleep(delay)
+        return value
+
+    async def fail():
+        raise RuntimeError("unavailable")
+
+    started = time.perf_counter()
+    results, timings = await run_preflight([
+        PreflightStep("settings", lambda: fetch("settings", 0.1)),
+        PreflightStep("outline", lambda: fetch("outline", 0.1)),
+        PreflightStep("images", lambda: fetch(["slow"], 5), default=[], timeout=0.2),
+        PreflightStep("dictionary", fail, default=[]),
+    ])
+    elapsed = time.perf_counter() - started
+
+    assert elapsed < 0.5
+    assert results == {"settings": "settings", "outline": "outline", "images": [], "dictionary": []}
+    assert timings["images"]["status"] == "timeout"
+    assert timings["dictionary"]["status"] == "error"
+    assert timings["settings"]["status"] == "ok" and timings["settings"]["ms"] >= 100
@@ -0,0 +1,42 @@
+from app.core import rate_limiter as rate_limiter_module
+from app.core.rate_limiter import InMemoryRateLimiter
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_sliding_window_limits_requests_and_weights_previous_window(monkeypatch):
+    """制限回数を超えたリクエストを拒否し、前の窓の件数が経過時間に応じて減っていくかテストする"""
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter_module.time, "time", clock)
+    limiter = InMemoryRateLimiter()
+
+    results = [limiter.is_allowed("1.2.3.4", limit=10, window=60)[0] for _ in range(12)]
+    assert results == [True] * 10 + [False] * 2
+    assert limiter.is_allowed("5.6.7.8", limit=10, window=60)[1]["remaining"] == 9
+
+    # 次の窓の半分が過ぎると前の窓の10件は5件分として数えられる
+    clock.now += 60 + 30
+    allowed = [limiter.is_allowed("1.2.3.4", limit=10, window=60)[0] for _ in range(6)]
+    assert allowed == [True] * 5 + [False]
+
+
+def test_idle_keys_are_swept_and_key_count_is_bounded(monkeypatch):
+    """アクセスのない識別子が定期的に削除され、識別子数が上限を超えないかテストする"""
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter_module.time, "time", clock)
+    limiter = InMemoryRateLimiter(max_keys=100, sweep_interval=10)
+
+    for i in range(150):
+        limiter.is_allowed(f"10.0.0.{i}", limit=5, window=60)
+    assert len(limiter.requests) == 100
+
+    clock.now += 120
+    limiter.is_allowed("active", limit=5, window=60)
+    assert list(limiter.requests) == ["active"]
+    assert limiter.evictions == 150
@@ -0,0 +1,96 @@
+from google.adk.events.event import Event, EventActions
+from google.genai.types import Content, Part
+
+from services.session_service import FakeRedis, PersistentSessionService, RedisSessionBackend
+
+APP_NAME = "gakkoudayori-agent"
+
+
+def create_service(backend=None, **kwargs):
+    backend = backend or RedisSessionBackend(FakeRedis())
+    return PersistentSessionService(backend, flush_interval=0, **kwargs)
+
+
+async def test_session_shared_between_instances():
+    """別インスタンス（別サービス）からも書き込み済みのイベントと状態が見えるかテストする"""
+    backend = RedisSessionBackend(FakeRedis())
+    instance_a = create_service(backend)
+    instance_b = create_service(backend)
+
+    session = await instance_a.create_session(
+        app_name=APP_NAME, user_id="u1", session_id="s1", state={"user_id": "u1"}
+    )
+    event = Event(
+        author="user",
+        content=Content(parts=[Part(text="運動会の学級通信")]),
+        actions=EventActions(state_delta={"school_name": "テスト小学校", "temp:x": 1}),
+    )
+    await instance_a.append_event(session, event)
+    await instance_a.flush()
+
+    loaded = await instance_b.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    assert loaded is not None
+    assert [e.id for e in loaded.events] == [event.id]
+    assert loaded.state["school_name"] == "テスト小学校"
+    assert "temp:x" not in loaded.state
+
+
+async def test_expired_session_is_not_returned():
+    """TTLを過ぎたセッションが取得できないことをテストする"""
+    service = create_service(ttl_seconds=-1)
+    await service.create_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+
+    assert await service.get_session(app_name=APP_NAME, user_id="u1", session_id="s1") is None
+
+
+async def test_hot_tier_eviction_keeps_pending_writes():
+    """ホット層から追い出されたセッションも未反映の書き込みが失われないことをテストする"""
+    service = create_service(hot_cache_size=1)
+    first = await service.create_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    event = Event(author="user", content=Content(parts=[Part(text="hello")]))
+    await service.append_event(first, event)
+    await service.create_session(app_name=APP_NAME, user_id="u1", session_id="s2")
+
+    loaded = await service.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    assert [e.id for e in loaded.events] == [event.id]
+
+
+async def test_history_over_budget_is_compacted_and_reported():
+    """イベント履歴がバイト上限を超えると古い長文が圧縮され、メトリクスに反映されるかテストする"""
+    service = create_service(max_session_bytes=40_000)
+    session = await service.create_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    for _ in range(10):
+        html = "<!DOCTYPE html>" + "x" * 5000
+        await service.append_event(session, Event(author="layout_agent", content=Content(parts=[Part(text=html)])))
+
+    metrics = service.get_metrics()
+    assert metrics["live_sessions"] == 1
+    assert metrics["bytes_held"] <= 40_000
+    assert metrics["compacted_events"] == 4
+    loaded = await service.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    assert loaded.events[0].content.parts[0].text.startswith("[省略された出力")
+
+
+async def test_hot_session_reloaded_after_write_from_other_instance():
+    """他インスタンスが書き込んだ後は、ホット層の古いコピーを返さず状態も巻き戻さないかテストする"""
+    backend = RedisSessionBackend(FakeRedis())
+    instance_a = create_service(backend)
+    instance_b = create_service(backend)
+    session_a = await instance_a.create_session(app_name=APP_NAME, user_id="u1", session_id="s1", state={"k": 1})
+
+    session_b = await instance_b.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    from_b = Event(author="user", actions=EventActions(state_delta={"k": 2}))
+    await instance_b.append_event(session_b, from_b)
+    await instance_b.flush()
+
+    session_a = await instance_a.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    assert [e.id for e in session_a.events] == [from_b.id]
+    assert session_a.state["k"] == 2
+
+    from_a = Event(author="user", content=Content(parts=[Part(text="hello")]))
+    await instance_a.append_event(session_a, from_a)
+    await instance_a.flush()
+
+    loaded = await instance_b.get_session(app_name=APP_NAME, user_id="u1", session_id="s1")
+    assert [e.id for e in loaded.events] == [from_b.id, from_a.id]
+    assert loaded.state["k"] == 2
@@ -0,0 +1,63 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from google.adk.events import Event, EventActions
+from google.genai.types import Content, FunctionCall, Part
+from sse_starlette.sse import AppStatus, EventSourceResponse
+
+from app.core.artifact_manager import ArtifactManager
+from app.core.sse_compression import SSECompressionMiddleware
+from app.core.sse_events import event_frame, html_stream_frame
+
+HTML = "<html>" + "<p>学級通信</p>" * 500 + "</html>"
+
+
+async def test_compact_events_keep_text_and_send_html_by_reference():
+    """フロントエンドが使うテキストだけを残し、保存済みの完成HTMLは参照で送るかテストする"""
+    text_event = Event(
+        author="main_conversation_agent",
+        content=Content(role="model", parts=[Part(text="学級通信を作成しました")]),
+        actions=EventActions(state_delta={"html": HTML}),
+    )
+    tool_event = Event(
+        author="main_conversation_agent",
+        content=Content(role="model", parts=[Part(function_call=FunctionCall(name="save_outline", args={"outline": HTML}))]),
+    )
+
+    frame = json.loads(event_frame(text_event)["data"])
+    assert frame["content"]["parts"] == [{"text": "学級通信を作成しました"}]
+    assert "actions" not in frame
+    assert len(event_frame(tool_event)["data"]) < 200
+    assert event_frame(Event(author="layout_agent")) is None
+
+    manager = ArtifactManager()
+    stored = await manager.store_html_artifact("u:s1", HTML)
+    complete = Event(author="layout_agent", partial=True, custom_metadata={"html_complete": HTML, "seq": 3})
+    payload = json.loads(html_stream_frame(complete, "u:s1", manager.get_artifact)["data"])
+    assert "data" not in payload
+    assert payload["artifact"]["version"] == stored.version
+
+
+def test_sse_stream_is_gzip_compressed_when_negotiated():
+    """Accept-Encoding: gzip のクライアントにだけSSEを圧縮して送るかテストする"""
+    app = FastAPI()
+    app.add_middleware(SSECompressionMiddleware, enabled=True)
+
+    @app.get("/stream")
+    async def stream():
+        async def events():
+            for i in range(20):
+                yield {"data": json.dumps({"seq": i, "text": "こんにちは" * 20}, ensure_ascii=False)}
+        return EventSourceResponse(events())
+
+    # 他のテストのイベントループに紐づいた終了イベントを作り直させる
+    AppStatus.should_exit_event = None
+    with TestClient(app) as client:
+        compressed = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        plain = client.get("/stream", headers={"Accept-Encoding": "identity"})
+
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in plain.headers
+    assert compressed.text == plain.text
+    assert compressed.text.count("data:") == 20
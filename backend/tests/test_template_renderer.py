@@ -0,0 +1,37 @@
+from agents.layout_agent.template_renderer import (
+    parse_outline,
+    render_newsletter_html,
+    validate_outline,
+    wants_custom_design,
+)
+
+BASIC_INFO = {
+    "school_name": "テスト小学校",
+    "class_name": "3年2組",
+    "teacher_name": "田中先生",
+    "current_date": "2025-10-01",
+}
+
+
+def test_outline_in_json_fence_is_rendered_and_escaped():
+    """```json フェンス付きの構成案からHTMLが生成され、本文がエスケープされるかテストする"""
+    raw_outline = '```json\n{"main_title": "運動会", "sections": [{"title": "練習", "content": "<b>がんばりました</b>"}]}\n```'
+
+    outline = validate_outline(parse_outline(raw_outline), BASIC_INFO)
+    html = render_newsletter_html(outline)
+
+    assert html.startswith("<!DOCTYPE html>")
+    assert "テスト小学校 3年2組" in html
+    assert "&lt;b&gt;がんばりました&lt;/b&gt;" in html
+
+
+def test_outline_without_sections_falls_back_to_llm():
+    """本文のない構成案はテンプレート生成の対象外になるかテストする"""
+    assert validate_outline({"main_title": "運動会", "sections": []}, BASIC_INFO) is None
+    assert parse_outline("まだ構成案はありません") is None
+
+
+def test_custom_design_request_is_detected():
+    """カスタムデザインの要望があるメッセージを判定できるかテストする"""
+    assert wants_custom_design("もっとおしゃれなデザインにしてください")
+    assert not wants_custom_design("作成してください")
@@ -0,0 +1,28 @@
+from unittest.mock import AsyncMock, MagicMock
+
+from models.user_settings import UserSettings
+from services.user_settings_service import UserSettingsCache, UserSettingsService
+
+
+def make_service(mocker, stored: dict) -> UserSettingsService:
+    """Firestoreのドキュメント1件（stored）を読み書きするサービスを作る"""
+    snapshot = MagicMock(exists=True)
+    snapshot.to_dict.side_effect = lambda: dict(stored)
+    doc_ref = MagicMock()
+    doc_ref.get = AsyncMock(return_value=snapshot)
+    doc_ref.update = AsyncMock(side_effect=stored.update)
+    db = MagicMock()
+    db.collection.return_value.document.return_value.collection.return_value.document.return_value = doc_ref
+    mocker.patch("services.user_settings_service.get_db_client", return_value=db)
+    return UserSettingsService(cache=UserSettingsCache())
+
+
+async def test_title_usage_update_invalidates_cached_settings(mocker):
+    """号数を進めた直後に、キャッシュ経由の取得が新しい号数を返すかテストする"""
+    stored = UserSettings(school_name="本物小学校", class_name="3年1組", teacher_name="山田").dict()
+    service = make_service(mocker, stored)
+    assert (await service.get_cached_user_settings("u1")).title_templates.current_number == 1
+
+    assert await service.update_title_usage("u1", "学級だより1号")
+
+    assert (await service.get_cached_user_settings("u1")).title_templates.current_number == 2
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+from app.core.artifact_manager import ArtifactManager
+
+
+class FakeWebSocket:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(text) if text.startswith("{") else text)
+
+
+async def test_all_subscribers_receive_artifact_and_slow_client_does_not_block():
+    """複数の購読者に配信され、遅いクライアントが配信元や他の購読者を待たせないかテストする"""
+    manager = ArtifactManager()
+    hub = manager.websocket_manager
+    fast, slow = FakeWebSocket(), FakeWebSocket(delay=0.5)
+    await hub.connect("s1", fast)
+    await hub.connect("s1", slow)
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await manager.store_html_artifact("s1", "<html>v1</html>")
+    assert loop.time() - started < 0.1
+
+    await asyncio.sleep(0.05)
+    assert fast.sent[0]["type"] == "html_artifact"
+    assert slow.sent == []
+    assert hub.connection_count("s1") == 2
+    await hub.disconnect("s1")
+
+
+async def test_backlogged_subscriber_gets_only_latest_artifact():
+    """送信が詰まった購読者には途中の版や差分を捨て、最新の版だけが送られるかテストする"""
+    manager = ArtifactManager()
+    manager.websocket_manager.queue_size = 4
+    websocket = FakeWebSocket(delay=0.05)
+    await manager.websocket_manager.connect("s1", websocket)
+
+    for seq in range(10):
+        await manager.publish_html_delta("s1", f"<p>{seq}</p>", seq)
+    for version in range(1, 4):
+        latest = await manager.store_html_artifact("s1", f"<html>v{version}</html>")
+    await asyncio.sleep(0.5)
+
+    artifacts = [m for m in websocket.sent if m["type"] == "html_artifact"]
+    deltas = [m for m in websocket.sent if m["type"] == "html_delta"]
+    assert [a["data"]["version"] for a in artifacts] == [latest.version]
+    assert len(deltas) <= 4
+    assert manager.websocket_manager.stats["dropped"] >= 6
+    await manager.websocket_manager.disconnect("s1")
+
+
+async def test_heartbeat_pings_and_reaps_idle_connections():
+    """サーバーからpingを送り、応答のない接続だけが回収されるかテストする"""
+    manager = ArtifactManager()
+    hub = manager.websocket_manager
+    hub.ping_interval, hub.idle_timeout = 0.05, 0.12
+    alive, dead = FakeWebSocket(), FakeWebSocket()
+    closed = []
+
+    async def close(code=1000):
+        closed.append(code)
+
+    dead.close = close
+    alive_subscriber = await hub.connect("s1", alive)
+    await hub.connect("s1", dead)
+
+    for _ in range(6):
+        await asyncio.sleep(0.05)
+        await manager.handle_client_message(alive_subscriber, "ping")
+
+    assert {"type": "ping"} in alive.sent
+    assert closed == [1001]
+    assert hub.connection_count("s1") == 1
+    assert hub.get_metrics()["reaped"] == 1
+    await hub.disconnect("s1")